@@ -0,0 +1,273 @@
+"""
+Author: Carlos Valcarcel <carlos.d.valcarcel.w@gmail.com>
+
+This file is part of spot-connect
+
+Asyncio interface - aio.py:
+
+The aio sub-module wraps SpotInstance and InstanceManager so a cluster can be
+driven from a single event loop (e.g. a notebook kernel) alongside other async
+services. The blocking boto3 and paramiko calls run in two bounded thread pools,
+one for AWS API calls and one for SSH/SFTP, so the number of concurrent calls
+stays under control however many coroutines are running. Streams (command
+output, map results) are long lived and run in their own threads instead, so
+open streams never hold up the calls waiting for the pools:
+
+    manager = AsyncInstanceManager()
+    instances = await manager.launch_many(['worker_1', 'worker_2'], profile='t2.micro')
+    results = await manager.run_on_all('nproc')
+
+    async for line in instances[0].stream('python train.py'):
+        print(line)
+
+Use `configure` to change the size of the thread pools.
+
+MIT License 2020
+"""
+
+import asyncio, functools, threading, concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+from spot_connect import spotted, instance_methods, job_methods
+from spot_connect.instance_manager import InstanceManager
+
+executors = {}
+executor_sizes = {'aws': 16, 'ssh': 32}
+executor_lock = threading.Lock()
+
+
+def configure(aws_workers=None, ssh_workers=None):
+    '''
+    Set the maximum number of concurrent blocking calls. Pools already in use are shut down (without waiting) and replaced.
+    __________
+    parameters
+    - aws_workers : int. maximum number of concurrent boto3 calls (launching, describing and terminating instances)
+    - ssh_workers : int. maximum number of concurrent SSH/SFTP calls
+    '''
+    with executor_lock:
+        for kind, size in (('aws', aws_workers), ('ssh', ssh_workers)):
+            if size is None:
+                continue
+            executor_sizes[kind] = size
+            if kind in executors:
+                executors.pop(kind).shutdown(wait=False)
+
+
+def get_executor(kind):
+    '''Return the thread pool for "aws" or "ssh" calls, creating it the first time'''
+    with executor_lock:
+        if kind not in executors:
+            executors[kind] = ThreadPoolExecutor(max_workers=executor_sizes[kind], thread_name_prefix='spot_connect_'+kind)
+        return executors[kind]
+
+
+async def run_blocking(kind, func, *args, **kwargs):
+    '''Run a blocking function in the "aws" or "ssh" thread pool and return its result'''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(kind), functools.partial(func, *args, **kwargs))
+
+
+async def iterate_blocking(kind, iterator_factory, maxsize=100):
+    '''
+    Turn a blocking iterator into an async iterator. The iterator returned by iterator_factory() is consumed in a thread of its own (not in the `kind` pool,
+    where a stream would hold a slot for as long as it is open) and its items are passed through a bounded queue, so a slow consumer slows the producer down.
+    Exceptions raised by the iterator are raised in the consumer.
+    '''
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue(maxsize=maxsize)
+    closed = threading.Event()
+    done = object()
+
+    def put(item):
+        future = asyncio.run_coroutine_threadsafe(items.put(item), loop)
+        while True:
+            try:
+                return future.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                if closed.is_set():
+                    future.cancel()
+                    return
+
+    def produce():
+        try:
+            for item in iterator_factory():
+                if closed.is_set():
+                    return
+                put((False, item))
+            put((False, done))
+        except Exception as e:
+            put((True, e))
+        finally:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(lambda: producer.done() or producer.set_result(None))
+
+    producer = loop.create_future()
+    threading.Thread(target=produce, daemon=True, name='spot_connect_'+kind+'_stream').start()
+    try:
+        while True:
+            failed, item = await items.get()
+            if failed:
+                raise item
+            if item is done:
+                break
+            yield item
+        await producer
+    finally:
+        # If the consumer stopped early the producer returns at its next item instead of running to the end
+        closed.set()
+        while not items.empty():
+            items.get_nowait()
+
+
+def stream_command(instance, user_name, command, kp_dir=None, port=22):
+    '''Run a command on the instance over a pooled SSH connection and yield its combined output line by line as it is produced'''
+    client = instance_methods.get_connection(instance, user_name, port=port, kp_dir=kp_dir)
+    session = client.get_transport().open_session()
+    session.set_combine_stderr(True)
+    session.exec_command(command)
+    try:
+        for line in session.makefile():
+            yield line.rstrip('\n') if isinstance(line, str) else line.decode('utf-8', errors='replace').rstrip('\n')
+    finally:
+        session.close()
+
+
+class AsyncSpotInstance:
+
+    sync        =   None
+
+    def __init__(self, instance):
+        '''
+        Asyncio wrapper of a spotted.SpotInstance, launch new instances with `await AsyncSpotInstance.launch(name, ...)`.
+        The wrapped instance is available as the `sync` attribute.
+        __________
+        parameters
+        - instance : spotted.SpotInstance. instance to wrap
+        '''
+        self.sync = instance
+
+    @classmethod
+    async def launch(cls, name, **kwargs):
+        '''Launch (or connect to) an instance in the AWS thread pool, the keyword arguments are the same as for spotted.SpotInstance'''
+        return cls(await run_blocking('aws', spotted.SpotInstance, name, **kwargs))
+
+    @property
+    def instance(self):
+        return self.sync.instance
+
+    @property
+    def username(self):
+        return self.sync.profile['username']
+
+    async def refresh(self):
+        '''Refresh the instance's description and state'''
+        await run_blocking('aws', self.sync.refresh_instance, verbose=False)
+        return self.sync.state
+
+    async def run(self, command):
+        '''Run a command over a pooled SSH connection and return its (exit status, combined output)'''
+        return await run_blocking('ssh', instance_methods.run_command, self.instance, self.username, command, kp_dir=self.sync.kp_dir)
+
+    async def stream(self, command):
+        '''Run a command and yield its output lines as they are produced: async for line in instance.stream(command)'''
+        async for line in iterate_blocking('ssh', lambda: stream_command(self.instance, self.username, command, kp_dir=self.sync.kp_dir)):
+            yield line
+
+    async def start_script(self, script, job_id=None):
+        '''Start a script in the background on the instance and return its job_methods.ScriptHandle'''
+        handle = job_methods.ScriptHandle(self.instance, self.username, script, job_id=job_id, kp_dir=self.sync.kp_dir)
+        await run_blocking('ssh', handle.start)
+        return handle
+
+    async def wait_script(self, handle, poll_interval=10):
+        '''Wait until a background script finishes and return its final status'''
+        while True:
+            status = await run_blocking('ssh', handle.status)
+            if status!='running':
+                return status
+            await asyncio.sleep(poll_interval)
+
+    async def follow(self, handle, poll_interval=5):
+        '''Yield the new output lines of a background script until it finishes'''
+        seen = 0
+        while True:
+            status = await run_blocking('ssh', handle.status)
+            lines = (await run_blocking('ssh', handle.output)).splitlines()
+            for line in lines[seen:]:
+                yield line
+            seen = len(lines)
+            if status!='running':
+                return
+            await asyncio.sleep(poll_interval)
+
+    async def upload(self, files, remotepath, verbose=False):
+        await run_blocking('ssh', self.sync.upload, files, remotepath, verbose=verbose)
+
+    async def download(self, files, localpath):
+        await run_blocking('ssh', self.sync.download, files, localpath)
+
+    async def terminate(self):
+        await run_blocking('aws', self.sync.terminate)
+
+
+class AsyncInstanceManager:
+
+    sync        =   None
+    instances   =   None
+
+    def __init__(self, manager=None, **kwargs):
+        '''
+        Asyncio wrapper of an instance_manager.InstanceManager. Blocking methods of the manager that do not have an async version can be called with `await manager.call(<method name>, ...)`.
+        __________
+        parameters
+        - manager : InstanceManager. manager to wrap, a new one is created with the keyword arguments if None
+        '''
+        if manager is None:
+            manager = InstanceManager(**kwargs)
+        self.sync = manager
+        self.instances = {}
+
+    async def call(self, method, *args, **kwargs):
+        '''Run a blocking InstanceManager method in the AWS thread pool and return its result'''
+        return await run_blocking('aws', getattr(self.sync, method), *args, **kwargs)
+
+    async def launch_instance(self, name, **kwargs):
+        '''Launch an instance, the keyword arguments are the same as for InstanceManager.launch_instance. Returns its AsyncSpotInstance'''
+        await self.call('launch_instance', name, **kwargs)
+        self.instances[name] = AsyncSpotInstance(self.sync.instances[name])
+        return self.instances[name]
+
+    async def launch_many(self, names, max_concurrency=8, return_exceptions=False, **kwargs):
+        '''
+        Launch several instances concurrently with the same settings and return their AsyncSpotInstance in the same order as the names.
+        __________
+        parameters
+        - names : list of str. names of the instances
+        - max_concurrency : int. maximum number of instances being launched at the same time
+        - return_exceptions : bool. if True, the exception raised by a failed launch is returned in its place instead of being raised
+        - kwargs : same as for InstanceManager.launch_instance
+        '''
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def launch(name):
+            async with semaphore:
+                return await self.launch_instance(name, **kwargs)
+
+        return await asyncio.gather(*[launch(name) for name in names], return_exceptions=return_exceptions)
+
+    async def run_on_all(self, command, names=None):
+        '''Run a command on all the launched instances (or the named ones) concurrently and return {name: (exit status, output)}'''
+        if names is None:
+            names = list(self.instances)
+        results = await asyncio.gather(*[self.instances[name].run(command) for name in names], return_exceptions=True)
+        return dict(zip(names, results))
+
+    async def terminate_all(self, names=None):
+        if names is None:
+            names = list(self.instances)
+        await asyncio.gather(*[self.instances[name].terminate() for name in names])
+
+    async def map(self, func, iterable, **kwargs):
+        '''Async version of InstanceManager.map, yield the results as they complete: async for result in manager.map(func, items, fid=fid)'''
+        async for result in iterate_blocking('ssh', lambda: self.sync.map(func, iterable, **kwargs)):
+            yield result
@@ -12,7 +12,7 @@ for common packages, updating github repos, and managing spot-fleet settings.
 MIT License 2020
 """
 
-import base64
+import base64, shlex
 
 
 def init_userdata_script(python3=True):
@@ -45,7 +45,41 @@ def compose_s3_sync_script(source, dest, instance_path, logfile='s3_sync_log', d
     script +="nohup sh -c 'while ps -p $0 &> /dev/null; do sleep 10 ; done && sudo shutdown -h now ' $curpid &> s3_transfer.txt &"+delimiter  
     
     return script
-    
+
+
+def compose_parallel_s3_sync_script(source, dest, prefixes, max_concurrent_requests=64, multipart_chunksize_mb=64, shutdown=True, shutdown_delay=120, delimiter='\n', script=''):
+    '''
+    Sync a share of the top-level folders between an instance path and s3 with tuned aws cli concurrency, one folder at a time.
+    The line "### done <n>" is printed after the n-th folder so the progress can be followed from the output (see InstanceManager.s3_transfer_progress).
+    The script exits with status 1 if any sync failed.
+    __________
+    parameters
+    - source : str. instance path or "s3://<bucket>/<prefix>" to sync from
+    - dest : str. instance path or "s3://<bucket>/<prefix>" to sync to
+    - prefixes : list of str. top-level folders to sync, "" syncs the files directly under the source
+    - max_concurrent_requests : int. number of concurrent requests of the aws cli
+    - multipart_chunksize_mb : int. size of the multipart parts in MB
+    - shutdown : bool. if True, shut down the instance `shutdown_delay` seconds after the sync (so the final status can still be read)
+    '''
+    script += 'aws configure set default.s3.max_concurrent_requests '+str(max_concurrent_requests)+delimiter
+    script += 'aws configure set default.s3.max_queue_size '+str(max(10000, max_concurrent_requests*100))+delimiter
+    script += 'aws configure set default.s3.multipart_chunksize '+str(multipart_chunksize_mb)+'MB'+delimiter
+    script += 'failed=0'+delimiter
+
+    source, dest = source.rstrip('/'), dest.rstrip('/')
+    for n, prefix in enumerate(prefixes):
+        if prefix=='':
+            script += 'aws s3 sync '+shlex.quote(source)+' '+shlex.quote(dest)+' --exclude "*/*" || failed=1'+delimiter
+        else:
+            script += 'aws s3 sync '+shlex.quote(source+'/'+prefix)+' '+shlex.quote(dest+'/'+prefix)+' || failed=1'+delimiter
+        script += 'echo "### done '+str(n)+'"'+delimiter
+
+    if shutdown:
+        script += "nohup sh -c 'sleep "+str(shutdown_delay)+"; sudo shutdown -h now' > /dev/null 2>&1 &"+delimiter
+    script += 'exit $failed'+delimiter
+
+    return script
+
 
 def update_git_repo(repo_path, branch=None, repo_link=None, delimiter='\n', script=''):
     '''Update the github repo at the given path. Use the repo_link arg for private repos that require authentication details'''
@@ -85,11 +119,37 @@ def install_ta_lib(download=False, install_as_user=None, delimiter='\n', script=
     return script 
 
 
-def compose_mount_script(filesystem_dns, base='/home/ec2-user', delimiter='\n', script=''):
-    '''Create a script of linux commands that can be run on an instance to connect an EFS'''
+# NFS options for mounting an EFS, see https://docs.aws.amazon.com/efs/latest/ug/mounting-fs-nfs-mount-settings.html 
+# "throughput" opens several TCP connections to the EFS (nconnect needs a linux kernel >= 5.3) and raises the read-ahead, for large sequential files 
+# "metadata" caches file attributes for longer, for many small files that are not modified by several instances at the same time 
+mount_presets = {'default': {'options': 'nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2,noresvport', 'read_ahead_kb': None},
+                 'throughput': {'options': 'nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2,noresvport,noatime,nconnect=16', 'read_ahead_kb': 15360},
+                 'metadata': {'options': 'nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2,noresvport,noatime,nodiratime,actimeo=60', 'read_ahead_kb': None}}
+
+
+def compose_mount_script(filesystem_dns, base='/home/ec2-user', preset='default', options=None, read_ahead_kb=None, delimiter='\n', script=''):
+    '''
+    Create a script of linux commands that can be run on an instance to connect an EFS
+    __________
+    parameters
+    - filesystem_dns : str. DNS of the file system (see efs_methods.get_filesystem_dns)
+    - base : str. directory the EFS is mounted under, as <base>/efs
+    - preset : str. NFS settings from mount_presets: "default", "throughput" or "metadata"
+    - options : str. NFS mount options, overrides the options of the preset
+    - read_ahead_kb : int. read-ahead of the mount in KB, overrides the read-ahead of the preset
+    '''
+    if preset not in mount_presets: 
+        raise Exception('Unknown mount preset "'+str(preset)+'", use one of: '+', '.join(mount_presets))
+    if options is None: 
+        options = mount_presets[preset]['options']
+    if read_ahead_kb is None: 
+        read_ahead_kb = mount_presets[preset]['read_ahead_kb']
     
     script+='mkdir '+base+'/efs'+delimiter
-    script+='sudo mount -t nfs -o nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2,noresvport '+filesystem_dns+':/   '+base+'/efs '+delimiter
+    script+='sudo mount -t nfs -o '+options+' '+filesystem_dns+':/   '+base+'/efs '+delimiter
+    if read_ahead_kb is not None: 
+        # The NFS mount's read-ahead is set through its backing device info 
+        script+='echo '+str(int(read_ahead_kb))+' | sudo tee /sys/class/bdi/0:$(stat -c "%d" '+base+'/efs)/read_ahead_kb > /dev/null'+delimiter
     script+='cd '+base+'/efs'+delimiter
     # go-rwx removes read, write, execute permissions from the group and other users. It will not change permissions for the user that owns the file.
     script+='sudo chmod go+rw .'+delimiter
@@ -99,6 +159,230 @@ def compose_mount_script(filesystem_dns, base='/home/ec2-user', delimiter='\n',
     return script 
 
 
+def compose_efs_benchmark_script(directory, size_mb=1024, streams=4, n_files=2000, delimiter='\n', script=''):
+    '''
+    Measure the throughput of a mounted EFS (or any directory) from the instance, to compare mount presets and throughput modes. 
+    Runs a sequential write and read of `streams` files of `size_mb` MB in parallel (the page cache is dropped before reading) and the creation, listing and deletion of `n_files` small files. 
+    Each result is printed on a line "### <test> <seconds> <rate>" where the rate is in MB/s for the sequential tests and files/s for the metadata tests. 
+    __________
+    parameters
+    - directory : str. directory on the mount to benchmark, a temporary sub-directory is created and removed in it
+    - size_mb : int. size of each sequential test file in MB
+    - streams : int. number of files written and read in parallel
+    - n_files : int. number of small files for the metadata tests
+    '''
+    work = shlex.quote(directory.rstrip('/')+'/.spot_connect_benchmark')
+    total_mb = size_mb*streams
+
+    script += 'set -e'+delimiter
+    script += 'mkdir -p '+work+delimiter
+    script += 'now() { date +%s.%N; }'+delimiter
+    script += 'report() { awk -v t="$1" -v s="$2" -v e="$3" -v n="$4" \'BEGIN { d = e-s; printf "### %s %.3f %.1f\\n", t, d, n/d }\'; }'+delimiter
+
+    script += 'start=$(now)'+delimiter
+    script += 'for i in $(seq 1 '+str(streams)+'); do dd if=/dev/zero of='+work+'/seq_$i bs=1M count='+str(size_mb)+' conv=fdatasync status=none & done; wait'+delimiter
+    script += 'report sequential_write $start $(now) '+str(total_mb)+delimiter
+
+    script += 'sync; echo 3 | sudo tee /proc/sys/vm/drop_caches > /dev/null'+delimiter
+    script += 'start=$(now)'+delimiter
+    script += 'for i in $(seq 1 '+str(streams)+'); do dd if='+work+'/seq_$i of=/dev/null bs=1M status=none & done; wait'+delimiter
+    script += 'report sequential_read $start $(now) '+str(total_mb)+delimiter
+    script += 'rm -f '+work+'/seq_*'+delimiter
+
+    script += 'mkdir -p '+work+'/meta'+delimiter
+    script += 'start=$(now)'+delimiter
+    script += 'for i in $(seq 1 '+str(n_files)+'); do echo $i > '+work+'/meta/f_$i; done'+delimiter
+    script += 'report file_create $start $(now) '+str(n_files)+delimiter
+    script += 'sync; echo 3 | sudo tee /proc/sys/vm/drop_caches > /dev/null'+delimiter
+    script += 'start=$(now)'+delimiter
+    script += 'ls -l '+work+'/meta > /dev/null'+delimiter
+    script += 'report file_stat $start $(now) '+str(n_files)+delimiter
+    script += 'start=$(now)'+delimiter
+    script += 'rm -rf '+work+'/meta'+delimiter
+    script += 'report file_delete $start $(now) '+str(n_files)+delimiter
+
+    script += 'rmdir '+work+delimiter
+
+    return script
+
+
+def compose_scratch_script(mount_point='/scratch', user='ec2-user', filesystem='xfs', delimiter='\n', script=''):
+    '''
+    Detect the instance-store NVMe drives of the instance, combine them in a RAID0 array if there are several, format them and mount them as scratch space. 
+    Instance-store data is lost when the instance stops or is terminated, use it for temporary files (shuffles, caches, many small files). 
+    If the instance type has no instance-store the mount point is created on the root volume so jobs can always rely on the path. 
+    __________
+    parameters
+    - mount_point : str. directory to mount the scratch space on
+    - user : str. user that owns the mount point
+    - filesystem : str. "xfs" or "ext4"
+    '''
+    mkfs = 'sudo mkfs.xfs -f -K' if filesystem=='xfs' else 'sudo mkfs.'+filesystem+' -F -E nodiscard'
+
+    script += 'if ! mountpoint -q '+mount_point+'; then'+delimiter
+    # Instance-store drives report this model, EBS volumes report "Amazon Elastic Block Store" 
+    script += '  devices=$(lsblk -dpno NAME,MODEL | awk \'/Amazon EC2 NVMe Instance Storage/ {print $1}\')'+delimiter
+    script += '  n=$(echo $devices | wc -w)'+delimiter
+    script += '  sudo mkdir -p '+mount_point+delimiter
+    script += '  if [ $n -eq 0 ]; then'+delimiter
+    script += '    echo "No instance-store NVMe found, '+mount_point+' is on the root volume"'+delimiter
+    script += '  else'+delimiter
+    script += '    if [ $n -gt 1 ]; then'+delimiter
+    script += '      sudo mdadm --create /dev/md/spot_connect_scratch --level=0 --raid-devices=$n $devices --run'+delimiter
+    script += '      device=/dev/md/spot_connect_scratch'+delimiter
+    script += '    else'+delimiter
+    script += '      device=$devices'+delimiter
+    script += '    fi'+delimiter
+    script += '    '+mkfs+' $device > /dev/null'+delimiter
+    script += '    sudo mount -o noatime $device '+mount_point+delimiter
+    script += '    echo "Mounted $n instance-store NVMe drive(s) on '+mount_point+'"'+delimiter
+    script += '  fi'+delimiter
+    script += '  sudo chown '+user+' '+mount_point+delimiter
+    script += 'fi'+delimiter
+
+    return script
+
+
+def compose_ebs_mount_script(device, mount_point, user='ec2-user', prewarm=False, filesystem='xfs', timeout=300, delimiter='\n', script=''):
+    '''
+    Mount an EBS volume attached under the given device name (see ec2_methods.snapshot_volume_mappings). Volumes restored from a snapshot keep their file system, empty volumes are formatted. 
+    On nitro instances the volume shows up as an NVMe drive, it is found from the device name stored by AWS in the drive's vendor data (this needs nvme-cli). 
+    Blocks of a volume restored from a snapshot are loaded from S3 the first time they are read, a pre-warm pass reads the whole volume once in the background so the job does not pay that latency. 
+    The file /tmp/spot_connect_prewarm_<device name>.done is created when the pre-warm pass is complete. 
+    __________
+    parameters
+    - device : str. device name the volume was attached under (e.g. "/dev/sdf")
+    - mount_point : str. directory to mount the volume on
+    - user : str. user that owns the mount point
+    - prewarm : bool. if True, read the whole volume in the background
+    - filesystem : str. file system used to format empty volumes
+    - timeout : int. maximum number of seconds to wait for the volume to show up
+    '''
+    name = device.replace('/dev/', '')
+
+    script += 'find_ebs_device() {'+delimiter
+    script += '  for d in /dev/'+name+' /dev/xvd'+name[-1]+'; do if [ -b $d ]; then readlink -f $d; return; fi; done'+delimiter
+    script += '  for d in /dev/nvme*n1; do'+delimiter
+    script += '    n=$(sudo nvme id-ctrl --raw-binary $d 2>/dev/null | dd bs=1 skip=3072 count=32 2>/dev/null | tr -d " \\000")'+delimiter
+    script += '    if [ "$n" = "'+name+'" ] || [ "$n" = "/dev/'+name+'" ]; then echo $d; return; fi'+delimiter
+    script += '  done'+delimiter
+    script += '}'+delimiter
+    script += 'device=""'+delimiter
+    script += 'for i in $(seq 1 '+str(int(timeout/5))+'); do device=$(find_ebs_device); if [ -n "$device" ]; then break; fi; sleep 5; done'+delimiter
+    script += 'if [ -z "$device" ]; then'+delimiter
+    script += '  echo "EBS volume '+device+' was not found"'+delimiter
+    script += 'elif ! mountpoint -q '+mount_point+'; then'+delimiter
+    # Snapshots of root volumes have a partition table, mount their first partition 
+    script += '  partition=$(lsblk -lnpo NAME,TYPE $device | awk \'$2=="part" {print $1; exit}\')'+delimiter
+    script += '  target=${partition:-$device}'+delimiter
+    script += '  if [ -z "$(sudo blkid -o value -s TYPE $target)" ]; then sudo mkfs.'+filesystem+' $target > /dev/null; fi'+delimiter
+    script += '  sudo mkdir -p '+mount_point+delimiter
+    script += '  sudo mount -o noatime $target '+mount_point+delimiter
+    script += '  sudo chown '+user+' '+mount_point+delimiter
+    script += '  echo "Mounted EBS volume '+device+' on '+mount_point+'"'+delimiter
+    if prewarm: 
+        done_file = '/tmp/spot_connect_prewarm_'+name+'.done'
+        script += '  if command -v fio > /dev/null; then prewarm="sudo fio --filename=$device --rw=read --bs=1M --iodepth=32 --ioengine=libaio --direct=1 --name=prewarm"; else prewarm="sudo dd if=$device of=/dev/null bs=1M iflag=direct"; fi'+delimiter
+        # The pre-warm pass must not inherit the lock of compose_storage_script, otherwise later runs wait until the whole volume was read 
+        script += '  nohup sh -c "$prewarm && touch '+done_file+'" > /dev/null 2>&1 9>&- &'+delimiter
+    script += 'fi'+delimiter
+
+    return script
+
+
+def compose_storage_script(scratch=None, volumes=None, user='ec2-user', delimiter='\n', script=''):
+    '''
+    Set up the scratch space and EBS volumes of an instance (see compose_scratch_script and compose_ebs_mount_script). 
+    The script can run both as user data and over SSH: a lock makes a second run wait for the first one and mounted paths are left as they are. 
+    __________
+    parameters
+    - scratch : str. mount point of the instance-store scratch space, no scratch space if None
+    - volumes : list of dict. EBS volumes with their "device", "mount_point" and "prewarm" settings
+    - user : str. user that owns the mount points
+    '''
+    script += 'sudo mkdir -p /var/lib/spot_connect'+delimiter
+    script += '('+delimiter
+    script += 'flock 9'+delimiter
+    if scratch is not None: 
+        script = compose_scratch_script(mount_point=scratch, user=user, delimiter=delimiter, script=script)
+    for volume in (volumes or []): 
+        script = compose_ebs_mount_script(volume['device'], volume['mount_point'], user=user, prewarm=volume.get('prewarm', False), delimiter=delimiter, script=script)
+    script += ') 9</var/lib/spot_connect'+delimiter
+
+    return script
+
+
+def add_script_to_userdata(user_data, script):
+    '''Add a script at the start of base64 encoded user data (after its "#!" line), or return the script as user data if there is none'''
+    if user_data is None: 
+        return script_to_userdata(init_userdata_script()+script)
+    existing = base64.b64decode(user_data).decode('utf-8')
+    if existing.startswith('#!'): 
+        shebang, _, rest = existing.partition('\n')
+        return script_to_userdata(shebang+'\n'+script+rest)
+    return script_to_userdata(init_userdata_script()+script+existing)
+
+
+def compose_pool_runner_script(workload_file, function, output_dir, runner_path='pool_runner.py', processes=None, memory_per_task=None, chunksize=None, path=None, python='python3', delimiter='\n', script=''):
+    '''
+    Run a workload shard on every core of the instance with the spot_connect pool_runner (the pool_runner.py file must be uploaded to the instance). 
+    __________
+    parameters
+    - workload_file : str. path on the instance to the pickled workload shard (see sutils.split_workloads)
+    - function : str. function to apply to each item, as "module:function" importable on the instance 
+    - output_dir : str. directory on the instance for the per-worker results and manifest.json 
+    - runner_path : str. path on the instance to pool_runner.py 
+    - processes : int. number of processes, defaults to the instance's logical CPUs 
+    - memory_per_task : float. estimated memory per process in MB, caps the number of processes to avoid running out of memory 
+    - chunksize : int. number of items handed to an idle process at once (1 by default) 
+    - path : str. directory on the instance added to the python path to import the function's module 
+    - python : str. python executable on the instance 
+    '''
+    script += python+' '+runner_path+' '+workload_file+' '+function+' '+output_dir
+    if processes is not None: 
+        script += ' --processes '+str(processes)
+    if memory_per_task is not None: 
+        script += ' --memory-per-task '+str(memory_per_task)
+    if chunksize is not None: 
+        script += ' --chunksize '+str(chunksize)
+    if path is not None: 
+        script += ' --path '+path
+    script += delimiter
+
+    return script
+
+
+def compose_tree_reduce_script(directory, combiner, output, reducer_path='tree_reduce.py', rank=None, world_size=1, run_id=None, pattern='*.pickle', fan_in=2, timeout=3600, path=None, python='python3', delimiter='\n', script=''):
+    '''
+    Reduce the partial results in a directory with the spot_connect tree_reduce script (the tree_reduce.py file must be uploaded to the instance).
+    With a rank, the instance takes part in a hierarchical reduction over a shared directory (EFS) with the other `world_size` ranks.
+    __________
+    parameters
+    - directory : str. directory on the instance (or EFS) with the partial results
+    - combiner : str. function merging two partial results, as "module:function" importable on the instance
+    - output : str. path on the instance for the final result (only written by rank 0)
+    - reducer_path : str. path on the instance to tree_reduce.py
+    - rank : int. rank of the instance in the reduction, if None the whole directory is reduced by this instance
+    - world_size : int. number of instances taking part in the reduction
+    - run_id : str. identifier of the reduction, required with a rank. It must be the same for every rank and unique to each run so partials left by an earlier run are not read
+    - pattern : str. glob pattern of the partial result files, relative to the directory
+    - fan_in : int. number of partials merged together at each level
+    - timeout : int. maximum number of seconds to wait for the partials of other ranks
+    - path : str. directory on the instance added to the python path to import the combiner's module
+    - python : str. python executable on the instance
+    '''
+    script += python+' '+reducer_path+' '+directory+' '+combiner+' '+output+' --pattern "'+pattern+'" --fan-in '+str(fan_in)+' --timeout '+str(timeout)
+    if rank is not None:
+        if run_id is None:
+            raise Exception('A run_id shared by every rank is required for a distributed reduction')
+        script += ' --rank '+str(rank)+' --world-size '+str(world_size)+' --run-id '+str(run_id)
+    if path is not None:
+        script += ' --path '+path
+    script += delimiter
+
+    return script
+
+
 def shutdown_instance_after_command(command:str, command_log='', run_as_user='', delimiter='\n', script=''):
     '''
     Run a command and shut down the instance after the command has completed running (use this to run a python script, for example).
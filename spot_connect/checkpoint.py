@@ -0,0 +1,352 @@
+"""
+Author: Carlos Valcarcel <carlos.d.valcarcel.w@gmail.com>
+
+This file is part of spot-connect
+
+Checkpoint streaming - checkpoint.py:
+
+The checkpoint sub-module runs on the instance and keeps a durable copy of a
+job's checkpoint directory on the EFS (see bash_scripts.compose_mount_script)
+or on S3 while the job runs. A background thread copies new or changed files
+incrementally: files are split in fixed size chunks and only the chunks whose
+hash changed are written, at a bounded bandwidth so the copy does not compete
+with the job. `flush` copies everything immediately and without the bandwidth
+limit, register it as an interruption hook:
+
+    streamer = CheckpointStreamer('checkpoints', '/home/ec2-user/efs/run_1').start()
+    handler = interruption.InterruptionHandler().start()
+    handler.register(streamer.flush, priority=100)
+
+Use restore_checkpoint to copy a checkpoint back before resuming a job. The
+streamer can also be run from the command line:
+
+    python -m spot_connect.checkpoint <source> <destination> [--interval S] [--max-bandwidth MB]
+
+MIT License 2020
+"""
+
+import os, sys, json, time, hashlib, argparse, threading
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+MANIFEST = '.spot_connect_checkpoint.json'
+
+
+class DirectoryStore:
+    '''
+    Checkpoint destination on a file system (e.g. the EFS mount). Like the S3Store, chunks are stored once under <path>/.chunks/<hash> and each file is
+    described by its list of chunks in the manifest, so only the chunks that changed are written and a file is swapped to its new version when the manifest
+    is saved, an interruption never leaves a half written checkpoint behind. Use restore_checkpoint to rebuild the files.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.chunk_dir = os.path.join(path, '.chunks')
+        os.makedirs(self.chunk_dir, exist_ok=True)
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        tmp = os.path.join(self.path, MANIFEST+'.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+        # Chunks of the previous versions are not referenced anymore once the new manifest is in place
+        used = set(digest for entry in manifest.values() for digest in entry['chunks'])
+        for name in os.listdir(self.chunk_dir):
+            if name not in used:
+                try:
+                    os.remove(os.path.join(self.chunk_dir, name))
+                except OSError:
+                    pass
+
+    def write_file(self, relpath, size, chunks, read_chunk, throttle):
+        '''Write the chunks that changed (chunks is a list of (index, offset, hash), read_chunk(offset) returns the data of a chunk) and are not stored yet'''
+        for index, offset, digest in chunks:
+            dest = os.path.join(self.chunk_dir, digest)
+            if os.path.exists(dest):
+                continue
+            data = read_chunk(offset)
+            throttle(len(data))
+            tmp = dest+'.tmp'
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, dest)
+            except BaseException:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+
+    def remove_file(self, relpath, chunks):
+        # Chunks can be shared between files, the unused ones are removed when the manifest is saved
+        pass
+
+    def restore_file(self, relpath, entry, dest):
+        with open(dest, 'wb') as out:
+            for digest in entry['chunks']:
+                with open(os.path.join(self.chunk_dir, digest), 'rb') as src:
+                    out.write(src.read())
+
+
+class S3Store:
+    '''Checkpoint destination on S3. Chunks are stored once under <prefix>/.chunks/<hash> and each file is described by its list of chunks in the manifest'''
+
+    def __init__(self, url, region=None):
+        if boto3 is None:
+            raise Exception('boto3 is required to stream checkpoints to S3')
+        self.bucket, _, self.prefix = url[len('s3://'):].partition('/')
+        self.prefix = self.prefix.strip('/')
+        self.client = boto3.client('s3', region_name=region)
+        self.chunks = set()
+
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key('.chunks/')):
+            for obj in page.get('Contents', []):
+                self.chunks.add(obj['Key'].rsplit('/', 1)[-1])
+
+    def key(self, name):
+        return name if self.prefix=='' else self.prefix+'/'+name
+
+    def load_manifest(self):
+        try:
+            return json.loads(self.client.get_object(Bucket=self.bucket, Key=self.key(MANIFEST))['Body'].read())
+        except self.client.exceptions.NoSuchKey:
+            return {}
+
+    def save_manifest(self, manifest):
+        self.client.put_object(Bucket=self.bucket, Key=self.key(MANIFEST), Body=json.dumps(manifest).encode())
+
+    def write_file(self, relpath, size, chunks, read_chunk, throttle):
+        for index, offset, digest in chunks:
+            if digest in self.chunks:
+                continue
+            data = read_chunk(offset)
+            throttle(len(data))
+            self.client.put_object(Bucket=self.bucket, Key=self.key('.chunks/'+digest), Body=data)
+            self.chunks.add(digest)
+
+    def remove_file(self, relpath, chunks):
+        # Chunks can be shared between files and versions, they are left in place
+        pass
+
+    def restore_file(self, relpath, entry, dest):
+        with open(dest, 'wb') as out:
+            for digest in entry['chunks']:
+                out.write(self.client.get_object(Bucket=self.bucket, Key=self.key('.chunks/'+digest))['Body'].read())
+
+
+def open_store(destination, region=None):
+    '''Return the store for an "s3://bucket/prefix" URL or a directory path'''
+    if destination.startswith('s3://'):
+        return S3Store(destination, region=region)
+    return DirectoryStore(destination)
+
+
+class CheckpointStreamer:
+
+    source          =   None
+    destination     =   None
+    interval        =   None
+    chunk_size      =   None
+    max_bandwidth   =   None
+    manifest        =   None
+
+    def __init__(self, source, destination, interval=30, chunk_size=8*1024*1024, max_bandwidth=None, region=None, verbose=False):
+        '''
+        Copy the files of a checkpoint directory to the EFS or S3 in a background thread as they are created or changed.
+        A file is only copied once its size and modification time have stayed the same for one scan (so files being written are not copied half way), except when flushing.
+        Only the chunks of a file whose sha256 changed since the last copy are written. The manifest of the copied files and their chunk hashes is saved at the
+        destination, so a streamer restarted on a new instance does not copy unchanged files again.
+        __________
+        parameters
+        - source : str. local checkpoint directory
+        - destination : str. directory (e.g. on the EFS mount) or "s3://bucket/prefix" URL to copy the checkpoints to
+        - interval : float. number of seconds between scans of the checkpoint directory
+        - chunk_size : int. size in bytes of the chunks compared between copies
+        - max_bandwidth : float. maximum number of bytes per second written by the background thread, unlimited if None
+        - region : str. region of the S3 bucket
+        - verbose : bool. if True, print each copied file
+        '''
+        self.source = source
+        self.destination = destination
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.max_bandwidth = max_bandwidth
+        self.verbose = verbose
+        self.store = open_store(destination, region=region)
+        self.manifest = self.store.load_manifest()
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.unthrottled = threading.Event()
+        self.thread = None
+        self.sent = 0
+        self.window_start = time.time()
+        self.stats = {'files': 0, 'bytes': 0, 'chunks_skipped': 0, 'scans': 0}
+
+    def throttle(self, nbytes):
+        '''Sleep as needed to keep the copy under the bandwidth limit (ignored while flushing)'''
+        self.stats['bytes'] += nbytes
+        if self.max_bandwidth is None or self.unthrottled.is_set():
+            return
+        self.sent += nbytes
+        elapsed = time.time()-self.window_start
+        wait = self.sent/self.max_bandwidth-elapsed
+        if wait>0:
+            time.sleep(wait)
+        if elapsed>10:
+            # Restart the window so idle periods do not build up a burst allowance
+            self.sent = 0
+            self.window_start = time.time()
+
+    def hash_chunks(self, path):
+        digests = []
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                digests.append(hashlib.sha256(data).hexdigest())
+        return digests
+
+    def sync_file(self, relpath, stat):
+        path = os.path.join(self.source, relpath)
+        digests = self.hash_chunks(path)
+        previous = self.manifest.get(relpath, {}).get('chunks', [])
+
+        changed = [(i, i*self.chunk_size, d) for i, d in enumerate(digests) if i>=len(previous) or previous[i]!=d]
+        self.stats['chunks_skipped'] += len(digests)-len(changed)
+
+        with open(path, 'rb') as f:
+            def read_chunk(offset):
+                f.seek(offset)
+                return f.read(self.chunk_size)
+            self.store.write_file(relpath, stat.st_size, changed, read_chunk, self.throttle)
+
+        self.manifest[relpath] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'chunks': digests}
+        self.stats['files'] += 1
+        if self.verbose:
+            print('Copied '+relpath+' ('+str(len(changed))+'/'+str(len(digests))+' chunks)', flush=True)
+
+    def scan(self, force=False):
+        '''Copy the new and changed files once. With force=True files are copied even if they changed since the last scan'''
+        with self.lock:
+            self.stats['scans'] += 1
+            current = {}
+            for root, dirs, files in os.walk(self.source):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    current[os.path.relpath(path, self.source)] = stat
+
+            updated = False
+            for relpath, stat in current.items():
+                entry = self.manifest.get(relpath)
+                if entry is not None and entry['size']==stat.st_size and entry['mtime']==stat.st_mtime:
+                    continue
+                # Wait for the file to stop changing before copying it
+                stable = self.seen.get(relpath)==(stat.st_size, stat.st_mtime)
+                self.seen[relpath] = (stat.st_size, stat.st_mtime)
+                if stable or force:
+                    try:
+                        self.sync_file(relpath, stat)
+                        updated = True
+                    except (IOError, OSError) as e:
+                        print('Could not copy checkpoint '+relpath+': '+str(e), file=sys.stderr, flush=True)
+
+            for relpath in [r for r in self.manifest if r not in current]:
+                self.store.remove_file(relpath, self.manifest.pop(relpath)['chunks'])
+                updated = True
+
+            if updated:
+                self.store.save_manifest(self.manifest)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                print('Checkpoint streaming failed: '+str(e), file=sys.stderr, flush=True)
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        '''Start copying in a daemon thread'''
+        if self.thread is None or not self.thread.is_alive():
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def flush(self):
+        '''Copy every new or changed file now without the bandwidth limit, wait for it to finish and return the stats. Use it as an interruption hook'''
+        self.unthrottled.set()
+        try:
+            self.scan(force=True)
+        finally:
+            self.unthrottled.clear()
+        return self.stats
+
+    def stop(self, flush=True):
+        '''Stop the background thread, flushing the checkpoints first by default'''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if flush:
+            self.flush()
+
+
+def restore_checkpoint(destination, local_dir, region=None):
+    '''
+    Copy a checkpoint saved by a CheckpointStreamer back to a local directory (e.g. before resuming an interrupted job). Returns the list of restored files.
+    __________
+    parameters
+    - destination : str. directory or "s3://bucket/prefix" URL the checkpoints were streamed to
+    - local_dir : str. local directory to restore the checkpoint in
+    - region : str. region of the S3 bucket
+    '''
+    store = open_store(destination, region=region)
+    manifest = store.load_manifest()
+
+    for relpath, entry in manifest.items():
+        dest = os.path.join(local_dir, relpath)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        store.restore_file(relpath, entry, dest)
+        os.utime(dest, (entry['mtime'], entry['mtime']))
+
+    return list(manifest)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stream a checkpoint directory to the EFS or S3')
+    parser.add_argument('source', help='local checkpoint directory')
+    parser.add_argument('destination', help='directory or s3://bucket/prefix to copy the checkpoints to')
+    parser.add_argument('--interval', type=float, default=30, help='seconds between scans')
+    parser.add_argument('--max-bandwidth', type=float, default=None, help='maximum upload rate in MB/s')
+    parser.add_argument('--region', default=None, help='region of the S3 bucket')
+    args = parser.parse_args()
+
+    max_bandwidth = None if args.max_bandwidth is None else args.max_bandwidth*1024*1024
+    streamer = CheckpointStreamer(args.source, args.destination, interval=args.interval, max_bandwidth=max_bandwidth, region=args.region, verbose=True)
+    try:
+        streamer.run()
+    except KeyboardInterrupt:
+        streamer.flush()
@@ -11,12 +11,240 @@ spot instances or making and manging spot-fleet requests.
 MIT License 2020
 """
 
-import boto3, paramiko, time, sys, os
+import boto3, paramiko, time, sys, os, hashlib
 from path import Path
 
 root = Path(os.path.dirname(os.path.abspath(__file__)))
 
-from spot_connect import iam_methods
+from spot_connect import iam_methods, sutils, bash_scripts
+
+
+def launch_template_key(profile, key_pair, security_group, instance_profile='', user_data=None, monitoring=True, block_device_mappings=None):
+    '''
+    Return the cache key for the launch template matching the given settings.
+    The key only depends on names (not AWS ids) so a cached template can be found before the key pair and security group checks.
+    __________
+    parameters
+    - profile : dict. profile with the "region", "image_id" and "instance_type" settings
+    - key_pair : str. name of the key pair
+    - security_group : str. name of the security group
+    - instance_profile : str. instance profile with attached IAM roles
+    - user_data : str. base64 encoded user data submitted with the template
+    - monitoring : bool. whether monitoring is enabled for the instances
+    - block_device_mappings : list of dict. EBS volumes attached to the instances (see snapshot_volume_mappings)
+    '''
+    if user_data is None:
+        user_data_hash = ''
+    else:
+        user_data_hash = hashlib.sha256(user_data.encode('utf-8')).hexdigest()
+
+    settings = (profile['region'], profile['image_id'], profile['instance_type'], key_pair, security_group, instance_profile, bool(monitoring), user_data_hash)
+    if block_device_mappings is not None:
+        settings += (repr(block_device_mappings),)
+
+    return hashlib.sha256(repr(settings).encode('utf-8')).hexdigest()[:24]
+
+
+def get_cached_launch_template(profile, key_pair, security_group, instance_profile='', user_data=None, monitoring=True, block_device_mappings=None, client=None):
+    '''
+    Return the cached launch template entry for the given settings or None if no template has been cached yet.
+    The key is built from the security group name, if a client is submitted the cached security group ID is checked and the entry is dropped
+    when the group no longer exists (deleted and created again under the same name).
+    '''
+    key = launch_template_key(profile, key_pair, security_group, instance_profile=instance_profile, user_data=user_data, monitoring=monitoring, block_device_mappings=block_device_mappings)
+    template = sutils.load_launch_templates().get(key)
+
+    if template is not None and client is not None:
+        try:
+            client.describe_security_groups(GroupIds=[template['security_group'][0]])
+        except Exception as e:
+            if 'InvalidGroup' not in str(e):
+                raise e
+            print('Cached security group '+template['security_group'][0]+' no longer exists, dropping the cached launch template...')
+            forget_launch_template(key)
+            return None
+
+    return template
+
+
+def forget_launch_template(key):
+    '''Remove a launch template from the local cache (the template itself is left on AWS)'''
+    sutils.update_launch_templates(key, None)
+
+
+def get_launch_template(client, profile, instance_profile='', user_data=None, monitoring=True, refresh=False, block_device_mappings=None):
+    '''
+    Create or retrieve the EC2 launch template for the given profile and return its cache entry.
+    Templates are cached locally in "launch_templates.txt" so repeated launches reference them by ID without rebuilding the launch specification.
+    The cache is validated lazily: callers should use `forget_launch_template` and `refresh=True` if AWS reports the template as missing.
+    __________
+    parameters
+    - client : boto3 ec2 client for the profile's region
+    - profile : dict. profile with the "key_pair" and "security_group" settings filled out
+    - instance_profile : str. instance profile with attached IAM roles
+    - user_data : str. base64 encoded user data
+    - monitoring : bool. enable monitoring on the instances
+    - refresh : bool. if True, ignore the cached entry and look the template up on AWS again
+    - block_device_mappings : list of dict. EBS volumes attached to the instances (see snapshot_volume_mappings)
+    '''
+    key = launch_template_key(profile, profile['key_pair'][0], profile['security_group'][1], instance_profile=instance_profile, user_data=user_data, monitoring=monitoring, block_device_mappings=block_device_mappings)
+
+    # The key is built from names, an entry that was cached with another security group ID (or key pair) is stale
+    cached = sutils.load_launch_templates().get(key)
+    if cached is not None and not refresh and cached['security_group']==tuple(profile['security_group']) and cached['key_pair']==tuple(profile['key_pair']):
+        return cached
+
+    template_data = {
+        'SecurityGroupIds': [
+            profile['security_group'][0],
+        ],
+        'EbsOptimized': False,                                                 # do not optimize for EBS storage
+        'ImageId': profile['image_id'],                                        # AWS image ID. List available programatically or through launch wizard
+        'InstanceType': profile['instance_type'],                              # Instance type. List available programatically or through wizard or at https://aws.amazon.com/ec2/spot/pricing/
+        'KeyName': profile['key_pair'][0],                                     # Name for the key pair
+        'Monitoring': {'Enabled': monitoring},                                 # Enable monitoring
+    }
+    if instance_profile!='':
+        template_data['IamInstanceProfile'] = {                                # Define the IAM role for your instance
+            'Name': instance_profile,
+        }
+    if user_data is not None:
+        template_data['UserData'] = user_data
+    if block_device_mappings is not None:
+        template_data['BlockDeviceMappings'] = block_device_mappings
+
+    # The template name is derived from the key so identical settings always map to the same template
+    template_name = 'spot-connect-'+key
+
+    try:
+        template = client.create_launch_template(LaunchTemplateName=template_name, LaunchTemplateData=template_data)['LaunchTemplate']
+        print('Launch template '+template_name+' created...')
+    except Exception as e:
+        if 'AlreadyExists' in str(e):
+            template = client.describe_launch_templates(LaunchTemplateNames=[template_name])['LaunchTemplates'][0]
+            latest = client.describe_launch_template_versions(LaunchTemplateName=template_name, Versions=['$Latest'])['LaunchTemplateVersions'][0]
+            # The security group was created again under the same name, point the template to the new group ID with a new version
+            if latest['LaunchTemplateData'].get('SecurityGroupIds')!=template_data['SecurityGroupIds']:
+                version = client.create_launch_template_version(LaunchTemplateName=template_name, LaunchTemplateData=template_data)['LaunchTemplateVersion']
+                template['LatestVersionNumber'] = version['VersionNumber']
+                print('Launch template detected, created version '+str(version['VersionNumber'])+' for security group '+profile['security_group'][0]+'...')
+            else:
+                print('Launch template detected, re-using...')
+        else:
+            raise e
+
+    entry = {
+        'LaunchTemplateId': template['LaunchTemplateId'],
+        'LaunchTemplateName': template_name,
+        'Version': str(template['LatestVersionNumber']),
+        'region': profile['region'],
+        'key_pair': tuple(profile['key_pair']),
+        'security_group': tuple(profile['security_group']),
+        'key': key,
+    }
+    sutils.update_launch_templates(key, entry)
+
+    return entry
+
+
+def snapshot_volume_mappings(volumes):
+    '''
+    Return the block device mappings attaching the given EBS volumes at launch and the volume settings with their device names filled in. 
+    Each volume is a dict with: 
+        > mount_point : directory to mount the volume on 
+        > snapshot_id : snapshot to restore the volume from, an empty volume is created if missing 
+        > size : size in GiB, defaults to the size of the snapshot (required without a snapshot) 
+        > volume_type : "gp3" by default, with optional "iops" and "throughput" (MiB/s) 
+        > device : device name, assigned from /dev/sdf onward if missing 
+        > prewarm : if True, the volume is read once in the background after it is mounted 
+        > fast_restore : if True, fast snapshot restore is enabled for the snapshot in the instance's availability zone (which must be submitted) and the launch waits until it is enabled, 
+                         so the volume is restored at full performance. It is billed until it is disabled with disable_fast_snapshot_restore 
+        > delete_on_termination : True by default 
+    '''
+    mappings, filled = [], []
+    used = set(volume['device'] for volume in volumes if 'device' in volume)
+    letters = iter([l for l in 'fghijklmnop' if '/dev/sd'+l not in used])
+
+    for volume in volumes:
+        volume = dict(volume)
+        if 'mount_point' not in volume:
+            raise Exception('EBS volumes need a "mount_point"')
+        if 'snapshot_id' not in volume and 'size' not in volume:
+            raise Exception('EBS volumes need a "snapshot_id" or a "size"')
+        if 'device' not in volume:
+            volume['device'] = '/dev/sd'+next(letters)
+
+        ebs = {'VolumeType': volume.get('volume_type', 'gp3'), 'DeleteOnTermination': volume.get('delete_on_termination', True)}
+        for key, name in (('snapshot_id', 'SnapshotId'), ('size', 'VolumeSize'), ('iops', 'Iops'), ('throughput', 'Throughput')):
+            if key in volume:
+                ebs[name] = volume[key]
+
+        mappings.append({'DeviceName': volume['device'], 'Ebs': ebs})
+        filled.append(volume)
+
+    return mappings, filled
+
+
+def enable_fast_snapshot_restore(client, snapshot_ids, availability_zones, wait=True, poll_interval=30):
+    '''
+    Enable fast snapshot restore for the snapshots in the availability zones, so volumes created from them do not load their blocks from S3 on first read. 
+    Fast snapshot restore is billed per snapshot and availability zone while it is enabled, disable it with disable_fast_snapshot_restore when it is not needed anymore. 
+    Enabling it takes about an hour per TiB, volumes created before it is enabled are restored normally. 
+    __________
+    parameters
+    - client : boto3 ec2 client for the snapshots' region
+    - snapshot_ids : list of str. snapshots to enable fast snapshot restore for
+    - availability_zones : list of str. availability zones the volumes will be created in
+    - wait : bool. if True, wait until fast snapshot restore is enabled
+    - poll_interval : int. number of seconds between checks while waiting
+    '''
+    response = client.enable_fast_snapshot_restores(AvailabilityZones=availability_zones, SourceSnapshotIds=snapshot_ids)
+    for error in response.get('Unsuccessful', []):
+        print('Could not enable fast snapshot restore for '+error['SnapshotId']+': '+str(error['FastSnapshotRestoreStateErrors']))
+
+    if wait:
+        sys.stdout.write('Waiting for fast snapshot restore...')
+        sys.stdout.flush()
+        while True:
+            states = client.describe_fast_snapshot_restores(Filters=[{'Name':'snapshot-id', 'Values':snapshot_ids}, 
+                                                                     {'Name':'availability-zone', 'Values':availability_zones}])['FastSnapshotRestores']
+            if len(states)>=len(snapshot_ids)*len(availability_zones) and all(state['State']=='enabled' for state in states):
+                break
+            sys.stdout.write('.')
+            sys.stdout.flush()
+            time.sleep(poll_interval)
+        print('Enabled')
+
+
+def disable_fast_snapshot_restore(client, snapshot_ids, availability_zones):
+    '''Disable fast snapshot restore for the snapshots in the availability zones (e.g. once the instances using them were launched) so it is not billed anymore'''
+    response = client.disable_fast_snapshot_restores(AvailabilityZones=availability_zones, SourceSnapshotIds=snapshot_ids)
+    for error in response.get('Unsuccessful', []):
+        print('Could not disable fast snapshot restore for '+error['SnapshotId']+': '+str(error['FastSnapshotRestoreStateErrors']))
+
+
+def storage_launch_settings(client, profile, scratch=None, volumes=None, availability_zone=None, user_data=None):
+    '''
+    Return the block device mappings and the user data that set up the instance-store scratch space and EBS volumes when an instance boots, and the volume settings (see snapshot_volume_mappings). 
+    The storage script is added at the start of the given user data. Fast snapshot restore is enabled for the volumes that ask for it in the availability zone the instances are launched in, 
+    and the call waits until it is enabled so the volumes benefit from it. Disable it with disable_fast_snapshot_restore once it is not needed. 
+    '''
+    if scratch is None and not volumes:
+        return None, user_data, []
+
+    mappings, volumes = snapshot_volume_mappings(volumes or [])
+
+    fast_restore = [volume['snapshot_id'] for volume in volumes if volume.get('fast_restore') and 'snapshot_id' in volume]
+    if len(fast_restore)>0:
+        if availability_zone is None:
+            raise Exception('Fast snapshot restore is billed per availability zone, submit the availability_zone the instances are launched in')
+        enable_fast_snapshot_restore(client, fast_restore, [availability_zone], wait=True)
+        print('Fast snapshot restore stays enabled (and billed) for '+', '.join(fast_restore)+' in '+availability_zone+', disable it with ec2_methods.disable_fast_snapshot_restore')
+
+    script = bash_scripts.compose_storage_script(scratch=scratch, volumes=volumes, user=profile['username'])
+
+    return (mappings if len(mappings)>0 else None), bash_scripts.add_script_to_userdata(user_data, script), volumes
+
 
 def get_spot_instance(spotid,
                       profile, 
@@ -27,9 +255,16 @@ def get_spot_instance(spotid,
                       kp_dir=None, 
                       enable_nfs=True, 
                       enable_ds=True,
-                      using_instance_id=False):
+                      using_instance_id=False,
+                      launch_backend='spot_request',
+                      scratch=None,
+                      volumes=None,
+                      availability_zone=None,
+                      verbose=True,
+                      return_timings=False):
     '''
     Launch a spot instance or connect to an existing one using the preconfigured aws account on boto3. Returns instance ID and profile (if the returned profile has the "key_pair" and "security_group" params filled out if they were empty) 
+    and the time taken by each startup step (see sutils.run_pipeline) if return_timings is True. 
     __________
     parameters 
     - spotid : name for the spot instance's launch group. Try and keep launch groups unique to active instances.  
@@ -45,48 +280,100 @@ def get_spot_instance(spotid,
     - enable_nfs : bool, default True. When true, add NFS ingress rules to security group (TCP access from port 2049)
     - enable_ds : bool, default True. When true, add HTTP ingress rules to security group (TCP access from port 80)
     - instance_id : bool, default False. if True, spotid will be treated as the instance ID instead of the launch-group
+    - launch_backend : str, default "spot_request". Use "fleet" to launch through an instant EC2 Fleet which returns the instance ID in a single call. Falls back to "spot_request" if the fleet cannot launch the instance. 
+    - scratch : str. mount point for the instance-store NVMe drives (combined in a RAID0 array if there are several), set up when the instance boots 
+    - volumes : list of dict. EBS volumes, optionally restored from snapshots, attached and mounted when the instance boots, see snapshot_volume_mappings 
+    - availability_zone : str. availability zone to launch the instance in (required for volumes with fast snapshot restore), any zone of the region if None 
+    - verbose : bool. if True, print the time taken by the startup steps 
+    - return_timings : bool. if True, also return the timings of the startup steps ({step: {"start", "end", "seconds"}}) 
     '''
 
+    steps = spot_instance_steps(spotid, profile, instance_profile=instance_profile, monitoring=monitoring, spot_wait_sleep=spot_wait_sleep, instance_wait_sleep=instance_wait_sleep, 
+                                kp_dir=kp_dir, enable_nfs=enable_nfs, enable_ds=enable_ds, using_instance_id=using_instance_id, launch_backend=launch_backend, scratch=scratch, 
+                                volumes=volumes, availability_zone=availability_zone)
+
+    results, timings = sutils.run_pipeline(steps, verbose=verbose)
+
+    if return_timings: 
+        return results['boot'], profile, timings
+    return results['boot'], profile
+
+
+def spot_instance_steps(spotid,
+                        profile, 
+                        instance_profile='', 
+                        monitoring=True, 
+                        spot_wait_sleep=5, 
+                        instance_wait_sleep=5, 
+                        kp_dir=None, 
+                        enable_nfs=True, 
+                        enable_ds=True,
+                        using_instance_id=False,
+                        launch_backend='spot_request',
+                        scratch=None,
+                        volumes=None,
+                        availability_zone=None):
+    '''
+    Return the steps that launch (or connect to) a spot instance, as a dict for sutils.run_pipeline: the key pair and security group are set up at the same time, 
+    then the instance is launched ("instance" returns its description as soon as it has an ID) and waited for ("boot" returns it once it is running). 
+    Add steps that depend on "instance" or "boot" to overlap more work with the launch, see spotted.SpotInstance. For the parameters see get_spot_instance. 
+    '''
     print('Profile:')
     print(profile)
     print('')    
 
     # Connect to aws ec2 subnet as a client 
     client = boto3.client('ec2', region_name=profile['region'])                
-    
-    #~#~#~#~#~#~#~#~#~#~#
-    #~#~# Key Pairs #~#~#
-    #~#~#~#~#~#~#~#~#~#~#
-    
+
+    # The key pair and security group do not depend on each other and are set up at the same time 
+    steps = {} 
     if not using_instance_id:
-        # If no key_par exists for the current spot instance id
-        if 'key_pair' not in profile:                                               
-            # Log a keypair in the profile dictionary 
-            profile['key_pair']=('KP-'+spotid,'KP-'+spotid+'.pem')                 
-    
-        try: 
-            iam_methods.create_key_pair(client, profile, kp_dir)
-        except Exception as e: 
-            if 'InvalidKeyPair.Duplicate' in str(e): 
-                print('Key pair detected, re-using...')
-            else: 
-                sys.stdout.write("Was not able to find Key-Pair in default directory "+str(kp_dir))
-                sys.stdout.write("\nTo reset default directory run: spot_connect.sutils.set_default_kp_dir(<dir>)")
-                sys.stdout.flush()   
-                raise e 
+        steps['key_pair'] = (lambda results: setup_key_pair(client, spotid, profile, kp_dir=kp_dir), [])
+        steps['security_group'] = (lambda results: setup_security_group(client, spotid, profile, enable_nfs=enable_nfs, enable_ds=enable_ds), [])
+    steps['instance'] = (lambda results: launch_instance(client, spotid, profile, instance_profile=instance_profile, monitoring=monitoring, spot_wait_sleep=spot_wait_sleep, using_instance_id=using_instance_id, 
+                                                         launch_backend=launch_backend, scratch=scratch, volumes=volumes, availability_zone=availability_zone), list(steps))
+    steps['boot'] = (lambda results: wait_for_instance(client, results['instance']['InstanceId'], instance_wait_sleep=instance_wait_sleep), ['instance'])
 
-    #~#~#~#~#~#~#~#~#~#~#~#~#~#
-    #~#~# Security Groups #~#~#
-    #~#~#~#~#~#~#~#~#~#~#~#~#~#
+    return steps 
+
+
+def setup_key_pair(client, spotid, profile, kp_dir=None):
+    '''Create the key pair of the instance (named after the spotid if the profile has none) or re-use it if it already exists'''
+
+    # If no key_par exists for the current spot instance id
+    if 'key_pair' not in profile:                                               
+        # Log a keypair in the profile dictionary 
+        profile['key_pair']=('KP-'+spotid,'KP-'+spotid+'.pem')                 
+
+    try: 
+        iam_methods.create_key_pair(client, profile, kp_dir)
+    except Exception as e: 
+        if 'InvalidKeyPair.Duplicate' in str(e): 
+            print('Key pair detected, re-using...')
+        else: 
+            sys.stdout.write("Was not able to find Key-Pair in default directory "+str(kp_dir))
+            sys.stdout.write("\nTo reset default directory run: spot_connect.sutils.set_default_kp_dir(<dir>)")
+            sys.stdout.flush()   
+            raise e 
+
+
+def setup_security_group(client, spotid, profile, enable_nfs=True, enable_ds=True):
+    '''Create the security group of the instance (named after the spotid) or re-use it, unless the profile already has one'''
+
+    # If no security group was submitted 
+    if 'security_group' not in profile:                                                    
+        # Create and retrieve the security group 
+        sg = iam_methods.get_security_group(client, 'SG-'+spotid, enable_nfs=enable_nfs, enable_ds=enable_ds, firewall_ingress_settings=profile['firewall_ingress'])    
+
+        # For the profile we need a tuple of the security group ID and the security group name. 
+        profile['security_group'] = (sg['GroupId'],'SG-'+spotid)               # Add the security group ID and name to the profile dictionary 
 
-    if not using_instance_id:
-        # If no security group was submitted 
-        if 'security_group' not in profile:                                                    
-            # Create and retrieve the security group 
-            sg = iam_methods.get_security_group(client, 'SG-'+spotid, enable_nfs=enable_nfs, enable_ds=enable_ds, firewall_ingress_settings=profile['firewall_ingress'])    
-    
-            # For the profile we need a tuple of the security group ID and the security group name. 
-            profile['security_group'] = (sg['GroupId'],'SG-'+spotid)               # Add the security group ID and name to the profile dictionary 
+
+def launch_instance(client, spotid, profile, instance_profile='', monitoring=True, spot_wait_sleep=5, using_instance_id=False, launch_backend='spot_request', scratch=None, volumes=None, availability_zone=None):
+    '''
+    Launch the spot instance (or find the existing one) once its key pair and security group are set up, and return its description. 
+    The instance may still be booting but its subnet and availability zone are known, see get_spot_instance for the parameters. 
+    '''
 
     #~#~#~#~#~#~#~#~#~#~#~#~#~#~#
     #~#~# Instance Requests #~#~#
@@ -105,93 +392,27 @@ def get_spot_instance(spotid,
             
     # Otherwise, filter using the instance's launch group 
     else:     
-        spot_requests = client.describe_spot_instance_requests(Filters=[{'Name':'launch-group', 'Values':[spotid]},
-                                                                         {'Name':'state','Values':['open','active']}])['SpotInstanceRequests']
-        
-        # If there are open/active instance requests with the same name (should only be one) re-use the first one that was found 
-        if len(spot_requests)>0:               
-            print('Spot instance found')                                    
-            spot_req_id = spot_requests[0]['SpotInstanceRequestId']                
-        else:
-            # Otherwise request a new one 
-            print('Requesting spot instance')
-    
-            launch_specs = {
-                    'SecurityGroupIds': [
-                        profile['security_group'][0],
-                    ],
-                    'SecurityGroups': [
-                        profile['security_group'][1],
-                    ],
-                    'EbsOptimized': False,                                         # do not optimize for EBS storage 
-                    'ImageId': profile['image_id'],                                # AWS image ID. List available programatically or through launch wizard 
-                    'InstanceType': profile['instance_type'],                      # Instance type. List available programatically or through wizard or at https://aws.amazon.com/ec2/spot/pricing/ 
-                    'KeyName': profile['key_pair'][0],                             # Name for the key pair
-                    'Monitoring' : {'Enabled': monitoring},                        # Enable monitoring
-            }
-            if instance_profile!='':
-                launch_specs['IamInstanceProfile']= {                              # Define the IAM role for your instance 
-                             'Name': instance_profile,                                       
-                }
-    
-            response = client.request_spot_instances(                              
-                AvailabilityZoneGroup=profile['region'],
-                ClientToken=spotid,                                                # submit a name to ensure idempotency 
-                DryRun=False,                                                      # if True, checks if you have permission without actually submitting request
-                InstanceCount=1,                                                   # number of individual instances 
-                LaunchGroup=spotid,
-                LaunchSpecification=launch_specs,
-                SpotPrice=profile['price'],                                        # Must be greater than current instance type price for region, available at https://aws.amazon.com/ec2/spot/pricing/ 
-                Type='one-time',                                                   # Persisitence is usually not necessary (given storage backup) or advisable with spot instances 
-                InstanceInterruptionBehavior='terminate',                          # Instance terminates if typing `shutdown -h now` in the console
-            )
-            spot_req_id = response['SpotInstanceRequests'][0]['SpotInstanceRequestId']
-
-        # Check if the instance id has been created (will only delay if the instance was just created)
-        attempt = 0 
-        instance_id = None
-        spot_tag_added = False
-        
-        # Wait for the instance to initialize, retrieve the request by ID 
-        while not instance_id:  # I know this is unusual cause its not a boolean but it works.                                                     
-            spot_req = client.describe_spot_instance_requests(Filters=[{'Name':'spot-instance-request-id', 'Values':[spot_req_id]}])['SpotInstanceRequests']
-    
-            if len(spot_req)>0:          
-    
-                spot_req = spot_req[0]                                             
-    
-                # If no tag has been added yet add a tag to the request with the spot instance name 
-                if not spot_tag_added:     
-                    client.create_tags(Resources=[spot_req['SpotInstanceRequestId']], Tags=[{'Key':'Name','Value':spotid}])
-                    spot_tag_added=True
-                
-                # If the request failed raise an exception 
-                if spot_req['State']=='failed':                                    
-                    raise Exception('Spot Request Failed')
-    
-                # If an instance ID was returned with the spot request we exit the while loop 
-                if 'InstanceId' in spot_req:                                       
-                    instance_id = spot_req['InstanceId']
-    
-                # Otherwise we continue to wait 
-                else:                                                              
-                    sys.stdout.write(".")
-                    sys.stdout.flush()                                                   
-                    time.sleep(spot_wait_sleep)
-            else:             
-                # If its the first attempt print launching and follow that with a bunch of periods until we're done
-                if attempt==0:
-                    sys.stdout.write('Launching...')
-                    sys.stdout.flush()             
-                
-                # If a new spot request was submitted it may take a moment to register
-                sys.stdout.write(".")
-                sys.stdout.flush()                                                 
-                
-                # Wait and attempt to connect again 
-                time.sleep(spot_wait_sleep)                                        
-    
-                attempt+=1 
+        instance_id = None 
+
+        block_device_mappings, user_data, volumes = storage_launch_settings(client, profile, scratch=scratch, volumes=volumes, availability_zone=availability_zone)
+
+        # The instant fleet backend is skipped if the launch group already has a spot request from the default backend 
+        if launch_backend=='fleet':
+            instance_id = find_named_instance(client, spotid)
+            if instance_id is None: 
+                spot_requests = client.describe_spot_instance_requests(Filters=[{'Name':'launch-group', 'Values':[spotid]},
+                                                                                 {'Name':'state','Values':['open','active']}])['SpotInstanceRequests']
+                if len(spot_requests)==0: 
+                    instance_id = request_fleet_instance(client, spotid, profile, instance_profile=instance_profile, monitoring=monitoring, block_device_mappings=block_device_mappings, user_data=user_data, availability_zone=availability_zone)
+            else: 
+                print('Spot instance found')
+
+        elif launch_backend!='spot_request': 
+            raise Exception('launch_backend must be "spot_request" or "fleet"')
+
+        # Fall back to a regular spot instance request 
+        if instance_id is None: 
+            instance_id = request_spot_instance(client, spotid, profile, instance_profile=instance_profile, monitoring=monitoring, spot_wait_sleep=spot_wait_sleep, block_device_mappings=block_device_mappings, user_data=user_data, availability_zone=availability_zone)
 
     print('Retrieving instance by id')
 
@@ -208,6 +429,12 @@ def get_spot_instance(spotid,
     if str(instance['State']['Name'])=='terminated':
         raise Exception('Desired spot request has been terminated, please choose a new instance name or wait until the terminated spot request has expired in the AWS console')
 
+    return instance
+
+
+def wait_for_instance(client, instance_id, instance_wait_sleep=5):
+    '''Wait until the instance passes its status checks and return its description (with its public IP and DNS)'''
+
     instance_status = check_instance_initialization(instance_id, client=client, instance_wait_sleep=instance_wait_sleep)
 
     if instance_status!='ok':                                                  # Wait until the instance is runing to connect 
@@ -215,7 +442,198 @@ def get_spot_instance(spotid,
 
     print('..Online')
 
-    return instance, profile
+    return client.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]
+
+
+def request_spot_instance(client, spotid, profile, instance_profile='', monitoring=True, spot_wait_sleep=5, block_device_mappings=None, user_data=None, availability_zone=None):
+    '''
+    Submit a spot instance request under the `spotid` launch group (or re-use an open one) and wait until it has been fulfilled. Returns the instance ID. 
+    __________
+    parameters 
+    - client : boto3 ec2 client for the profile's region 
+    - spotid : str. name for the spot instance's launch group
+    - profile : dict. profile with the "key_pair" and "security_group" settings filled out 
+    - instance_profile : str. instance profile with attached IAM roles 
+    - monitoring : bool. enable monitoring on the instance 
+    - spot_wait_sleep : how much time to wait between each probe of whether the spot request has been placed 
+    - block_device_mappings : list of dict. EBS volumes attached to the instance (see snapshot_volume_mappings)
+    - user_data : str. base64 encoded user data 
+    - availability_zone : str. availability zone to launch the instance in, any zone of the region if None 
+    '''
+    spot_requests = client.describe_spot_instance_requests(Filters=[{'Name':'launch-group', 'Values':[spotid]},
+                                                                     {'Name':'state','Values':['open','active']}])['SpotInstanceRequests']
+    
+    # If there are open/active instance requests with the same name (should only be one) re-use the first one that was found 
+    if len(spot_requests)>0:               
+        print('Spot instance found')                                    
+        spot_req_id = spot_requests[0]['SpotInstanceRequestId']                
+    else:
+        # Otherwise request a new one 
+        print('Requesting spot instance')
+    
+        launch_specs = {
+                'SecurityGroupIds': [
+                    profile['security_group'][0],
+                ],
+                'SecurityGroups': [
+                    profile['security_group'][1],
+                ],
+                'EbsOptimized': False,                                         # do not optimize for EBS storage 
+                'ImageId': profile['image_id'],                                # AWS image ID. List available programatically or through launch wizard 
+                'InstanceType': profile['instance_type'],                      # Instance type. List available programatically or through wizard or at https://aws.amazon.com/ec2/spot/pricing/ 
+                'KeyName': profile['key_pair'][0],                             # Name for the key pair
+                'Monitoring' : {'Enabled': monitoring},                        # Enable monitoring
+        }
+        if instance_profile!='':
+            launch_specs['IamInstanceProfile']= {                              # Define the IAM role for your instance 
+                         'Name': instance_profile,                                       
+            }
+        if block_device_mappings is not None:
+            launch_specs['BlockDeviceMappings'] = block_device_mappings
+        if user_data is not None:
+            launch_specs['UserData'] = user_data
+        if availability_zone is not None:
+            launch_specs['Placement'] = {'AvailabilityZone': availability_zone}
+    
+        response = client.request_spot_instances(                              
+            AvailabilityZoneGroup=profile['region'],
+            ClientToken=spotid,                                                # submit a name to ensure idempotency 
+            DryRun=False,                                                      # if True, checks if you have permission without actually submitting request
+            InstanceCount=1,                                                   # number of individual instances 
+            LaunchGroup=spotid,
+            LaunchSpecification=launch_specs,
+            SpotPrice=profile['price'],                                        # Must be greater than current instance type price for region, available at https://aws.amazon.com/ec2/spot/pricing/ 
+            Type='one-time',                                                   # Persisitence is usually not necessary (given storage backup) or advisable with spot instances 
+            InstanceInterruptionBehavior='terminate',                          # Instance terminates if typing `shutdown -h now` in the console
+        )
+        spot_req_id = response['SpotInstanceRequests'][0]['SpotInstanceRequestId']
+    
+    # Check if the instance id has been created (will only delay if the instance was just created)
+    attempt = 0 
+    instance_id = None
+    spot_tag_added = False
+    
+    # Wait for the instance to initialize, retrieve the request by ID 
+    while not instance_id:  # I know this is unusual cause its not a boolean but it works.                                                     
+        spot_req = client.describe_spot_instance_requests(Filters=[{'Name':'spot-instance-request-id', 'Values':[spot_req_id]}])['SpotInstanceRequests']
+    
+        if len(spot_req)>0:          
+    
+            spot_req = spot_req[0]                                             
+    
+            # If no tag has been added yet add a tag to the request with the spot instance name 
+            if not spot_tag_added:     
+                client.create_tags(Resources=[spot_req['SpotInstanceRequestId']], Tags=[{'Key':'Name','Value':spotid}])
+                spot_tag_added=True
+    
+            # If the request failed raise an exception 
+            if spot_req['State']=='failed':                                    
+                raise Exception('Spot Request Failed')
+    
+            # If an instance ID was returned with the spot request we exit the while loop 
+            if 'InstanceId' in spot_req:                                       
+                instance_id = spot_req['InstanceId']
+    
+            # Otherwise we continue to wait 
+            else:                                                              
+                sys.stdout.write(".")
+                sys.stdout.flush()                                                   
+                time.sleep(spot_wait_sleep)
+        else:             
+            # If its the first attempt print launching and follow that with a bunch of periods until we're done
+            if attempt==0:
+                sys.stdout.write('Launching...')
+                sys.stdout.flush()             
+    
+            # If a new spot request was submitted it may take a moment to register
+            sys.stdout.write(".")
+            sys.stdout.flush()                                                 
+    
+            # Wait and attempt to connect again 
+            time.sleep(spot_wait_sleep)                                        
+    
+            attempt+=1
+
+    return instance_id
+
+
+def find_named_instance(client, spotid): 
+    '''Return the ID of a pending or running instance tagged with the name `spotid`, or None if there is none'''
+    reservations = client.describe_instances(Filters=[{'Name':'tag:Name', 'Values':[spotid]},
+                                                      {'Name':'instance-state-name','Values':['pending','running']}])['Reservations']
+    for reservation in reservations: 
+        for instance in reservation['Instances']: 
+            return instance['InstanceId']
+    return None 
+
+
+def request_fleet_instance(client, spotid, profile, instance_profile='', monitoring=True, block_device_mappings=None, user_data=None, availability_zone=None): 
+    '''
+    Launch a single spot instance with an EC2 Fleet in "instant" mode. The instance ID is returned synchronously so there is no request fulfilment to poll for. 
+    Returns None if the fleet could not launch the instance (no capacity, price too low, missing permissions, etc.) so the caller can fall back to `request_spot_instance`. 
+    __________
+    parameters 
+    - client : boto3 ec2 client for the profile's region 
+    - spotid : str. name for the instance, the instance is tagged with it so it can be found again 
+    - profile : dict. profile with the "key_pair" and "security_group" settings filled out 
+    - instance_profile : str. instance profile with attached IAM roles 
+    - monitoring : bool. enable monitoring on the instance 
+    - block_device_mappings : list of dict. EBS volumes attached to the instance (see snapshot_volume_mappings)
+    - user_data : str. base64 encoded user data 
+    - availability_zone : str. availability zone to launch the instance in, any zone of the region if None 
+    '''
+    print('Requesting spot instance through an instant fleet')
+
+    overrides = {'MaxPrice': str(profile['price'])}                           # Must be greater than current instance type price for region
+    if availability_zone is not None: 
+        overrides['AvailabilityZone'] = availability_zone
+
+    def create_fleet(template): 
+        return client.create_fleet(
+            Type='instant',                                                    # instances are launched synchronously and the request is not maintained 
+            LaunchTemplateConfigs=[{
+                'LaunchTemplateSpecification': {
+                    'LaunchTemplateId': template['LaunchTemplateId'],
+                    'Version': template['Version'],
+                },
+                'Overrides': [overrides],
+            }],
+            TargetCapacitySpecification={
+                'TotalTargetCapacity': 1,
+                'DefaultTargetCapacityType': 'spot',
+            },
+            SpotOptions={
+                'InstanceInterruptionBehavior': 'terminate',
+            },
+            TagSpecifications=[{
+                'ResourceType': 'instance',
+                'Tags': [{'Key':'Name','Value':spotid}],
+            }],
+        )
+
+    try: 
+        template = get_launch_template(client, profile, instance_profile=instance_profile, monitoring=monitoring, block_device_mappings=block_device_mappings, user_data=user_data)
+        try: 
+            response = create_fleet(template)
+        except Exception as e: 
+            # The template was deleted outside of spot-connect, drop it from the cache and create it again 
+            if 'InvalidLaunchTemplate' in str(e): 
+                forget_launch_template(template['key'])
+                template = get_launch_template(client, profile, instance_profile=instance_profile, monitoring=monitoring, refresh=True, block_device_mappings=block_device_mappings, user_data=user_data)
+                response = create_fleet(template)
+            else: 
+                raise e 
+    except Exception as e: 
+        print('Instant fleet request failed ('+str(e)+'), falling back to a spot instance request')
+        return None 
+
+    for instances in response.get('Instances', []): 
+        if len(instances.get('InstanceIds', []))>0: 
+            return instances['InstanceIds'][0]
+
+    errors = [err.get('ErrorCode', '')+': '+err.get('ErrorMessage', '') for err in response.get('Errors', [])]
+    print('Instant fleet did not launch an instance ('+'; '.join(errors)+'), falling back to a spot instance request')
+    return None 
 
 
 def check_instance_initialization(instance_id, client=None, region=None, instance_wait_sleep=5): 
@@ -252,6 +670,68 @@ def check_instance_initialization(instance_id, client=None, region=None, instanc
     return instance_status
 
 
+def get_instance_statuses(instance_ids, client=None, region=None):
+    '''
+    Get the state and status checks for many instances using batched describe_instance_status calls.
+    Returns a dictionary with an entry per instance ID: {'state': <instance state>, 'instance_status': <status>, 'system_status': <status>}.
+    Instances that AWS does not report on yet (just requested) are left out.
+    __________
+    parameters
+    - instance_ids : list of str. the instance IDs to check
+    - client : boto3 ec2 client. if None, region must be submitted
+    - region : str. region to connect to if no client is submitted
+    '''
+    if client is None:
+        try: assert region is not None
+        except: raise Exception('If client is None region must be passed.')
+        client = boto3.client('ec2', region_name=region)
+
+    statuses = {}
+
+    # describe_instance_status accepts at most 100 instance IDs per call
+    for batch in sutils.chunks(list(instance_ids), 100):
+        try:
+            response = client.describe_instance_status(InstanceIds=batch, IncludeAllInstances=True)
+        except Exception as e:
+            # Instances that were just launched may not be registered yet, check them one at a time
+            if 'InvalidInstanceID' in str(e) and len(batch)>1:
+                for iid in batch:
+                    statuses.update(get_instance_statuses([iid], client=client))
+                continue
+            elif 'InvalidInstanceID' in str(e):
+                continue
+            raise e
+
+        for status in response['InstanceStatuses']:
+            statuses[status['InstanceId']] = {'state': status['InstanceState']['Name'],
+                                              'instance_status': status['InstanceStatus']['Status'],
+                                              'system_status': status['SystemStatus']['Status']}
+    return statuses
+
+
+def get_instances(instance_ids, client=None, region=None):
+    '''
+    Describe many instances with batched describe_instances calls. Returns a dictionary with the instance description for each instance ID found. 
+    __________
+    parameters
+    - instance_ids : list of str. the instance IDs to describe
+    - client : boto3 ec2 client. if None, region must be submitted
+    - region : str. region to connect to if no client is submitted
+    '''
+    if client is None:
+        try: assert region is not None
+        except: raise Exception('If client is None region must be passed.')
+        client = boto3.client('ec2', region_name=region)
+
+    instances = {}
+    for batch in sutils.chunks(list(instance_ids), 100):
+        for reservation in client.describe_instances(InstanceIds=batch)['Reservations']:
+            for instance in reservation['Instances']:
+                instances[instance['InstanceId']] = instance
+
+    return instances
+
+
 def connect_to_instance(ip, keyfile, username='ec2-user', port=22, timeout=10):
     '''
     Connect to the spot instance using paramiko's SSH client 
@@ -12,16 +12,136 @@ MIT License 2020
 """
 
 import boto3
-import sys, time, os
+import sys, time, os, random, threading
 from path import Path
-from netaddr import IPNetwork
+from netaddr import IPNetwork, IPAddress
 
 root = Path(os.path.dirname(os.path.abspath(__file__)))
 
 from spot_connect import sutils
 
-def launch_efs(system_name, region='us-west-2', launch_wait=3):
-    '''Create or connect to an existing file system'''
+# Descriptors of the file systems used in this session, keyed by (region, system name), so repeat launches and mounts do not call the EFS API again 
+efs_cache = {}
+efs_cache_ttl = 600
+efs_cache_lock = threading.Lock()
+efs_launch_locks = {}
+
+
+def set_efs_cache_ttl(ttl):
+    '''Set the number of seconds an EFS descriptor is reused before it is described again (0 disables the cache)'''
+    global efs_cache_ttl
+    efs_cache_ttl = ttl
+
+
+def invalidate_efs_cache(system_name=None, region=None):
+    '''Forget the cached descriptors of a file system (in every region if region is None), or of all file systems if system_name is None'''
+    with efs_cache_lock:
+        for key in [k for k in efs_cache if (region is None or k[0]==region) and (system_name is None or k[1]==system_name)]:
+            del efs_cache[key]
+
+
+def get_cached_efs(system_name, region):
+    '''
+    Return the cached descriptor of a file system if it is recent enough, otherwise None. 
+    The descriptor is a dict with the "file_system" description, its "id", "dns", "lifecycle", the "mount_targets" by availability zone and the "time" it was described at. 
+    '''
+    with efs_cache_lock:
+        descriptor = efs_cache.get((region, system_name))
+        if descriptor is None or time.time()-descriptor['time']>efs_cache_ttl:
+            return None
+        return descriptor
+
+
+def cache_efs(system_name, region, file_system, mount_targets=None):
+    '''Cache the description of a file system (and of its mount targets, if given) and return its descriptor'''
+    with efs_cache_lock:
+        previous = efs_cache.get((region, system_name))
+        if mount_targets is None:
+            mount_targets = {} if previous is None or previous['id']!=file_system['FileSystemId'] else previous['mount_targets']
+        else:
+            # Mount targets being deleted (or that failed) cannot be mounted, the ones being created are waited for by retrieve_efs_mount
+            mount_targets = {mt['AvailabilityZoneName']: mt for mt in mount_targets if mt['LifeCycleState'] in ('available', 'creating')}
+        descriptor = {'file_system': file_system,
+                      'id': file_system['FileSystemId'],
+                      'dns': file_system['FileSystemId']+'.efs.'+region+'.amazonaws.com',
+                      'lifecycle': file_system['LifeCycleState'],
+                      'mount_targets': mount_targets,
+                      'time': time.time()}
+        efs_cache[(region, system_name)] = descriptor
+        return descriptor
+
+
+def cache_mount_target(system_name, region, mount_target):
+    '''Add a mount target to the cached descriptor of its file system'''
+    with efs_cache_lock:
+        descriptor = efs_cache.get((region, system_name))
+        if descriptor is not None:
+            descriptor['mount_targets'][mount_target['AvailabilityZoneName']] = mount_target
+
+
+def forget_mount_target(system_name, region, availability_zone):
+    '''Remove the mount target of an availability zone from the cached descriptor of its file system'''
+    with efs_cache_lock:
+        descriptor = efs_cache.get((region, system_name))
+        if descriptor is not None:
+            descriptor['mount_targets'].pop(availability_zone, None)
+
+
+def describe_efs(system_name, region='us-west-2', refresh=False, launch_wait=3, performance_mode=None, throughput_mode=None, provisioned_throughput=None):
+    '''
+    Return the descriptor of a file system (see get_cached_efs), creating the file system if it does not exist (see launch_efs for the performance and throughput settings). 
+    A recent cached descriptor of an available file system is returned without calling AWS, use refresh=True to describe it again. 
+    Concurrent calls for the same file system (e.g. instances launched in parallel) wait for the first one instead of repeating it. 
+    '''
+    with efs_cache_lock:
+        launch_lock = efs_launch_locks.setdefault((region, system_name), threading.Lock())
+
+    with launch_lock:
+        descriptor = None if refresh else get_cached_efs(system_name, region)
+        if descriptor is not None and not throughput_matches(descriptor['file_system'], throughput_mode, provisioned_throughput):
+            descriptor = None
+        if descriptor is None or descriptor['lifecycle']!='available':
+            file_system = launch_efs(system_name, region=region, launch_wait=launch_wait, use_cache=False, performance_mode=performance_mode, throughput_mode=throughput_mode, provisioned_throughput=provisioned_throughput)
+            mount_targets = boto3.client('efs', region_name=region).describe_mount_targets(FileSystemId=file_system['FileSystemId'])['MountTargets']
+            descriptor = cache_efs(system_name, region, file_system, mount_targets=mount_targets)
+
+    return descriptor
+
+
+def throughput_matches(file_system, throughput_mode=None, provisioned_throughput=None):
+    '''Check whether a file system description has the requested throughput mode (None matches any mode)'''
+    if throughput_mode is None: 
+        return True 
+    if file_system.get('ThroughputMode', 'bursting')!=throughput_mode: 
+        return False 
+    return throughput_mode!='provisioned' or provisioned_throughput is None or file_system.get('ProvisionedThroughputInMibps')==provisioned_throughput
+
+
+def launch_efs(system_name, region='us-west-2', launch_wait=3, use_cache=True, performance_mode=None, throughput_mode=None, provisioned_throughput=None):
+    '''
+    Create or connect to an existing file system. With use_cache=True a recently described available file system is returned without calling AWS. 
+    I/O heavy fleets can run out of burst credits with the default "bursting" throughput, use the "elastic" or "provisioned" throughput modes for them. 
+    The throughput mode of an existing file system is updated if it differs (AWS allows one change a day), its performance mode cannot be changed. 
+    __________
+    parameters
+    - system_name : str. name (creation token) of the file system
+    - region : str. AWS region 
+    - performance_mode : str. "generalPurpose" (default) or "maxIO", only used when the file system is created 
+    - throughput_mode : str. "bursting" (default), "provisioned" or "elastic" 
+    - provisioned_throughput : float. throughput in MiB/s when the throughput mode is "provisioned" 
+    '''
+
+    if use_cache:
+        return describe_efs(system_name, region=region, launch_wait=launch_wait, performance_mode=performance_mode, throughput_mode=throughput_mode, provisioned_throughput=provisioned_throughput)['file_system']
+
+    if throughput_mode=='provisioned' and provisioned_throughput is None: 
+        raise Exception('provisioned_throughput (MiB/s) is required with the "provisioned" throughput mode')
+
+    throughput = {}
+    if throughput_mode is not None: 
+        throughput['ThroughputMode'] = throughput_mode
+        if throughput_mode=='provisioned': 
+            throughput['ProvisionedThroughputInMibps'] = provisioned_throughput
 
     client = boto3.client('efs', region_name=region)
     
@@ -36,7 +156,8 @@ def launch_efs(system_name, region='us-west-2', launch_wait=3):
         # Create the file system 
         client.create_file_system(                                             
             CreationToken=system_name,
-            PerformanceMode='generalPurpose',
+            PerformanceMode='generalPurpose' if performance_mode is None else performance_mode,
+            **throughput
         )
 
         initiated=False 
@@ -61,130 +182,192 @@ def launch_efs(system_name, region='us-west-2', launch_wait=3):
     else: 
         print('...EFS file system already exists')
         file_system = file_systems[0]                                          # If the file system exists 
-                
-    available=False
-    sys.stdout.write('Waiting for availability...')
-    sys.stdout.flush() 
 
-    while not available: 
+        if performance_mode is not None and file_system['PerformanceMode']!=performance_mode: 
+            print('The file system was created with the "'+file_system['PerformanceMode']+'" performance mode, which cannot be changed')
 
-        file_system = client.describe_file_systems(CreationToken=system_name)['FileSystems'][0]
+        if not throughput_matches(file_system, throughput_mode, provisioned_throughput): 
+            print('Updating the throughput mode to "'+throughput_mode+'"')
+            client.update_file_system(FileSystemId=file_system['FileSystemId'], **throughput)
+            file_system = client.describe_file_systems(CreationToken=system_name)['FileSystems'][0]
+                
+    # Only poll if the file system is not available yet 
+    if file_system['LifeCycleState']!='available':
+        sys.stdout.write('Waiting for availability...')
+        sys.stdout.flush() 
 
+    while file_system['LifeCycleState']!='available': 
+        sys.stdout.write(".")
+        sys.stdout.flush() 
+        time.sleep(launch_wait)
+        file_system = client.describe_file_systems(CreationToken=system_name)['FileSystems'][0]
         if file_system['LifeCycleState']=='available':
-            available=True
             print('...Available')
-            
-        else: 
-            sys.stdout.write(".")
-            sys.stdout.flush() 
-            time.sleep(launch_wait)
         
+    cache_efs(system_name, region, file_system)
+
     return file_system 
 
 
-def retrieve_efs_mount(file_system_name, instance, new_mount=False, region='us-west-2', mount_wait=3): 
-    
-    # Launch or connect to an EFS 
-    file_system = launch_efs(file_system_name, region=region)                  
-    file_system_id = file_system['FileSystemId']
-        
-    # Connect and check for existing mount targets on the EFS 
-    client = boto3.client('efs', region_name=region)                            
-    mount_targets = client.describe_mount_targets(FileSystemId=file_system_id)['MountTargets']
+def used_subnet_ips(subnet_id, region='us-west-2'):
+    '''Return the set of private IPs (as integers) already assigned to network interfaces in the subnet, with a single describe call'''
+    client = boto3.client('ec2', region_name=region)
+    used = set()
+    for page in client.get_paginator('describe_network_interfaces').paginate(Filters=[{'Name': 'subnet-id', 'Values': [subnet_id]}]):
+        for interface in page['NetworkInterfaces']:
+            for address in interface.get('PrivateIpAddresses', []):
+                used.add(int(IPAddress(address['PrivateIpAddress'])))
+    return used
+
+
+def free_subnet_ips(cidr_block, used=(), start=None):
+    '''
+    Generator over the free IPs of a subnet's CIDR block, starting at a random address and wrapping around. 
+    The addresses are computed from the block so memory use does not depend on its size. 
+    AWS reserves the first four and the last address of every subnet, those are skipped. 
+    __________
+    parameters
+    - cidr_block : str. IPv4 CIDR block of the subnet (e.g. "172.31.0.0/16")
+    - used : set of int. IPs already in use, as integers (see used_subnet_ips)
+    - start : int. offset of the first address to try among the usable addresses, random if None
+    '''
+    net = IPNetwork(cidr_block)
+    n_usable = net.size-5
+    if start is None: 
+        start = random.randrange(n_usable)
+    for i in range(n_usable):
+        ip = net[4+(start+i)%n_usable]
+        if int(ip) not in used:
+            yield str(ip)
+
+
+def create_mount_target(file_system_id, subnet_id, security_group_id, ip_address=None, region='us-west-2', max_attempts=10):
+    '''
+    Create a mount target for the file system in the subnet and return the response. 
+    By default AWS assigns the IP address of the mount target, use ip_address='pick' to pick a free address of the subnet here instead (retrying with the next free address if it was taken in the meantime).
+    __________
+    parameters
+    - file_system_id : str. ID of the file system
+    - subnet_id : str. subnet of the mount target, the same as the instances that mount it
+    - security_group_id : str. security group of the mount target, which must allow NFS connections (port 2049)
+    - ip_address : str. None to let AWS assign the address, "pick" to pick a free one or a specific IPv4 address
+    - max_attempts : int. number of addresses to try when picking
+    '''
+    client = boto3.client('efs', region_name=region)
+    kwargs = {'FileSystemId': file_system_id, 'SubnetId': subnet_id, 'SecurityGroups': [security_group_id]}
+
+    if ip_address!='pick':
+        if ip_address is not None:
+            kwargs['IpAddress'] = ip_address
+        return client.create_mount_target(**kwargs)
+
+    cidr_block = boto3.client('ec2', region_name=region).describe_subnets(SubnetIds=[subnet_id])['Subnets'][0]['CidrBlock']
+    candidates = free_subnet_ips(cidr_block, used=used_subnet_ips(subnet_id, region=region))
 
-    # If no mount targets are detected
-    if (len(mount_targets)==0):   
-        new_mount = True 
+    for attempt, ip in enumerate(candidates):
+        try:
+            return client.create_mount_target(IpAddress=ip, **kwargs)
+        except Exception as e:
+            if 'IpAddressInUse' not in str(e) or attempt+1>=max_attempts:
+                raise e
 
-    # Setup a new mount on the file system 
-    if new_mount:                                               
+    raise Exception('No free IP address left in subnet '+subnet_id)
+
+
+def wait_for_mount_target(mount_target_id, region='us-west-2', mount_wait=3, timeout=600):
+    '''Poll a mount target until its LifeCycleState is "available" and return its description. Raises an exception if it is being deleted, failed or the timeout runs out'''
+    client = boto3.client('efs', region_name=region)
+    st = time.time()
+    while True:
+        try:
+            mount_target = client.describe_mount_targets(MountTargetId=mount_target_id)['MountTargets'][0]
+        except Exception:
+            mount_target = None                                                # a new mount target may not be visible yet
+        if mount_target is not None:
+            if mount_target['LifeCycleState']=='available':
+                return mount_target
+            if mount_target['LifeCycleState'] in ('deleting', 'deleted', 'error'):
+                raise Exception('Mount target '+mount_target_id+' is '+mount_target['LifeCycleState'])
+        if time.time()-st>timeout:
+            raise Exception('Timed out waiting for mount target '+mount_target_id+' to be available')
+        sys.stdout.write('.')
+        sys.stdout.flush()
+        time.sleep(mount_wait)
+
+
+def retrieve_efs_mount(file_system_name, instance, new_mount=False, region='us-west-2', mount_wait=3, ip_address=None): 
+    '''
+    Launch or connect to the file system and create a mount target in the instance's availability zone if there is none (or if new_mount is True). 
+    The file system and its mount targets are cached (see describe_efs), so mounting it on more instances in the same availability zone does not call AWS. 
+    The mount target is only returned (and cached) once it is available, cached mount targets that are not available are checked again. 
+    Returns the mount target, the instance's public DNS and the file system's DNS. 
+    __________
+    parameters
+    - ip_address : str. IP address of a new mount target, see create_mount_target
+    '''
+    
+    # Launch or connect to an EFS 
+    descriptor = describe_efs(file_system_name, region=region)
+    file_system_id = descriptor['id']
+    availability_zone = instance['Placement']['AvailabilityZone']
+
+    # A cached mount target that was not available yet (or is not anymore) is checked again before it is used 
+    mount_target = None if new_mount else descriptor['mount_targets'].get(availability_zone)
+    if mount_target is not None and mount_target['LifeCycleState']!='available':
+        sys.stdout.write('Waiting for mount target...')
+        sys.stdout.flush() 
+        try: 
+            mount_target = wait_for_mount_target(mount_target['MountTargetId'], region=region, mount_wait=mount_wait)
+            print('Available')
+            cache_mount_target(file_system_name, region, mount_target)
+        except Exception as e: 
+            print(str(e))
+            forget_mount_target(file_system_name, region, availability_zone)
+            mount_target = None
+
+    # Setup a new mount on the file system if there is none in the instance's availability zone 
+    if mount_target is None:                                               
 
         sys.stdout.write('No mount target detected. Creating mount target...')
         sys.stdout.flush() 
 
         subnet_id = instance['SubnetId']                                       # Gather the instance subnet ID. Subnets are your personal cloud, for a full explanation see https://docs.aws.amazon.com/vpc/latest/userguide/VPC_Subnets.html
-        security_group_id = instance['SecurityGroups'][0]['GroupId']           # Get the instance's security group
-        
-        ec2 = boto3.resource('ec2')                                            
-        subnet = ec2.Subnet(subnet_id)                                         # Get the features of the subnet
-        
-        net = IPNetwork(subnet.cidr_block)                                     # Get the IPv4 CIDR block assigned to the subnet.
-        ips = [str(x) for x in list(net[4:-1])]                                # The CIDR block is a block or range of IP addresses, we only need to assign one of these to a single mount
+        security_group_id = instance['SecurityGroups'][0]['GroupId']           # Get the instance's security group, which must have ingress rules to allow NFS client connections (enable port 2049)
 
-        # TODO: This might be why sometimes efs mounts disconnect from one instance or another, verify whether using the IDLOG works and whether this problem pops-up again.  
-        
-        # Use an id log to keep track of which IPs get used in a single day 
-        # A list of the ips (indices of the Ips used) will be saved for each user. 
-        # Each time we run this we will pick a random ip from the list of available ips
-        idlog = sutils.CurrentIdLog(lower_limit=0, upper_limit=(len(ips)-1))
-
-        # Assume we're always using the same AWS config and thus always using the same user 
-        idlog.set_user_id(0)
-        ipid = idlog.get_valid_call_id()
-        
-        complete = False 
-
-        while not complete: 
-            try: 
-                response = client.create_mount_target(                         # Create the mount target 
-                    FileSystemId=file_system_id,                               # Under the file system just created 
-                    SubnetId=subnet_id,                                        # Under the same subnet as the EC2 instance you've just created 
-                    IpAddress=ips[ipid],                                       # Assign it the first IP Adress from the CIDR block assigned to the subnet 
-                    SecurityGroups=[
-                        security_group_id,                                     # Apply the security group which must have ingress rules to allow NFS client connections (enable port 2049)
-                    ]
-                )
-                complete=True
-            except Exception as e: 
-                if 'IpAddressInUse' in str(e):
-                    ipid+=1 
-                else: 
-                    raise(e) 
-
-        initiated = False
+        try: 
+            response = create_mount_target(file_system_id, subnet_id, security_group_id, ip_address=ip_address, region=region)
+        except Exception as e: 
+            # The cache may be missing a mount target created elsewhere, forget it so the next call describes the file system again 
+            invalidate_efs_cache(file_system_name, region=region)
+            raise e
 
         sys.stdout.write('Initializing...')
         sys.stdout.flush() 
 
-        # Probe for the mount target until it is detectable 
-        while not initiated: 
-            try:                                                               
-                mount_target = client.describe_mount_targets(MountTargetId=response['MountTargetId'])['MountTargets'][0]
-                initiated = True 
-            except: 
-                sys.stdout.write(".")
-                sys.stdout.flush() 
-                time.sleep(mount_wait)
+        # The NFS mount fails until the mount target is available, only cache and return it then 
+        mount_target = wait_for_mount_target(response['MountTargetId'], region=region, mount_wait=mount_wait)
 
-        print('Detected')
+        print('Available')
+        cache_mount_target(file_system_name, region, mount_target)
 
-    else: 
-        mount_target = mount_targets[0]
-    
     instance_dns = instance['PublicDnsName']
     print('Region',region)
     print('FSID', file_system_id)
     
-    filesystem_dns = file_system_id+'.efs.'+region+'.amazonaws.com'
+    filesystem_dns = descriptor['dns']
             
     return mount_target, instance_dns, filesystem_dns
 
 
 def get_filesystem_dns(file_system_name, region):
     # Launch or connect to an EFS 
-    file_system = launch_efs(file_system_name, region=region)                  
-    file_system_id = file_system['FileSystemId']
-
-    filesystem_dns = file_system_id+'.efs.'+region+'.amazonaws.com'
-
-    return filesystem_dns
+    return describe_efs(file_system_name, region=region)['dns']
 
 
 def get_mounttarget_dns(file_system_name, region, availability_zone):
 
     # Launch or connect to an EFS 
-    file_system = launch_efs(file_system_name, region=region)                  
-    file_system_id = file_system['FileSystemId']
+    file_system_id = describe_efs(file_system_name, region=region)['id']
 
     # Format : availability-zone.file-system-id.efs.aws-region.amazonaws.com
     mount_target_dns = availability_zone+'.'+file_system_id+'.efs.'+region+'.amazonaws.com'
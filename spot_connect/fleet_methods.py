@@ -11,12 +11,12 @@ infrastructure using the spotted module.
 MIT License 2020
 '''
 
-import os, sys, boto3
+import os, sys, time, boto3
 from path import Path 
 
 root = Path(os.path.dirname(os.path.abspath(__file__)))
 
-from spot_connect import iam_methods
+from spot_connect import iam_methods, ec2_methods, sutils
 
     
 
@@ -30,84 +30,105 @@ def launch_spot_fleet(account_number,
                       availability_zone=None,
                       kp_dir=None,
                       enable_nfs=True,
-                      enable_ds=True):
+                      enable_ds=True,
+                      scratch=None,
+                      volumes=None):
     '''
-    Launch a spot fleet request 
+    Launch a spot fleet request. The launch specification is submitted as a cached EC2 launch template, see ec2_methods.get_launch_template 
+    Use `scratch` (mount point) to mount the instance-store NVMe drives of each instance as scratch space and `volumes` to attach EBS volumes restored from snapshots, see ec2_methods.get_spot_instance 
     '''
         
     client = boto3.client('ec2', region_name=profile['region'])
 
-    #~#~#~#~#~#~#~#~#~#~#
-    #~#~# Key Pairs #~#~#
-    #~#~#~#~#~#~#~#~#~#~#
-    
-    if 'key_pair' not in profile: 
+    # The storage is set up by the user data when each instance boots 
+    block_device_mappings, user_data, volumes = ec2_methods.storage_launch_settings(client, profile, scratch=scratch, volumes=volumes, availability_zone=availability_zone, user_data=user_data)
+
+    if 'key_pair' not in profile or 'security_group' not in profile: 
         if name is None: 
             raise Exception('key_pair not in profile. Please use name arg to create a key-pair & security group')        
-        # Log a keypair in the profile directory
-        profile['key_pair']=('KP-'+name, 'KP-'+name+'.pem')
+
+    if kp_dir is None: 
+        kp_dir = sutils.get_default_kp_dir()
+
+    # The key pair and security group names are known before any call to AWS so we can look for a cached launch template first 
+    key_pair = profile.get('key_pair', ('KP-'+str(name), 'KP-'+str(name)+'.pem'))
+    sg_name = profile['security_group'][1] if 'security_group' in profile else 'SG-'+str(name)
+
+    template = ec2_methods.get_cached_launch_template(profile, key_pair[0], sg_name, instance_profile=instance_profile, user_data=user_data, monitoring=monitoring, block_device_mappings=block_device_mappings, client=client)
+
+    # A cached template means the key pair and security group were already set up, skip those calls if the private key is still around
+    if template is not None and os.path.exists(os.path.join(kp_dir, template['key_pair'][1])): 
+        print('Launch template detected in cache, skipping key pair and security group setup...')
+        profile['key_pair'] = template['key_pair']
+        profile['security_group'] = template['security_group']
+
+    else: 
+        #~#~#~#~#~#~#~#~#~#~#
+        #~#~# Key Pairs #~#~#
+        #~#~#~#~#~#~#~#~#~#~#
         
-    try: 
-        iam_methods.create_key_pair(client, profile, kp_dir)
-    except Exception as e: 
-        if 'InvalidKeyPair.Duplicate' in str(e):
-            print('Key pair detected, re-using...')
-        else: 
-            sys.stdout.write('Was not able to find Key-Pair in default directory '+str(kp_dir))
-            sys.stdout.write("\nTo reset default directory run: spot_connect.sutils.set_default_kp_dir(<dir>)")
-            sys.stdout.flush()   
-            raise e 
-            
-    #~#~#~#~#~#~#~#~#~#~#~#~#~#
-    #~#~# Security Groups #~#~#
-    #~#~#~#~#~#~#~#~#~#~#~#~#~#
+        # Log a keypair in the profile directory
+        profile['key_pair'] = key_pair
             
-    # If no security group was submitted 
-    if 'security_group' not in profile:                                                    
-        if name is None: 
-            raise Exception('key_pair not in profile. Please use name arg to create a key-pair & security group')        
-        # Create and retrieve the security group 
-        sg = iam_methods.get_security_group(client, 'SG-'+name, enable_nfs=enable_nfs, enable_ds=enable_ds, firewall_ingress_settings=profile['firewall_ingress'])    
+        try: 
+            iam_methods.create_key_pair(client, profile, kp_dir)
+        except Exception as e: 
+            if 'InvalidKeyPair.Duplicate' in str(e):
+                print('Key pair detected, re-using...')
+            else: 
+                sys.stdout.write('Was not able to find Key-Pair in default directory '+str(kp_dir))
+                sys.stdout.write("\nTo reset default directory run: spot_connect.sutils.set_default_kp_dir(<dir>)")
+                sys.stdout.flush()   
+                raise e 
+                
+        #~#~#~#~#~#~#~#~#~#~#~#~#~#
+        #~#~# Security Groups #~#~#
+        #~#~#~#~#~#~#~#~#~#~#~#~#~#
+                
+        # If no security group was submitted 
+        if 'security_group' not in profile:                                                    
+            # Create and retrieve the security group 
+            sg = iam_methods.get_security_group(client, sg_name, enable_nfs=enable_nfs, enable_ds=enable_ds, firewall_ingress_settings=profile['firewall_ingress'])    
+    
+            # For the profile we need a tuple of the security group ID and the security group name. 
+            profile['security_group'] = (sg['GroupId'], sg_name)                 # Add the security group ID and name to the profile dictionary 
 
-        # For the profile we need a tuple of the security group ID and the security group name. 
-        profile['security_group'] = (sg['GroupId'],'SG-'+name)               # Add the security group ID and name to the profile dictionary 
+        template = ec2_methods.get_launch_template(client, profile, instance_profile=instance_profile, user_data=user_data, monitoring=monitoring, block_device_mappings=block_device_mappings)
 
     #~#~#~#~#~#~#~#~#~#~#~#~#~#
     #~#~# Fleet Requests  #~#~#
     #~#~#~#~#~#~#~#~#~#~#~#~#~#
 
-    launch_specs = [{
-        'SecurityGroups':[
-            {
-                'GroupId':profile['security_group'][0]
+    def request_fleet(template): 
+        launch_template_config = {
+            'LaunchTemplateSpecification': {
+                'LaunchTemplateId': template['LaunchTemplateId'],
+                'Version': template['Version'],
             }
-        ],
-        'EbsOptimized': False,                   # do not optimize for EBS storage 
-        'ImageId': profile['image_id'],          # AWS image ID. List available programatically or through launch wizard 
-        'InstanceType': profile['instance_type'],# Instance type. List available programatically or through wizard or at https://aws.amazon.com/ec2/spot/pricing/ 
-        'KeyName': profile['key_pair'][0],       # Name for the key pair
-        'Monitoring' : {'Enabled': monitoring},  # Enable monitoring
-    }]
-    
-    if instance_profile!='':
-        launch_specs[0]['IamInstanceProfile']= {                              # Define the IAM role for your instance 
-                     'Name': instance_profile,                                       
-        }
-    if user_data is not None: 
-        launch_specs[0]['UserData']= user_data
-    if availability_zone is not None: 
-        launch_specs[0]['Placement']= {
-                'AvailabilityZone': availability_zone, 
         }
-        
-    response = client.request_spot_fleet(
-        DryRun=False,
-        SpotFleetRequestConfig={
-            'TargetCapacity': n_instances,
-            'IamFleetRole': 'arn:aws:iam::'+account_number+':role/aws-ec2-spot-fleet-tagging-role',  # required 
-            'LaunchSpecifications': launch_specs
-        }
-    )
+        if availability_zone is not None: 
+            launch_template_config['Overrides'] = [{'AvailabilityZone': availability_zone}]
+
+        return client.request_spot_fleet(
+            DryRun=False,
+            SpotFleetRequestConfig={
+                'TargetCapacity': n_instances,
+                'IamFleetRole': 'arn:aws:iam::'+account_number+':role/aws-ec2-spot-fleet-tagging-role',  # required 
+                'LaunchTemplateConfigs': [launch_template_config]
+            }
+        )
+
+    try: 
+        response = request_fleet(template)
+    except Exception as e: 
+        # The template was deleted outside of spot-connect, drop it from the cache and create it again 
+        if 'InvalidLaunchTemplate' in str(e): 
+            print('Cached launch template is no longer valid, re-creating...')
+            ec2_methods.forget_launch_template(template['key'])
+            template = ec2_methods.get_launch_template(client, profile, instance_profile=instance_profile, user_data=user_data, monitoring=monitoring, refresh=True, block_device_mappings=block_device_mappings)
+            response = request_fleet(template)
+        else: 
+            raise e 
         
     return response
 
@@ -118,4 +139,171 @@ def get_fleet_instances(spot_fleet_req_id, region=None):
         client = boto3.client('ec2')
     else: 
         client = boto3.client('ec2', region_name=region)
-    return client.describe_spot_fleet_instances(SpotFleetRequestId=spot_fleet_req_id)
\ No newline at end of file
+    return client.describe_spot_fleet_instances(SpotFleetRequestId=spot_fleet_req_id)
+
+def get_fleet_capacity(spot_fleet_req_id, region=None): 
+    '''Returns the target capacity and the state of the given spot fleet request'''
+    if region is None: 
+        client = boto3.client('ec2')
+    else: 
+        client = boto3.client('ec2', region_name=region)
+    config = client.describe_spot_fleet_requests(SpotFleetRequestIds=[spot_fleet_req_id])['SpotFleetRequestConfigs'][0]
+    return config['SpotFleetRequestConfig']['TargetCapacity'], config['SpotFleetRequestState']
+
+
+def modify_fleet_capacity(spot_fleet_req_id, target_capacity, region=None, terminate_excess=True): 
+    '''
+    Change the target capacity of a spot fleet request 
+    __________
+    parameters
+    - spot_fleet_req_id : str. spot fleet request ID 
+    - target_capacity : int. new number of instances for the fleet 
+    - region : str. region of the fleet 
+    - terminate_excess : bool. if True, instances above the new capacity are terminated, otherwise they are left running until they shut themselves down 
+    '''
+    if region is None: 
+        client = boto3.client('ec2')
+    else: 
+        client = boto3.client('ec2', region_name=region)
+    return client.modify_spot_fleet_request(SpotFleetRequestId=spot_fleet_req_id, 
+                                            TargetCapacity=target_capacity,
+                                            ExcessCapacityTerminationPolicy='default' if terminate_excess else 'noTermination')
+
+
+def cancel_fleet(spot_fleet_req_id, region=None, terminate_instances=True): 
+    '''Cancel a spot fleet request and (by default) terminate its instances'''
+    if region is None: 
+        client = boto3.client('ec2')
+    else: 
+        client = boto3.client('ec2', region_name=region)
+    return client.cancel_spot_fleet_requests(SpotFleetRequestIds=[spot_fleet_req_id], TerminateInstances=terminate_instances)
+
+
+class FleetAutoscaler: 
+
+    fid             =   None 
+    region          =   None 
+    capacity        =   None 
+    cancelled       =   False 
+    error           =   None 
+
+    def __init__(self, 
+                 fid, 
+                 backlog, 
+                 region=None, 
+                 tasks_per_instance=1, 
+                 min_capacity=0, 
+                 max_capacity=None, 
+                 scale_up_cooldown=60, 
+                 scale_down_cooldown=300, 
+                 hysteresis=1, 
+                 cancel_at_zero=True, 
+                 terminate_excess=True): 
+        '''
+        Keep the target capacity of a spot fleet matched to a backlog of work. 
+        Each call to `step` reads the backlog and grows or shrinks the fleet with modify_spot_fleet_request. Growing and shrinking 
+        have separate cool-downs, and the fleet only shrinks when it is at least `hysteresis` instances above what the backlog needs. 
+        When the backlog reaches zero the fleet request is cancelled (if cancel_at_zero is True), as long as the backlog had work in it before or has stayed empty 
+        for the scale-down cool-down, so a fleet whose backlog has not been filled yet is not cancelled (or shrunk) on the first check. 
+        __________
+        parameters
+        - fid : str. spot fleet request ID 
+        - backlog : callable, queue or list. The amount of remaining work: either a function returning the number of tasks, a queue.Queue (qsize) or any object with a length. 
+                    Count the tasks that are still running as well as the pending ones, otherwise busy instances may be terminated when the fleet shrinks. 
+        - region : str. region of the fleet 
+        - tasks_per_instance : int. number of tasks each instance works on at the same time 
+        - min_capacity : int. the fleet is never shrunk below this capacity (unless it is cancelled at zero) 
+        - max_capacity : int. the fleet is never grown above this capacity 
+        - scale_up_cooldown : int. minimum number of seconds between a capacity change and the next increase 
+        - scale_down_cooldown : int. minimum number of seconds between a capacity change and the next decrease 
+        - hysteresis : int. number of instances above the required capacity tolerated before shrinking 
+        - cancel_at_zero : bool. cancel the fleet request and terminate its instances when the backlog is empty (after it had work, or after `scale_down_cooldown` seconds empty) 
+        - terminate_excess : bool. terminate instances above the new capacity when the fleet shrinks 
+        '''
+        self.fid = fid 
+        self.backlog = backlog 
+        self.region = region 
+        self.tasks_per_instance = tasks_per_instance 
+        self.min_capacity = min_capacity 
+        self.max_capacity = max_capacity 
+        self.scale_up_cooldown = scale_up_cooldown 
+        self.scale_down_cooldown = scale_down_cooldown 
+        self.hysteresis = hysteresis 
+        self.cancel_at_zero = cancel_at_zero 
+        self.terminate_excess = terminate_excess 
+
+        self.capacity, _ = get_fleet_capacity(fid, region=region)
+        self.last_change = 0 
+        self.cancelled = False 
+        self.stopped = False 
+        self.error = None 
+        self.had_work = False 
+        self.empty_since = None 
+        self.started = time.time()
+        self.history = [] 
+
+    def backlog_size(self): 
+        '''Return the current size of the backlog'''
+        if callable(self.backlog): 
+            return int(self.backlog())
+        elif hasattr(self.backlog, 'qsize'): 
+            return self.backlog.qsize()
+        return len(self.backlog)
+
+    def desired_capacity(self, backlog): 
+        '''Return the capacity needed for the given backlog, within the min and max capacity'''
+        desired = -(-backlog // self.tasks_per_instance)                      # ceiling division 
+        desired = max(desired, self.min_capacity)
+        if self.max_capacity is not None: 
+            desired = min(desired, self.max_capacity)
+        return desired 
+
+    def step(self): 
+        '''Check the backlog once and resize or cancel the fleet if needed. Returns the current target capacity'''
+        if self.cancelled: 
+            return 0 
+
+        backlog = self.backlog_size()
+        now = time.time()
+
+        if backlog>0: 
+            self.had_work = True 
+            self.empty_since = None 
+        elif self.empty_since is None: 
+            self.empty_since = now 
+
+        if backlog==0 and self.cancel_at_zero and (self.had_work or now-self.empty_since>=self.scale_down_cooldown): 
+            print('Backlog is empty, cancelling fleet '+self.fid)
+            cancel_fleet(self.fid, region=self.region, terminate_instances=True)
+            self.cancelled = True 
+            self.capacity = 0 
+            self.history.append((now, backlog, 0))
+            return 0 
+
+        desired = self.desired_capacity(backlog)
+
+        if desired>self.capacity and now-self.last_change>=self.scale_up_cooldown: 
+            new_capacity = desired 
+        elif self.capacity-desired>self.hysteresis and now-self.last_change>=self.scale_down_cooldown and (self.had_work or now-self.started>=self.scale_down_cooldown): 
+            new_capacity = desired 
+        else: 
+            return self.capacity 
+
+        print('Backlog of '+str(backlog)+' tasks, resizing fleet '+self.fid+' from '+str(self.capacity)+' to '+str(new_capacity)+' instances')
+        modify_fleet_capacity(self.fid, new_capacity, region=self.region, terminate_excess=self.terminate_excess)
+        self.capacity = new_capacity 
+        self.last_change = now 
+        self.history.append((now, backlog, new_capacity))
+
+        return self.capacity 
+
+    def run(self, poll_interval=30): 
+        '''Call `step` every `poll_interval` seconds until the fleet is cancelled or `stop` is called'''
+        while not self.cancelled and not self.stopped: 
+            self.step()
+            if not self.cancelled: 
+                time.sleep(poll_interval)
+
+    def stop(self): 
+        '''Stop the `run` loop after the current step, the fleet is left at its current capacity'''
+        self.stopped = True 
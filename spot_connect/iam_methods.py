@@ -55,34 +55,46 @@ def get_security_group(client, spotid:str, enable_nfs:bool=False, enable_ds:bool
         sg = client.create_security_group(GroupName=spotid,          
                                           Description='SG for '+spotid)
         
+        # All the ingress rules are authorized in a single call 
+        ingress = []
+
         if enable_nfs:                                                     
             # Add NFS rules (port 2049) in order to connect an EFS instance 
-            client.authorize_security_group_ingress(GroupName=spotid,
-                                                    IpPermissions=[
-                                                            {'FromPort': 2049,
-                                                             'IpProtocol': 'tcp',
-                                                             'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
-                                                             'ToPort': 2049,
-                                                            }
-                                                    ])   
+            ingress.append({'FromPort': 2049,
+                            'IpProtocol': 'tcp',
+                            'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                            'ToPort': 2049,
+                            })
         
         if enable_ds:                                                      
-            # Add ingress & egress rules to enable datasync
             # Add HTTP and HTTPS rules (port 80 & 443) in order to connect to datasync agent
-            client.authorize_security_group_ingress(GroupName=spotid,
-                                                    IpPermissions=[
-                                                            {'FromPort': 80,
-                                                             'IpProtocol': 'tcp',
-                                                             'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
-                                                             'ToPort': 80,
-                                                            },
-                                                            {'FromPort': 443,
-                                                             'IpProtocol': 'tcp',
-                                                             'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
-                                                             'ToPort': 443,
-                                                            }                                        
-                                                    ])
+            ingress.append({'FromPort': 80,
+                            'IpProtocol': 'tcp',
+                            'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                            'ToPort': 80,
+                            })
+            ingress.append({'FromPort': 443,
+                            'IpProtocol': 'tcp',
+                            'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                            'ToPort': 443,
+                            })
 
+        # Define ingress rules OTHERWISE YOU WILL NOT BE ABLE TO CONNECT
+        if firewall_ingress_settings is not None:                                  
+            ingress.append({'FromPort': firewall_ingress_settings[1],
+                            'IpProtocol': firewall_ingress_settings[0],
+                            'IpRanges': [
+                                    {'CidrIp': firewall_ingress_settings[3],
+                                     'Description': 'ips'
+                                     },
+                                     ],
+                            'ToPort': firewall_ingress_settings[2],
+                            })
+
+        if len(ingress)>0: 
+            client.authorize_security_group_ingress(GroupId=sg['GroupId'], IpPermissions=ingress)
+
+        if enable_ds: 
             # Add HTTPS egress rules (port 443) in order to connect datasync agent instance to AWS 
             client.authorize_security_group_egress(GroupId=sg['GroupId'],  
                                                     IpPermissions=[
@@ -93,21 +105,6 @@ def get_security_group(client, spotid:str, enable_nfs:bool=False, enable_ds:bool
                                                             }                                        
                                                     ]) 
 
-        # Define ingress rules OTHERWISE YOU WILL NOT BE ABLE TO CONNECT
-        if firewall_ingress_settings is not None:                                  
-            client.authorize_security_group_ingress(GroupName=spotid,
-                                                    IpPermissions=[
-                                                            {'FromPort': firewall_ingress_settings[1],
-                                                             'IpProtocol': firewall_ingress_settings[0],
-                                                             'IpRanges': [
-                                                                     {'CidrIp': firewall_ingress_settings[3],
-                                                                      'Description': 'ips'
-                                                                      },
-                                                                      ],
-                                                            'ToPort': firewall_ingress_settings[2],
-                                                            }
-                                                    ])
-
         #if 'firewall_egress' in profile:
             # TODO : parameters for sg_egress and applplication to client.authorize_security_group_egress (Not necessary to establish a connection)
             #pass            
@@ -11,24 +11,26 @@ infrastructure using the spotted module.
 MIT License 2020
 '''
 
-import boto3, os
+import boto3, os, sys, math, shlex
 from path import Path 
 
 root = Path(os.path.dirname(os.path.abspath(__file__)))
 
 from spot_connect import sutils 
 from spot_connect import spotted 
-from spot_connect.sutils import genrs, load_profiles, split_workloads
-from spot_connect.bash_scripts import compose_s3_sync_script
-from spot_connect.fleet_methods import launch_spot_fleet, get_fleet_instances
+from spot_connect import tree_reduce 
+from spot_connect import s3_methods 
+from spot_connect.sutils import genrs, load_profiles, split_workloads, parse_transfer_size
+from spot_connect.bash_scripts import compose_parallel_s3_sync_script, compose_pool_runner_script, compose_tree_reduce_script
+from spot_connect.fleet_methods import launch_spot_fleet, get_fleet_instances, FleetAutoscaler
 from spot_connect.efs_methods import launch_efs
+from spot_connect.ec2_methods import get_instance_statuses, get_instances
+from spot_connect.job_methods import dispatch_scripts, stage_files, gather_files, JobSupervisor, map_on_instances
 
-import time
-from IPython.display import clear_output
+import time, threading
+from concurrent.futures import ThreadPoolExecutor
 
 
-# TODO : Add bash script to reduce spot fleet capacity. Or check that, if its going to reduce it to zero, to cancel it. 
-
 class InstanceManager:
     
     efs = None 
@@ -93,7 +95,8 @@ class InstanceManager:
                         username       :   str   = None,
                         filesystem     :   str   = None,
                         new_mount      :   bool  = False, 
-                        monitoring     :   bool  = False): 
+                        monitoring     :   bool  = False,
+                        launch_backend :   str   = 'spot_request'): 
         '''        
         Launch a spot instance and store it in the LinkAWS.instances dict attribute. 
         Default parameters are the same as for the spotted.SpotInstance Class. 
@@ -120,7 +123,8 @@ class InstanceManager:
                                         username=username,
                                         filesystem=filesystem,
                                         new_mount=new_mount,
-                                        monitoring=monitoring)
+                                        monitoring=monitoring,
+                                        launch_backend=launch_backend)
         self.instances[name] = instance
         
 
@@ -158,29 +162,46 @@ class InstanceManager:
         self.instances[instance_name].terminate()
 
 
-    def create_elastic_file_system(self, system_name, region):
-        '''Create an elastic file system with the given system name in the given region. If the file system already exists that one will be returned'''        
-        file_system = launch_efs(system_name, region=region)
+    def create_elastic_file_system(self, system_name, region, performance_mode=None, throughput_mode=None, provisioned_throughput=None):
+        '''
+        Create an elastic file system with the given system name in the given region. If the file system already exists that one will be returned. 
+        See efs_methods.launch_efs for the performance mode ("generalPurpose" or "maxIO") and throughput mode ("bursting", "provisioned" with provisioned_throughput in MiB/s, or "elastic")
+        '''        
+        file_system = launch_efs(system_name, region=region, performance_mode=performance_mode, throughput_mode=throughput_mode, provisioned_throughput=provisioned_throughput)
         return file_system
 
 
-    def instance_s3_transfer(self, source, dest, instance_profile, efs=None, instance_name=None):
+    def instance_s3_transfer(self, source, dest, instance_profile, efs=None, instance_name=None, n_workers=None, max_workers=8, bytes_per_worker=50e9, profile='t3.small',
+                             max_concurrent_requests=64, multipart_chunksize_mb=64, block=True, poll_interval=30, timeout=None):
         '''
-    	Will launch a new instance to transfer files from an S3 bucket to an instance or vice-versa. 
+    	Will launch new instances to transfer files from an S3 bucket to an instance folder (usually on the EFS) or vice-versa. 
+    	The top-level folders of the source are split between `n_workers` instances, balanced by size, and each instance syncs its share with tuned aws cli concurrency. 
     	The instance folder must include the home directory path such as "/home/ec2-user/<path>". 
     	If you do not know the home directory path for an instance use the link.LinkAWS.get_instance_home_directory() method.
-		The bucket must be of the format "s3://<bucket_name>"
+		The bucket must be of the format "s3://<bucket_name>" (optionally followed by a prefix). 
+		With block=True the progress is printed until the transfer completes, the instances are terminated and the final progress is returned (see s3_transfer_progress). 
+		Otherwise the transfer dict is returned right away, follow it with s3_transfer_progress, the instances shut down on their own after their sync. 
 		__________
 		parameters
 		- source : str. path to an instance folder (usually starts with "/home/ec2-user/") or bucket of the form s3://<bucket name>
 		- dest : str. path to an instance folder (usually starts with "/home/ec2-user/") or bucket of the form s3://<bucket name>
-		- efs : str. Name for the elastic file system to mount on the instance, if None will attempt to use default, if none has been set will prompt the user for continue. 
 		- instance_profile : str. instance profile to use for the instance, this is necessary to grant the instance access to S3. If None, default will be used. 
+		- efs : str. Name for the elastic file system to mount on the instance, if None will attempt to use default, if none has been set will prompt the user for continue. 
+		- instance_name : str. base name for the transfer instances 
+		- n_workers : int. number of instances to split the transfer across, if None one instance is used for every `bytes_per_worker` bytes in the source (up to `max_workers`)
+		- max_workers : int. maximum number of instances used when n_workers is None 
+		- bytes_per_worker : float. size of the source handled by each instance when n_workers is None 
+		- profile : str. profile of the transfer instances 
+		- max_concurrent_requests : int. number of concurrent requests of the aws cli on each instance 
+		- multipart_chunksize_mb : int. size of the multipart parts in MB 
+		- block : bool. if True, wait for the transfer to finish 
+		- poll_interval : float. number of seconds between progress reports when blocking 
+		- timeout : float. maximum number of seconds to wait when blocking, the instances are left running if it runs out 
         '''
         
         if efs is None:
             if self.efs is None:
-                answer = ('You have not specified an EFS, the instance will shut down after the sync and your data may not persist. Do you want to continue (Y)? ')
+                answer = input('You have not specified an EFS, the instance will shut down after the sync and your data may not persist. Do you want to continue (Y)? ')
                 if answer == "Y":
                     fs = None
                 else:
@@ -195,35 +216,157 @@ class InstanceManager:
             iname = 'downloader_'+didx
         else: 
             iname = instance_name
-            
-        self.instances[iname] = spotted.SpotInstance(iname, profile='t3.small', filesystem=fs, kp_dir=self.kp_dir, instance_profile=instance_profile)
-        
+
         # Check whether the s3 bucket is the source or destination 
         if 's3://' in source: 
-            instance_file_exists, instance_path, bucket_path = self.downloader.dir_exists(dest), dest, source 
+            instance_path, bucket_path = dest, source 
         elif 's3://' in dest:
-            instance_file_exists, instance_path, bucket_path = self.downloader.dir_exists(source), source, dest
+            instance_path, bucket_path = source, dest
         else:
             raise Exception('Either the source or dest must be an S3 bucket formatted as "s3://<bucket name>"')
 
-    	# First check if the instance path exists in the instance then check if the bucket exists in S3 
-        if not instance_file_exists:
-            raise Exception(instance_path+' does not exist on the instance')
-        else: 
-            s3 = boto3.resource('s3')
-            bucket_path_exists = s3.Bucket(bucket_path.replace('s3://','')) in s3.buckets.all()
-        if not bucket_path_exists:
+        bucket_name, _, bucket_prefix = bucket_path.replace('s3://','').partition('/')
+        try: 
+            boto3.client('s3').head_bucket(Bucket=bucket_name)
+        except Exception: 
             raise Exception(bucket_path+' was not found in S3')
 
-		# If both the bucket and instance path are OK we begin the sync 
-        else: 
-            command = compose_s3_sync_script(source, dest, instance_path, logfile=iname)
+        # The first instance checks the instance path (and measures it if it is the source) before the others are launched 
+        workers = [iname+'_0']
+        self.instances[workers[0]] = spotted.SpotInstance(workers[0], profile=profile, filesystem=fs, kp_dir=self.kp_dir, instance_profile=instance_profile)
+        first = self.instances[workers[0]]
 
-        self.instances[iname].run(command, cmd=True)
+        if not first.dir_exists(instance_path):
+            raise Exception(instance_path+' does not exist on the instance')
 
-        print('Files and directories from '+source+' are being is being synced to '+dest+' on the instance "'+iname+'"') 
-        print('The instance will be shutdown and terminated when the job is complete.')
-        print('Use the following to check progress: SpotInstance("'+iname+'").run("cat '+instance_path+'/'+iname+'.txt", cmd=True)')        
+        # Measure the top-level folders of the source, "" stands for the files directly under it 
+        sizes = {} 
+        if 's3://' in source: 
+            prefix = bucket_prefix.rstrip('/')+'/' if bucket_prefix!='' else ''
+            for obj in s3_methods.iter_s3_objects(bucket_name, prefix=prefix, delimiter='/', depth=1):
+                rest = obj.key[len(prefix):]
+                top = rest.split('/')[0] if '/' in rest else ''
+                sizes[top] = sizes.get(top, 0)+obj.size
+        else: 
+            command = 'cd '+shlex.quote(instance_path)+' && for f in * .[!.]*; do if [ -d "$f" ]; then du -sb -- "$f"; elif [ -f "$f" ]; then stat --printf "%s\\t\\n" -- "$f"; fi; done'
+            output = first.run(command, cmd=True, return_output=True)
+            for line in output.splitlines():
+                if '\t' not in line: 
+                    continue
+                size, top = line.split('\t', 1)
+                sizes[top] = sizes.get(top, 0)+int(size)
+
+        total_bytes = sum(sizes.values())
+
+        if n_workers is None: 
+            n_workers = min(max_workers, max(1, int(math.ceil(total_bytes/bytes_per_worker))))
+        n_workers = max(1, min(n_workers, len(sizes)))
+        if fs is None and n_workers>1: 
+            print('Without an EFS the instances cannot share the instance folder, using a single instance')
+            n_workers = 1 
+
+        # Assign the largest folders first, each to the least loaded worker 
+        shares = [{'prefixes': [], 'sizes': [], 'bytes': 0} for _ in range(n_workers)]
+        for top in sorted(sizes, key=lambda t: -sizes[t]): 
+            share = min(shares, key=lambda s: s['bytes'])
+            share['prefixes'].append(top)
+            share['sizes'].append(sizes[top])
+            share['bytes'] += sizes[top]
+
+        workers += [iname+'_'+str(i) for i in range(1, n_workers)]
+        if n_workers>1: 
+            with ThreadPoolExecutor(max_workers=n_workers-1) as executor: 
+                launched = executor.map(lambda name: spotted.SpotInstance(name, profile=profile, filesystem=fs, kp_dir=self.kp_dir, instance_profile=instance_profile), workers[1:])
+                for name, instance in zip(workers[1:], launched): 
+                    self.instances[name] = instance
+
+        scripts = [compose_parallel_s3_sync_script(source, dest, share['prefixes'], max_concurrent_requests=max_concurrent_requests, multipart_chunksize_mb=multipart_chunksize_mb) for share in shares]
+        handles = dispatch_scripts([self.instances[name].instance for name in workers], scripts, first.profile['username'], kp_dir=self.kp_dir)
+
+        transfer = {'source': source, 'dest': dest, 'bytes_total': total_bytes, 'started': time.time(), 'workers': []} 
+        for name, share, handle in zip(workers, shares, handles): 
+            transfer['workers'].append({'name': name, 'handle': handle, 'prefixes': share['prefixes'], 'sizes': share['sizes'], 'bytes_total': share['bytes']})
+
+        print('Syncing '+str(round(total_bytes/1e9, 2))+' GB from '+source+' to '+dest+' with '+str(n_workers)+' instances ('+', '.join(workers)+')')
+
+        if not block: 
+            print('The instances will be shutdown and terminated when the job is complete, use s3_transfer_progress(<transfer>) to check the progress.')
+            return transfer 
+
+        st = time.time()
+        progress = self.s3_transfer_progress(transfer)
+        while not progress['finished']: 
+            print('Transferred '+str(progress['objects_done'])+' objects, '+str(round(progress['bytes_done']/1e9, 2))+'/'+str(round(progress['bytes_total']/1e9, 2))+' GB ('+str(round(progress['rate']/1e6, 1))+' MB/s)', flush=True)
+            if timeout is not None and time.time()-st>timeout: 
+                print('Timed out, the transfer instances were left running')
+                return progress 
+            time.sleep(poll_interval)
+            progress = self.s3_transfer_progress(transfer)
+
+        for name in workers: 
+            self.terminate(name)
+
+        print('Transfer complete: '+str(progress['objects_done'])+' objects, '+str(round(progress['bytes_done']/1e9, 2))+' GB in '+str(round(progress['seconds']))+'s ('+str(round(progress['rate']/1e6, 1))+' MB/s), '
+              +str(len([w for w in progress['workers'] if w['status']!='succeeded']))+' instances failed')
+
+        return progress 
+
+
+    def s3_transfer_progress(self, transfer, unreachable_timeout=600): 
+        '''
+        Return the progress of a transfer started with instance_s3_transfer: a dict with the number of "objects_done", the "bytes_done" and "bytes_total", 
+        the average "rate" in bytes per second, the "seconds" since the start, whether it is "finished" and the progress of each of the "workers" 
+        ({"name", "status", "objects_done", "bytes_done", "bytes_total"}). Bytes are counted when a folder completes, plus the progress the aws cli reports for the current folder. 
+        Instances shut down on their own after their sync, so the last progress of a finished worker is kept and it is not contacted again. 
+        A worker that cannot be reached for `unreachable_timeout` seconds is reported as "lost" and counted as done. 
+        '''
+        def check(worker): 
+            handle = worker['handle']
+            last = worker.get('last')
+            if last is not None and last['status'] in ('succeeded', 'failed', 'lost'): 
+                return last 
+            if handle.error is not None: 
+                worker['last'] = {'name': worker['name'], 'status': 'failed', 'objects_done': 0, 'bytes_done': 0, 'bytes_total': worker['bytes_total']}
+                return worker['last']
+            try: 
+                status = handle.status()
+                output_file = shlex.quote(handle.job_dir+'/output.txt')
+                _, output = handle.command("grep -cE '^(upload|download|copy): ' "+output_file+"; grep -c '^### done' "+output_file+"; tail -c 4000 "+output_file+" | tr '\\r' '\\n' | grep '^Completed' | tail -n 1")
+            except Exception: 
+                worker.setdefault('unreachable_since', time.time())
+                status = 'lost' if time.time()-worker['unreachable_since']>unreachable_timeout else 'unreachable'
+                previous = last if last is not None else {'objects_done': 0, 'bytes_done': 0}
+                worker['last'] = {'name': worker['name'], 'status': status, 'objects_done': previous['objects_done'], 'bytes_done': previous['bytes_done'], 'bytes_total': worker['bytes_total']}
+                return worker['last']
+            worker.pop('unreachable_since', None)
+
+            lines = output.splitlines()+['', '', '']
+            objects_done = int(lines[0]) if lines[0].strip().isdigit() else 0
+            folders_done = int(lines[1]) if lines[1].strip().isdigit() else 0
+            bytes_done = sum(worker['sizes'][:folders_done])
+            if folders_done<len(worker['sizes']) and status=='running': 
+                bytes_done += parse_transfer_size(lines[2])
+            if status=='succeeded': 
+                bytes_done = worker['bytes_total']
+            if status not in ('running', 'succeeded'): 
+                status = 'failed'
+
+            worker['last'] = {'name': worker['name'], 'status': status, 'objects_done': objects_done, 'bytes_done': bytes_done, 'bytes_total': worker['bytes_total']}
+            return worker['last']
+
+        with ThreadPoolExecutor(max_workers=max(1, len(transfer['workers']))) as executor: 
+            workers = list(executor.map(check, transfer['workers']))
+
+        seconds = time.time()-transfer['started']
+        bytes_done = sum(w['bytes_done'] for w in workers)
+
+        return {'objects_done': sum(w['objects_done'] for w in workers), 
+                'bytes_done': bytes_done, 
+                'bytes_total': transfer['bytes_total'], 
+                'rate': bytes_done/max(seconds, 1e-9), 
+                'seconds': seconds, 
+                'finished': all(w['status'] not in ('running', 'unreachable') for w in workers), 
+                'workers': workers}
         
         
     def split_workload(self, n_jobs, workload, wrkdir=None, filename=None): 
@@ -243,7 +386,9 @@ class InstanceManager:
                      kp_dir=None, 
                      enable_nfs=True,
                      enable_ds=True,
-                     return_fid=False):
+                     return_fid=False,
+                     scratch=None,
+                     volumes=None):
         '''
         Launch a spot fleet and store it in the LinkAWS.fleets dict attribute. 
         Each item has as the key a fleet id and as the value a dictionary the key 'instances' with its respective instances and the key 'name' if a name was submitted. 
@@ -275,7 +420,9 @@ class InstanceManager:
                                      availability_zone=availability_zone,
                                      kp_dir=kp_dir,
                                      enable_nfs=enable_nfs,
-                                     enable_ds=enable_ds)        
+                                     enable_ds=enable_ds,
+                                     scratch=scratch,
+                                     volumes=volumes)        
         # Get the request id for the fleet 
         spot_fleet_req_id = response['SpotFleetRequestId']
 
@@ -286,6 +433,7 @@ class InstanceManager:
         self.fleets[spot_fleet_req_id] = {}        
         self.fleets[spot_fleet_req_id]['instances'] = fleet_instances['ActiveInstances']
         self.fleets[spot_fleet_req_id]['region'] = profile['region']
+        self.fleets[spot_fleet_req_id]['profile'] = profile
         if name is not None: 
             self.fleets[spot_fleet_req_id]['name'] = name
     
@@ -301,40 +449,99 @@ class InstanceManager:
                 self.fleets[fleet_id]['instances'] = get_fleet_instances(fleet_id, self.fleets[fleet_id]['region'])
             else: 
                 self.fleets[fleet_id]['instances'] = get_fleet_instances(fleet_id, region)
-        for fleet in self.fleets: 
-            if region is None: 
-                self.fleets[fleet]['instances'] = get_fleet_instances(fleet, self.fleets[fleet]['region'])
-            else: 
-                self.fleets[fleet_id]['instances'] = get_fleet_instances(fleet_id, region)
+                self.fleets[fleet_id]['region'] = region
+        else: 
+            for fleet in self.fleets: 
+                if region is None: 
+                    self.fleets[fleet]['instances'] = get_fleet_instances(fleet, self.fleets[fleet]['region'])
+                else: 
+                    self.fleets[fleet]['instances'] = get_fleet_instances(fleet, region)
+
+
+    def autoscale_fleet(self, fid, backlog, region=None, poll_interval=30, block=False, **kwargs): 
+        '''
+        Keep the fleet's target capacity matched to a backlog of work, growing and shrinking the fleet and cancelling it when the backlog is empty. 
+        The autoscaler is stored under self.fleets[fid]['autoscaler'] and returned, call its `stop` method to stop resizing the fleet. 
+        If the background thread fails, the exception is printed and stored in the autoscaler's `error` attribute. 
+        For the scaling options (tasks_per_instance, min_capacity, max_capacity, cool-downs, hysteresis, cancel_at_zero) use: help(spot_connect.fleet_methods.FleetAutoscaler)
+        __________
+        parameters
+        - fid : str. spot fleet request ID 
+        - backlog : callable, queue or list. remaining work, either a function returning the number of tasks or a queue/list of tasks 
+        - region : str. region of the fleet, if None the region stored in self.fleets is used 
+        - poll_interval : int. number of seconds between each check of the backlog 
+        - block : bool. if True, run the autoscaler in the current thread until the fleet is cancelled, otherwise run it in a background thread 
+        '''
+        if region is None: 
+            if fid not in self.fleets: 
+                raise Exception('Fleet '+fid+' was not launched by this manager, submit its region')
+            region = self.fleets[fid]['region']
+
+        autoscaler = FleetAutoscaler(fid, backlog, region=region, **kwargs)
+
+        if fid not in self.fleets: 
+            self.fleets[fid] = {'region': region}
+        self.fleets[fid]['autoscaler'] = autoscaler
+
+        def run(): 
+            try: 
+                autoscaler.run(poll_interval=poll_interval)
+            except Exception as e: 
+                # Exceptions of a daemon thread are lost, keep it on the autoscaler so the caller can check why it stopped 
+                autoscaler.error = e 
+                print('Autoscaler of fleet '+fid+' stopped: '+str(e), file=sys.stderr, flush=True)
+
+        if block: 
+            autoscaler.run(poll_interval=poll_interval)
+        else: 
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
 
+        return autoscaler
 
-    def run_distributed_jobs(self, account_number, prefix, n_jobs, profile, availability_zone=None, user_data=None, instance_profile=''):
+
+    def run_distributed_jobs(self, account_number, prefix, n_jobs, profile, availability_zone=None, user_data=None, instance_profile='', workload=None, function=None, use_pool=True, 
+                             processes=None, memory_per_task=None, path=None, python='python3', output_dir='.spot_connect/results', wrkdir=None, timeout=900, max_parallel=16):
         '''
-        Distribute scripts and workloads across a given number of instances with a given profile
+        Distribute scripts and workloads across a given number of instances with a given profile. 
+        If a workload is submitted, it is split into `n_jobs` shards processed by the pool_runner on every core of `n_jobs` fleet instances, see run_sloppy_distributed_jobs 
+        (the report it returns is returned). Otherwise a fleet of one instance is launched for each job with its user data. 
         __________
         parameters
         - prefix : str. Name given to each instance of fleet 
         - n_jobs : int. Number of different instances to launch (if use_fleet=True, fleet will request this number of instances).
-        - scripts : list. List of scripts formatted as strings (not filenames, the actual bash scripts with new line delimiters), note len(scripts) == n_jobs
         - profile : str. The name of the profile to use for the instances.
         - user_data : list. len(user_data) == n_jobs
+        - workload : list. items to process, see run_distributed_workload 
+        - function : str. function applied to each item as "module:function" 
+        - use_pool : bool, default True. if True, each shard runs on a process per logical CPU of its instance, otherwise in a single process 
+        - processes, memory_per_task, path, python, output_dir, wrkdir : pool_runner settings, see run_distributed_workload 
+        - timeout : int. maximum number of seconds to wait for the instances 
+        - max_parallel : int. maximum number of instances to connect to at the same time 
         '''
+        assert account_number is not None 
+
+        if workload is not None: 
+            region = sutils.load_profiles()[profile]['region']
+            return self.run_sloppy_distributed_jobs(account_number, prefix, n_jobs, profile, region, workload=workload, function=function, use_pool=use_pool, processes=processes, 
+                                                    memory_per_task=memory_per_task, path=path, python=python, output_dir=output_dir, wrkdir=wrkdir, instance_profile=instance_profile, 
+                                                    availability_zone=availability_zone, timeout=timeout, max_parallel=max_parallel)
+
         if user_data is not None: 
             assert type(user_data)==list
             assert len(user_data)==n_jobs                            
         
         for nn in range(n_jobs): 
             # Launch the spot fleet 
-            assert account_number is not None 
             if user_data is None: 
-                self.launch_fleet(account_number, 1, profile, name=prefix, instance_profile=instance_profile, availabilty_zone=availability_zone, monitoring=True, kp_dir=self.kp_dir)                    
+                self.launch_fleet(account_number, 1, profile, name=prefix, instance_profile=instance_profile, availability_zone=availability_zone, monitoring=True, kp_dir=self.kp_dir)                    
             else:
-                self.launch_fleet(account_number, 1, profile, name=prefix, user_data=user_data[nn], instance_profile=instance_profile, availabilty_zone=availability_zone, monitoring=True, kp_dir=self.kp_dir)    
+                self.launch_fleet(account_number, 1, profile, name=prefix, user_data=user_data[nn], instance_profile=instance_profile, availability_zone=availability_zone, monitoring=True, kp_dir=self.kp_dir)    
 
 
-    def setup_fleet(self, account_number, prefix, n_jobs, profile, instance_profile='', return_fid=True): 
+    def setup_fleet(self, account_number, prefix, n_jobs, profile, instance_profile='', return_fid=True, availability_zone=None): 
         assert account_number is not None
-        fid = self.launch_fleet(account_number, n_jobs, profile, name=prefix, instance_profile=instance_profile, monitoring=True, kp_dir=self.kp_dir, return_fid=return_fid)
+        fid = self.launch_fleet(account_number, n_jobs, profile, name=prefix, instance_profile=instance_profile, availability_zone=availability_zone, monitoring=True, kp_dir=self.kp_dir, return_fid=return_fid)
         return fid
 
     def get_fleet_iids(self, fid=None, region=None):
@@ -352,22 +559,421 @@ class InstanceManager:
         
         return fleet_instances
     
-    def distribute_scripts_on_instances(self, instance_ids, scripts):        
-        for inum, iid in enumerate(instance_ids): 
-            clear_output()
-            self.launch_instance(iid, instance_id=True, scripts=[scripts[inum]])
-                        
+    def distribute_scripts_on_instances(self, instance_ids, scripts, fid=None, region=None, username=None, max_parallel=16):        
+        '''
+        Start one script per instance, in parallel, and return a list of job_methods.ScriptHandle objects to poll the status and output of each script. 
+        Scripts run detached on the instances so this returns as soon as every script has started. Extra instances or scripts are left unused. 
+        __________
+        parameters
+        - instance_ids : list of str. IDs of the instances to run the scripts on 
+        - scripts : list of str. scripts (or paths to script files) to run, scripts[i] runs on instance_ids[i] 
+        - fid : str. spot fleet request ID the instances belong to, the fleet's region and profile are re-used for the connection 
+        - region : str. region of the instances, required if fid is None 
+        - username : str. SSH username for the instances, defaults to the fleet profile username or "ec2-user" 
+        - max_parallel : int. maximum number of instances to connect to at the same time 
+        '''
+        if fid is not None: 
+            if region is None: 
+                region = self.fleets[fid]['region']
+            if username is None and 'profile' in self.fleets[fid]: 
+                username = self.fleets[fid]['profile']['username']
+        if region is None: 
+            raise Exception('Either the fid or the region must be submitted')
+        if username is None: 
+            username = 'ec2-user'
 
-    def run_sloppy_distributed_jobs(self, account_num, prefix, n_jobs, profile, region, scripts, instance_profile='', boot_wait_time=5):
-                
-        fid = self.setup_fleet(account_num, prefix, n_jobs, profile, instance_profile=instance_profile, return_fid=True)
+        instance_ids = list(instance_ids)[:len(scripts)]
+        instances = get_instances(instance_ids, region=region)
 
-        fleet_instances = [] 
-        while len(fleet_instances)==0: 
-            time.sleep(boot_wait_time)
+        return dispatch_scripts([instances[iid] for iid in instance_ids], scripts, username, kp_dir=self.kp_dir, max_parallel=max_parallel)
 
-            fleet_instances = self.get_fleet_iids(fid=fid, region=region)
-            fleet_instances = fleet_instances[fid]
 
-        self.distribute_scripts_on_instances(fleet_instances,
-                                             scripts)                                   
\ No newline at end of file
+    def wait_for_fleet(self, fid, n_instances, on_ready=None, region=None, timeout=900, poll_interval=5):
+        '''
+        Wait until `n_instances` instances of the fleet have passed their status checks or until the timeout runs out. 
+        Status checks for every instance in the fleet are retrieved with batched describe_instance_status calls and 
+        `on_ready` is called with the instance ID the moment each instance is ready so work can be streamed to instances as they come up. 
+        Returns a dictionary with the "ready" instance IDs, the "booting" instance IDs that had not passed their checks when the wait ended 
+        and the "unfilled" capacity (number of instances the fleet had not launched yet). 
+        __________
+        parameters
+        - fid : str. spot fleet request ID 
+        - n_instances : int. number of ready instances to wait for 
+        - on_ready : callable. function called with each instance ID as soon as it is ready 
+        - region : str. region of the fleet, if None the region stored in self.fleets is used 
+        - timeout : int. maximum number of seconds to wait 
+        - poll_interval : int. number of seconds between each check 
+        '''
+        if region is None: 
+            region = self.fleets[fid]['region']
+        client = boto3.client('ec2', region_name=region)
+
+        ready = [] 
+        booting = [] 
+        failed = [] 
+        st = time.time() 
+
+        sys.stdout.write('Waiting for '+str(n_instances)+' fleet instances...')
+        sys.stdout.flush() 
+
+        while len(ready)<n_instances: 
+            fleet_iids = self.get_fleet_iids(fid=fid, region=region)[fid]
+            statuses = get_instance_statuses([iid for iid in fleet_iids if iid not in ready], client=client)
+
+            booting = [] 
+            for iid in fleet_iids: 
+                if iid in ready: 
+                    continue
+                status = statuses.get(iid)
+                if status is not None and status['state']=='running' and status['instance_status']=='ok': 
+                    ready.append(iid)
+                    if on_ready is not None: 
+                        on_ready(iid)
+                elif status is not None and status['instance_status']=='impaired': 
+                    if iid not in failed: 
+                        failed.append(iid)
+                else: 
+                    booting.append(iid)
+
+            if len(ready)>=n_instances or time.time()-st>timeout: 
+                break
+
+            sys.stdout.write('.')
+            sys.stdout.flush() 
+            time.sleep(poll_interval)
+
+        unfilled = max(n_instances - len(ready) - len(booting) - len(failed), 0)
+        print('..'+str(len(ready))+' ready, '+str(len(booting))+' booting, '+str(len(failed))+' impaired, '+str(unfilled)+' unfilled')
+
+        return {'ready': ready, 'booting': booting, 'impaired': failed, 'unfilled': unfilled}
+
+
+    def supervise_jobs(self, fid, scripts, region=None, username=None, max_attempts=3, max_parallel=16, poll_interval=30, timeout=None, block=True, speculate=True, speculation_factor=2.0): 
+        '''
+        Run the scripts on the fleet's instances, one task per instance at a time, and keep a ledger of which instance runs each task. 
+        Instances that are terminated or interrupted are detected by polling their state and their unfinished tasks are re-queued onto 
+        surviving or replacement instances, every task is run at least once until it succeeds or uses up `max_attempts`. 
+        The supervisor is stored under self.fleets[fid]['supervisor'] and returned, its `ledger` attribute holds the tasks and their attempts. 
+        __________
+        parameters
+        - fid : str. spot fleet request ID 
+        - scripts : list of str. the tasks to run, one script per task 
+        - region : str. region of the fleet, if None the region stored in self.fleets is used 
+        - username : str. SSH username for the instances, defaults to the fleet profile username or "ec2-user" 
+        - max_attempts : int. maximum number of attempts for each task 
+        - max_parallel : int. maximum number of instances to connect to at the same time 
+        - poll_interval : int. number of seconds between each check of the instances and tasks 
+        - timeout : int. stop supervising after this many seconds 
+        - block : bool. if True, supervise in the current thread until every task is done or failed, otherwise supervise in a background thread 
+        - speculate : bool. run duplicates of straggler tasks on idle instances and keep whichever finishes first 
+        - speculation_factor : float. a task is a straggler once it has run this many times the median task runtime 
+        '''
+        if region is None: 
+            region = self.fleets[fid]['region']
+        if username is None: 
+            username = self.fleets.get(fid, {}).get('profile', {}).get('username', 'ec2-user')
+
+        supervisor = JobSupervisor(scripts, 
+                                   lambda: self.get_fleet_iids(fid=fid, region=region)[fid], 
+                                   region, 
+                                   user_name=username, 
+                                   kp_dir=self.kp_dir, 
+                                   max_attempts=max_attempts, 
+                                   max_parallel=max_parallel,
+                                   speculate=speculate,
+                                   speculation_factor=speculation_factor)
+        self.fleets[fid]['supervisor'] = supervisor
+
+        if block: 
+            supervisor.run(poll_interval=poll_interval, timeout=timeout)
+        else: 
+            thread = threading.Thread(target=supervisor.run, kwargs={'poll_interval': poll_interval, 'timeout': timeout}, daemon=True)
+            thread.start()
+
+        return supervisor
+
+
+    def map(self, func, iterable, fid=None, instance_ids=None, region=None, username=None, chunksize=1, retries=2, prefetch=2, python='python3', return_index=False): 
+        '''
+        Apply `func` to every item of `iterable` on the instances of a fleet (or a list of instances) and return an iterator over the results in completion order. 
+        Batches of `chunksize` items are serialized, sent over pooled SSH connections and run by a small worker agent on each instance. 
+        For the details on serialization, backpressure and retries use: help(spot_connect.job_methods.map_on_instances)
+
+            results = list(manager.map(score_model, parameter_grid, fid=fid, chunksize=10))
+        __________
+        parameters
+        - func : callable. function applied to each item 
+        - iterable : iterable. items to process 
+        - fid : str. spot fleet request ID whose active instances run the work 
+        - instance_ids : list of str. instances to run the work on if no fid is submitted 
+        - region : str. region of the instances, if None the fleet region is used 
+        - username : str. SSH username for the instances, defaults to the fleet profile username or "ec2-user" 
+        - chunksize : int. number of items sent to an instance at once 
+        - retries : int. number of times a failed batch is retried 
+        - prefetch : int. number of batches queued per instance 
+        - python : str. python executable on the instances 
+        - return_index : bool. if True, yield (index, result) tuples 
+        '''
+        if fid is not None: 
+            if region is None: 
+                region = self.fleets[fid]['region']
+            if username is None: 
+                username = self.fleets[fid].get('profile', {}).get('username')
+            instance_ids = self.get_fleet_iids(fid=fid, region=region)[fid]
+        if instance_ids is None or region is None: 
+            raise Exception('Submit a fid or both instance_ids and region')
+        if username is None: 
+            username = 'ec2-user'
+
+        instances = [instance for instance in get_instances(instance_ids, region=region).values() if instance['State']['Name']=='running']
+        if len(instances)==0: 
+            raise Exception('No running instances to map over')
+
+        return map_on_instances(func, iterable, instances, username, kp_dir=self.kp_dir, chunksize=chunksize, retries=retries, prefetch=prefetch, python=python, return_index=return_index)
+
+
+    def gather(self, remote_glob, local_dir, fid=None, instance_ids=None, region=None, username=None, max_parallel=16, skip_existing=True):
+        '''
+        Download the files matching a glob pattern from every running instance of a fleet (or a list of instances) in parallel.
+        The files from each instance are saved in <local_dir>/<instance id>/. Returns a summary with the totals and the failures.
+        For the details use: help(spot_connect.job_methods.gather_files)
+
+            summary = manager.gather('results/*.pickle', 'results', fid=fid)
+        __________
+        parameters
+        - remote_glob : str. glob pattern of the files to download on the instances, "**" matches nested directories
+        - local_dir : str. local directory to download the files to
+        - fid : str. spot fleet request ID whose active instances hold the files
+        - instance_ids : list of str. instances to download from if no fid is submitted
+        - region : str. region of the instances, if None the fleet region is used
+        - username : str. SSH username for the instances, defaults to the fleet profile username or "ec2-user"
+        - max_parallel : int. maximum number of instances to download from at the same time
+        - skip_existing : bool. if True, files already downloaded with the same size are skipped
+        '''
+        if fid is not None:
+            if region is None:
+                region = self.fleets[fid]['region']
+            if username is None:
+                username = self.fleets[fid].get('profile', {}).get('username')
+            instance_ids = self.get_fleet_iids(fid=fid, region=region)[fid]
+        if instance_ids is None or region is None:
+            raise Exception('Submit a fid or both instance_ids and region')
+        if username is None:
+            username = 'ec2-user'
+
+        instances = [instance for instance in get_instances(instance_ids, region=region).values() if instance['State']['Name']=='running']
+
+        summary = gather_files(instances, remote_glob, local_dir, username, kp_dir=self.kp_dir, max_parallel=max_parallel, skip_existing=skip_existing)
+
+        print('Downloaded '+str(summary['files'])+' files ('+str(round(summary['bytes']/1e6, 1))+' MB) from '+str(summary['instances'])+' instances in '+str(round(summary['seconds'], 1))+'s, '
+              +str(summary['skipped'])+' skipped, '+str(len(summary['failed_instances']))+' instances and '+str(sum(len(f) for f in summary['failed_files'].values()))+' files failed')
+
+        return summary
+
+
+    def prepare_workload(self, workload, function, n_shards, name, output_dir='.spot_connect/results', use_pool=True, processes=None, memory_per_task=None, path=None, python='python3', wrkdir=None): 
+        '''
+        Split a workload into `n_shards` pickle files and compose the pool_runner script of each shard. 
+        Returns the directory the files must be uploaded to on the instances, the local files to upload for each shard (the shard and pool_runner.py) and the script of each shard. 
+        For the parameters see run_distributed_workload. 
+        '''
+        if not use_pool: 
+            processes = 1 
+
+        shard_files = split_workloads(n_shards, workload, wrkdir=wrkdir, filename=name)
+
+        remote_dir = '.spot_connect/workloads/'+name
+        runner = os.path.join(sutils.pull_root(), 'pool_runner.py')
+
+        scripts = [] 
+        for shard_num, shard in enumerate(shard_files): 
+            scripts.append(compose_pool_runner_script(remote_dir+'/'+os.path.split(shard)[-1], 
+                                                      function, 
+                                                      output_dir+'/'+name+'_'+str(shard_num), 
+                                                      runner_path=remote_dir+'/pool_runner.py', 
+                                                      processes=processes, 
+                                                      memory_per_task=memory_per_task, 
+                                                      path=path, 
+                                                      python=python))
+
+        return remote_dir, [[shard, runner] for shard in shard_files], scripts 
+
+
+    def run_distributed_workload(self, fid, workload, function, output_dir='.spot_connect/results', name=None, region=None, username=None, use_pool=True, processes=None, memory_per_task=None, path=None, python='python3', wrkdir=None, max_parallel=16): 
+        '''
+        Split a workload across the active instances of a fleet and process each shard with the pool_runner, which runs the function on every core of the instance. 
+        Each shard writes its per-worker results and a manifest.json to <output_dir>/<name>_<shard number>. Returns the job_methods.ScriptHandle of each shard. 
+        The function's module must be importable on the instances (e.g. a repo cloned on the EFS, see the `path` parameter). 
+        __________
+        parameters
+        - fid : str. spot fleet request ID 
+        - workload : list. items to process 
+        - function : str. function applied to each item as "module:function" 
+        - output_dir : str. directory on the instances (or EFS) for the results 
+        - name : str. name of the job, used for the shard files and result folders, a random name is used if None 
+        - region : str. region of the fleet, if None the region stored in self.fleets is used 
+        - username : str. SSH username for the instances, defaults to the fleet profile username or "ec2-user" 
+        - use_pool : bool. if True, use a process per logical CPU on each instance, otherwise run each shard in a single process 
+        - processes : int. number of processes per instance, defaults to the logical CPU count 
+        - memory_per_task : float. estimated memory per process in MB, caps the number of processes to avoid running out of memory 
+        - path : str. directory on the instances added to the python path to import the function's module 
+        - python : str. python executable on the instances 
+        - wrkdir : str. local directory to save the shard files in, see sutils.split_workloads 
+        - max_parallel : int. maximum number of instances to connect to at the same time 
+        '''
+        if region is None: 
+            region = self.fleets[fid]['region']
+        if username is None: 
+            username = self.fleets[fid].get('profile', {}).get('username', 'ec2-user')
+        if name is None: 
+            name = 'workload_'+genrs(length=4)
+
+        instance_ids = self.get_fleet_iids(fid=fid, region=region)[fid]
+        instances = [instance for instance in get_instances(instance_ids, region=region).values() if instance['State']['Name']=='running']
+        if len(instances)==0: 
+            raise Exception('No running instances in fleet '+fid)
+
+        remote_dir, files, scripts = self.prepare_workload(workload, function, len(instances), name, output_dir=output_dir, use_pool=use_pool, processes=processes, 
+                                                           memory_per_task=memory_per_task, path=path, python=python, wrkdir=wrkdir)
+        instances = instances[:len(scripts)]
+        errors = stage_files(instances, files, username, remote_dir=remote_dir, kp_dir=self.kp_dir, max_parallel=max_parallel)
+
+        staged = [i for i in range(len(instances)) if errors[i] is None]
+        if len(staged)<len(instances): 
+            print(str(len(instances)-len(staged))+' shards could not be uploaded and were not started')
+
+        return dispatch_scripts([instances[i] for i in staged], [scripts[i] for i in staged], username, kp_dir=self.kp_dir, max_parallel=max_parallel)
+
+
+    def reduce_results(self, directory, combiner, output, fid=None, region=None, username=None, pattern='*.pickle', fan_in=2, path=None, python='python3', timeout=3600, max_parallel=16):
+        '''
+        Merge the partial results in a directory into a single result with a combiner function, using the tree_reduce script.
+        If a fleet is submitted, every running instance of the fleet takes a rank and the partials are merged hierarchically on the shared directory (it must be on the EFS
+        mounted by all the instances) so only the final result is written by rank 0, returns the job_methods.ScriptHandle of each rank (rank 0 first).
+        Otherwise the directory is reduced locally and the result is returned.
+        For the results of `run_distributed_workload` use pattern="<name>_*/result_*.pickle".
+        __________
+        parameters
+        - directory : str. directory with the partial results, on the EFS if a fleet is used
+        - combiner : str or callable. function merging two partial results, as "module:function" (must be importable on the instances if a fleet is used) or a function for a local reduction
+        - output : str. path of the final result
+        - fid : str. spot fleet request ID, if None the reduction runs locally
+        - region : str. region of the fleet, if None the region stored in self.fleets is used
+        - username : str. SSH username for the instances, defaults to the fleet profile username or "ec2-user"
+        - pattern : str. glob pattern of the partial result files, relative to the directory
+        - fan_in : int. number of partials merged together at each level
+        - path : str. directory added to the python path to import the combiner's module
+        - python : str. python executable on the instances
+        - timeout : int. maximum number of seconds a rank waits for the partials of other ranks
+        - max_parallel : int. maximum number of instances to connect to at the same time
+        '''
+        if fid is None:
+            if isinstance(combiner, str):
+                combiner = tree_reduce.load_function(combiner, path)
+            return tree_reduce.tree_reduce_directory(directory, combiner, output=output, pattern=pattern, fan_in=fan_in)
+
+        if region is None:
+            region = self.fleets[fid]['region']
+        if username is None:
+            username = self.fleets[fid].get('profile', {}).get('username', 'ec2-user')
+
+        instance_ids = self.get_fleet_iids(fid=fid, region=region)[fid]
+        instances = [instance for instance in get_instances(instance_ids, region=region).values() if instance['State']['Name']=='running']
+        if len(instances)==0:
+            raise Exception('No running instances in fleet '+fid)
+
+        remote_dir = '.spot_connect/reducers'
+        reducer = os.path.join(sutils.pull_root(), 'tree_reduce.py')
+        errors = stage_files(instances, [[reducer] for _ in instances], username, remote_dir=remote_dir, kp_dir=self.kp_dir, max_parallel=max_parallel)
+        instances = [instances[i] for i in range(len(instances)) if errors[i] is None]
+        if len(instances)==0:
+            raise Exception('The reducer could not be uploaded to any instance of fleet '+fid)
+
+        # Every reduction exchanges its partials in its own work directory so stale partials of an earlier run are never merged 
+        run_id = time.strftime('%Y%m%d%H%M%S')+'_'+genrs(length=6)
+        scripts = [compose_tree_reduce_script(directory,
+                                              combiner,
+                                              output,
+                                              reducer_path=remote_dir+'/tree_reduce.py',
+                                              rank=rank,
+                                              world_size=len(instances),
+                                              run_id=run_id,
+                                              pattern=pattern,
+                                              fan_in=fan_in,
+                                              timeout=timeout,
+                                              path=path,
+                                              python=python) for rank in range(len(instances))]
+
+        return dispatch_scripts(instances, scripts, username, kp_dir=self.kp_dir, max_parallel=max_parallel)
+
+
+    def run_sloppy_distributed_jobs(self, account_num, prefix, n_jobs, profile, region, scripts=None, instance_profile='', boot_wait_time=5, timeout=900, max_parallel=16, 
+                                    workload=None, function=None, use_pool=True, processes=None, memory_per_task=None, path=None, python='python3', output_dir='.spot_connect/results', wrkdir=None, 
+                                    availability_zone=None):
+        '''
+        Launch a fleet of `n_jobs` instances and start one script on each instance as soon as the instance is ready. 
+        Instead of scripts, a workload can be submitted: it is split into `n_jobs` shards and each ready instance receives a shard, which the pool_runner processes 
+        on every core of the instance (one process per logical CPU unless use_pool is False). For the workload parameters see run_distributed_workload. 
+        The fleet is launched in `availability_zone` if one is submitted. 
+        A shard whose upload fails is handed to the next instance that becomes ready, or retried on the ready instances once the wait is over. 
+        Returns the fleet readiness report from `wait_for_fleet` with the job_methods.ScriptHandle of each started script under the "handles" key 
+        and the scripts that could not be dispatched under the "undispatched" key. 
+        '''
+        if workload is not None: 
+            if function is None: 
+                raise Exception('Submit the function applied to the workload items as "module:function"')
+            remote_dir, files, scripts = self.prepare_workload(workload, function, n_jobs, prefix, output_dir=output_dir, use_pool=use_pool, processes=processes, 
+                                                               memory_per_task=memory_per_task, path=path, python=python, wrkdir=wrkdir)
+        elif scripts is None: 
+            raise Exception('Submit either the scripts or a workload and function')
+
+        fid = self.setup_fleet(account_num, prefix, n_jobs, profile, instance_profile=instance_profile, return_fid=True, availability_zone=availability_zone)
+        username = self.fleets[fid].get('profile', {}).get('username', 'ec2-user')
+
+        pending = list(range(len(scripts)))
+        failures = {} 
+        dispatches = [] 
+        executor = ThreadPoolExecutor(max_workers=max_parallel)
+
+        def start(iid, job): 
+            if workload is not None: 
+                # The shard and the pool runner are uploaded to the instance before its script starts 
+                instance = get_instances([iid], region=region)[iid]
+                error = stage_files([instance], [files[job]], username, remote_dir=remote_dir, kp_dir=self.kp_dir)[0]
+                if error is not None: 
+                    failures.setdefault(job, set()).add(iid)
+                    pending.append(job)
+                    print('Could not upload shard '+str(job)+' to '+iid+': '+str(error))
+                    return []
+            return self.distribute_scripts_on_instances([iid], [scripts[job]], fid=fid, region=region)
+
+        def dispatch(iid): 
+            if len(pending)>0: 
+                dispatches.append(executor.submit(start, iid, pending.pop(0)))
+
+        report = self.wait_for_fleet(fid, n_jobs, on_ready=dispatch, region=region, timeout=timeout, poll_interval=boot_wait_time)
+        executor.shutdown(wait=True)
+
+        # Scripts whose upload failed were requeued, but no instance may have become ready after the failure. 
+        # Retry them on the instances that are already ready, each one on an instance it has not failed on yet 
+        ready = list(report['ready'])
+        for attempt in range(len(ready)): 
+            jobs = [] 
+            for i, job in enumerate(list(pending)): 
+                candidates = [iid for iid in ready if iid not in failures.get(job, ())]
+                if len(candidates)>0: 
+                    pending.remove(job)
+                    jobs.append((candidates[(attempt+i)%len(candidates)], job))
+            if len(jobs)==0: 
+                break
+            with ThreadPoolExecutor(max_workers=max_parallel) as retry: 
+                dispatches += [retry.submit(start, iid, job) for iid, job in jobs]
+
+        report['fid'] = fid 
+        report['handles'] = [handle for future in dispatches for handle in future.result()]
+        report['undispatched'] = [scripts[job] for job in pending]
+
+        if len(pending)>0: 
+            print(str(len(pending))+' scripts were not dispatched, fleet capacity was not filled in time or their upload failed on every ready instance')
+
+        return report
\ No newline at end of file
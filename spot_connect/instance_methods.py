@@ -12,9 +12,53 @@ the instance.
 MIT License 2020
 """
 
-import sys, boto3, os
+import sys, boto3, os, threading
 from spot_connect import ec2_methods, sutils, interactive
 
+# SSH clients that can be re-used across calls, keyed by (ip, username, key file, port)
+connection_pool = {}
+connection_lock = threading.Lock()
+
+
+def get_connection(instance, user_name, port=22, kp_dir=None):
+    '''
+    Return an open SSH client for the instance, re-using a pooled connection if one is still active. 
+    Pooled connections must not be closed by the caller, use close_connections instead. 
+    __________
+    parameters
+    - instance : dict. Response dictionary from ec2 instance describe_instances method 
+    - user_name : string. SSH username for accessing instance
+    - port : port to use to connect to the instance 
+    - kp_dir : string. directory with the private key files 
+    '''
+    if kp_dir is None: 
+        kp_dir = sutils.get_default_kp_dir()
+
+    key = (instance['PublicIpAddress'], user_name, os.path.join(kp_dir, instance['KeyName']), port)
+
+    with connection_lock: 
+        client = connection_pool.get(key)
+
+    if client is not None: 
+        transport = client.get_transport()
+        if transport is not None and transport.is_active(): 
+            return client 
+
+    client = ec2_methods.connect_to_instance(instance['PublicIpAddress'], key[2], username=user_name, port=port)
+
+    with connection_lock: 
+        connection_pool[key] = client
+
+    return client 
+
+
+def close_connections(): 
+    '''Close every pooled SSH connection'''
+    with connection_lock: 
+        for client in connection_pool.values(): 
+            client.close()
+        connection_pool.clear()
+
 def run_script(instance, user_name, script, cmd=False, port=22, kp_dir=None, return_output=False):
     '''
     Run a script on the the given instance 
@@ -58,6 +102,30 @@ def run_script(instance, user_name, script, cmd=False, port=22, kp_dir=None, ret
     else: return True
 
 
+def run_command(instance, user_name, command, port=22, kp_dir=None):
+    '''
+    Run a command on the instance over a pooled SSH connection and wait for it to finish. Returns the exit status and the combined stdout/stderr output. 
+    __________
+    parameters
+    - instance : dict. Response dictionary from ec2 instance describe_instances method 
+    - user_name : string. SSH username for accessing instance
+    - command : string. linux command to execute on the instance 
+    - port : port to use to connect to the instance 
+    - kp_dir : string. directory with the private key files 
+    '''
+    client = get_connection(instance, user_name, port=port, kp_dir=kp_dir)
+
+    session = client.get_transport().open_session()
+    session.set_combine_stderr(True)                                           # Combine the error message and output message channels
+    session.exec_command(command)
+
+    output = session.makefile().read().decode('utf-8', errors='replace')
+    exit_status = session.recv_exit_status()
+    session.close()
+
+    return exit_status, output
+
+
 def active_shell(instance, user_name, port=22, kp_dir=None): 
     '''
     Leave a shell active
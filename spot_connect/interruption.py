@@ -0,0 +1,277 @@
+"""
+Author: Carlos Valcarcel <carlos.d.valcarcel.w@gmail.com>
+
+This file is part of spot-connect
+
+Spot interruption handling - interruption.py:
+
+The interruption sub-module runs on the instance itself. It watches the
+instance metadata service for the two-minute spot interruption notice and the
+rebalance recommendation in a background thread and runs the registered hooks
+(flush a checkpoint, upload it to S3/EFS, release a task...) in priority order
+as soon as a notice arrives. It only depends on the standard library and does
+not care about the framework running the job:
+
+    handler = InterruptionHandler().start()
+    handler.register(save_checkpoint, priority=10)
+    handler.register(upload_checkpoint, priority=5)
+
+    for epoch in range(epochs):
+        for batch in loader:
+            if handler.interrupted:
+                handler.wait_for_hooks()
+                sys.exit(1)
+            train(batch)
+
+For Keras models use the keras_callback.SpotTermination callback.
+
+MIT License 2020
+"""
+
+import sys, time, json, datetime, threading
+import urllib.request, urllib.error
+
+
+class InterruptionWatcher:
+
+    endpoint        =   None
+    poll_interval   =   None
+    token_ttl       =   None
+    timeout         =   None
+    notice          =   None
+    rebalance       =   None
+
+    def __init__(self, endpoint='http://169.254.169.254', poll_interval=5, token_ttl=21600, timeout=2, on_notice=None):
+        '''
+        Background thread that polls the instance metadata service for a spot interruption notice and a rebalance recommendation.
+        The IMDSv2 session token is cached and only renewed when it is about to expire (or is rejected), falling back to IMDSv1 requests if no token can be obtained.
+        Check the `interrupted` property (or wait on the `event` attribute) to find out if the instance has been scheduled for interruption, the notice
+        (e.g. {"action": "terminate", "time": "2020-07-05T21:40:55Z"}) is stored in the `notice` attribute. The rebalance recommendation
+        (e.g. {"noticeTime": "2020-07-05T21:38:55Z"}) is stored in the `rebalance` attribute and sets `rebalance_event`.
+        __________
+        parameters
+        - endpoint : str. address of the instance metadata service, submit the address of a local HTTP server to test without an instance
+        - poll_interval : float. number of seconds between checks, AWS recommends checking every 5 seconds
+        - token_ttl : int. number of seconds the IMDSv2 token is valid for (max 21600)
+        - timeout : float. number of seconds to wait for the metadata service to answer
+        - on_notice : callable. function called from the watcher thread as on_notice(kind, notice) the first time each kind of notice ("interruption" or "rebalance") is seen
+        '''
+        self.endpoint = endpoint.rstrip('/')
+        self.poll_interval = poll_interval
+        self.token_ttl = token_ttl
+        self.timeout = timeout
+        self.on_notice = on_notice
+        self.notice = None
+        self.rebalance = None
+        self.event = threading.Event()
+        self.rebalance_event = threading.Event()
+        self.token = None
+        self.token_expires = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def interrupted(self):
+        '''True once an interruption notice has been received'''
+        return self.event.is_set()
+
+    def get_token(self):
+        '''
+        Return the cached IMDSv2 token, requesting a new one if it is missing or about to expire. Returns None if the service only supports IMDSv1 (or the
+        token request is blocked, e.g. by the hop limit), the failure is cached for `token_ttl` seconds so the following polls use IMDSv1 without waiting for the request again
+        '''
+        if time.time()<self.token_expires:
+            return self.token
+
+        request = urllib.request.Request(self.endpoint+'/latest/api/token', method='PUT', headers={'X-aws-ec2-metadata-token-ttl-seconds': str(self.token_ttl)})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                self.token = response.read().decode()
+                self.token_expires = time.time()+self.token_ttl-60
+        except (urllib.error.URLError, OSError):
+            self.token = None
+            self.token_expires = time.time()+self.token_ttl
+
+        return self.token
+
+    def get_metadata(self, path):
+        '''Return the (status code, body) of a metadata request, using the IMDSv2 token if there is one'''
+        for attempt in range(2):
+            token = self.get_token()
+            headers = {} if token is None else {'X-aws-ec2-metadata-token': token}
+            request = urllib.request.Request(self.endpoint+'/latest/meta-data/'+path, headers=headers)
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    return response.status, response.read().decode()
+            except urllib.error.HTTPError as e:
+                if e.code==401 and attempt==0:
+                    # The token expired or was revoked (or IMDSv2 is now required), get a new one and try again
+                    self.token = None
+                    self.token_expires = 0
+                    continue
+                return e.code, ''
+
+    def parse(self, body, key):
+        try:
+            return json.loads(body)
+        except ValueError:
+            return {key: body}
+
+    def check(self):
+        '''Check the metadata service once, set the flags of the notices received and return the interruption notice if there is one'''
+        if not self.rebalance_event.is_set():
+            status, body = self.get_metadata('events/recommendations/rebalance')
+            if status==200:
+                self.rebalance = self.parse(body, 'noticeTime')
+                self.rebalance_event.set()
+                if self.on_notice is not None:
+                    self.on_notice('rebalance', self.rebalance)
+
+        status, body = self.get_metadata('spot/instance-action')
+        if status==200:
+            self.notice = self.parse(body, 'action')
+            # Notify before setting the flag so the hooks are already running when the job sees it
+            if self.on_notice is not None:
+                self.on_notice('interruption', self.notice)
+            self.event.set()
+
+        return self.notice
+
+    def run(self):
+        while not self.stopped.is_set() and not self.event.is_set():
+            try:
+                self.check()
+            except (urllib.error.URLError, OSError):
+                pass
+            self.stopped.wait(self.poll_interval)
+
+    def start(self):
+        '''Start polling in a daemon thread'''
+        if self.thread is None or not self.thread.is_alive():
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stop polling'''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def seconds_until(timestamp):
+    '''Return the number of seconds until an ISO 8601 UTC timestamp from the metadata service (e.g. "2020-07-05T21:40:55Z"), or None if it cannot be parsed'''
+    try:
+        deadline = datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError):
+        return None
+    return (deadline-datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+
+class InterruptionHandler:
+
+    watcher     =   None
+    hooks       =   None
+    report      =   None
+
+    def __init__(self, watcher=None, endpoint='http://169.254.169.254', poll_interval=5, verbose=True):
+        '''
+        Run registered hooks as soon as the instance receives a spot interruption notice (or a rebalance recommendation, for the hooks registered for it).
+        Hooks run in a separate thread in priority order (highest first) and each one is timed, the results are added to the `report` attribute as
+        {"event", "hook", "priority", "seconds", "remaining", "error"} dicts where "remaining" is the number of seconds left before the interruption when the hook finished.
+        A hook that raises an exception does not stop the hooks after it.
+        __________
+        parameters
+        - watcher : InterruptionWatcher. watcher to use, a new one is created if None
+        - endpoint : str. address of the instance metadata service used by the new watcher
+        - poll_interval : float. number of seconds between checks of the new watcher
+        - verbose : bool. if True, print each hook's timing as it completes
+        '''
+        if watcher is None:
+            watcher = InterruptionWatcher(endpoint=endpoint, poll_interval=poll_interval)
+        watcher.on_notice = self.notify
+        self.watcher = watcher
+        self.verbose = verbose
+        self.hooks = []
+        self.report = []
+        self.lock = threading.Lock()
+        self.hook_threads = {}
+
+    @property
+    def interrupted(self):
+        '''True once an interruption notice has been received'''
+        return self.watcher.event.is_set()
+
+    @property
+    def notice(self):
+        return self.watcher.notice
+
+    def register(self, hook, priority=0, name=None, events=('interruption',)):
+        '''
+        Register a function to call (with no arguments) when a notice arrives. Returns the hook.
+        __________
+        parameters
+        - hook : callable. function to run
+        - priority : int. hooks with a higher priority run first
+        - name : str. name of the hook in the report, defaults to the function name
+        - events : tuple of str. notices that trigger the hook, "interruption" and/or "rebalance"
+        '''
+        if name is None:
+            name = getattr(hook, '__name__', repr(hook))
+        with self.lock:
+            self.hooks.append({'hook': hook, 'priority': priority, 'name': name, 'events': tuple(events)})
+        return hook
+
+    def notify(self, kind, notice):
+        '''Start running the hooks registered for a notice in a separate thread so the watcher keeps polling'''
+        with self.lock:
+            if kind in self.hook_threads:
+                return
+            self.hook_threads[kind] = threading.Thread(target=self.run_hooks, args=(kind, notice), daemon=True)
+            self.hook_threads[kind].start()
+
+    def run_hooks(self, kind='interruption', notice=None):
+        '''Run the hooks registered for a kind of notice in priority order and return their report entries'''
+        with self.lock:
+            hooks = sorted([h for h in self.hooks if kind in h['events']], key=lambda h: -h['priority'])
+
+        deadline = None
+        if notice is not None and kind=='interruption':
+            deadline = notice.get('time')
+
+        entries = []
+        for h in hooks:
+            st = time.time()
+            error = None
+            try:
+                h['hook']()
+            except Exception as e:
+                error = e
+            entry = {'event': kind, 'hook': h['name'], 'priority': h['priority'], 'seconds': time.time()-st, 'remaining': seconds_until(deadline), 'error': error}
+            entries.append(entry)
+            with self.lock:
+                self.report.append(entry)
+            if self.verbose:
+                print('Interruption hook '+h['name']+' took '+str(round(entry['seconds'], 2))+'s'+('' if error is None else ' and failed: '+str(error)), file=sys.stderr, flush=True)
+
+        return entries
+
+    def wait_for_hooks(self, timeout=None):
+        '''Wait until the hooks triggered by the interruption notice have finished running'''
+        thread = self.hook_threads.get('interruption')
+        if thread is not None:
+            thread.join(timeout)
+
+    def wait(self, timeout=None):
+        '''Block until an interruption notice arrives (or the timeout runs out) and return True if the instance is being interrupted'''
+        return self.watcher.event.wait(timeout)
+
+    def start(self):
+        '''Start watching for notices'''
+        self.watcher.start()
+        return self
+
+    def stop(self):
+        '''Stop watching for notices'''
+        self.watcher.stop()
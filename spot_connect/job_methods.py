@@ -0,0 +1,728 @@
+"""
+Author: Carlos Valcarcel <carlos.d.valcarcel.w@gmail.com>
+
+This file is part of spot-connect
+
+Toolbox for running distributed jobs - job_methods.py:
+
+The job_methods sub-module contains functions and classes to run scripts on
+many instances at once without waiting for them to finish. Scripts are started
+detached (nohup) and tracked through handles that can be polled for their
+status and output. A supervisor keeps track of which instance runs each task
+and re-runs the tasks lost to spot interruptions. Python functions can also be
+mapped over a set of instances with the map_worker agent.
+
+MIT License 2020
+"""
+
+import os, io, time, shlex, queue, pickle, threading, itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
+
+from spot_connect import sutils, instance_methods, ec2_methods
+
+
+class ScriptHandle:
+
+    instance    =   None
+    user_name   =   None
+    script      =   None
+    job_id      =   None
+    job_dir     =   None
+    pid         =   None
+    exit_code   =   None
+    started     =   None
+    finished    =   None
+    error       =   None
+
+    def __init__(self, instance, user_name, script, job_id=None, kp_dir=None, port=22):
+        '''
+        Handle for a script running detached on an instance. The script, its output, process ID and exit code are kept
+        in the ".spot_connect/jobs/<job_id>" folder of the instance home directory so the job can be checked from anywhere.
+        __________
+        parameters
+        - instance : dict. Response dictionary from ec2 instance describe_instances method
+        - user_name : str. SSH username for accessing instance
+        - script : str. bash script (commands separated by new lines) or path to a local script file
+        - job_id : str. unique identifier for the job, a random one is generated if None
+        - kp_dir : str. directory with the private key files
+        - port : int. port to use to connect to the instance
+        '''
+        self.instance = instance
+        self.user_name = user_name
+        self.kp_dir = kp_dir
+        self.port = port
+
+        if os.path.isfile(script):
+            script = open(script, 'r').read()
+        self.script = script.replace('\r', '')
+
+        if job_id is None:
+            job_id = sutils.genrs(length=8)
+        self.job_id = job_id
+        self.job_dir = '.spot_connect/jobs/'+job_id
+
+    def __repr__(self):
+        return 'ScriptHandle('+self.instance['InstanceId']+', '+self.job_id+')'
+
+    def command(self, command):
+        '''Run a command on the handle's instance and return its exit status and output'''
+        return instance_methods.run_command(self.instance, self.user_name, command, port=self.port, kp_dir=self.kp_dir)
+
+    def start(self):
+        '''Upload the script and launch it in the background, returns as soon as the script has started'''
+        job_dir = shlex.quote(self.job_dir)
+
+        self.command('mkdir -p '+job_dir)
+
+        client = instance_methods.get_connection(self.instance, self.user_name, port=self.port, kp_dir=self.kp_dir)
+        sftp = client.open_sftp()
+        with sftp.open(self.job_dir+'/script.sh', 'w') as f:
+            f.write(self.script)
+        sftp.close()
+
+        # setsid puts the job in its own process group so kill() can stop the whole script
+        # scripts can report their progress (a fraction between 0 and 1) by writing it to $SPOT_CONNECT_JOB_DIR/progress
+        # the exit code is written to a temporary file and renamed so status() never reads it half written
+        run = 'export SPOT_CONNECT_JOB_DIR=$HOME/'+job_dir+'; bash '+job_dir+'/script.sh > '+job_dir+'/output.txt 2>&1; echo $? > '+job_dir+'/exit_code.tmp; mv '+job_dir+'/exit_code.tmp '+job_dir+'/exit_code'
+        launch = 'setsid nohup bash -c '+shlex.quote(run)
+        launch += ' > /dev/null 2>&1 < /dev/null & echo $! > '+job_dir+'/pid && cat '+job_dir+'/pid'
+
+        exit_status, output = self.command(launch)
+        if exit_status!=0:
+            raise Exception('Failed to start job '+self.job_id+' on '+self.instance['InstanceId']+': '+output)
+
+        self.pid = int(output.strip())
+        self.started = time.time()
+
+        return self
+
+    def status(self):
+        '''Return the status of the script: "running", "succeeded", "failed" or "lost" (process gone without an exit code)'''
+        if self.exit_code is not None:
+            return 'succeeded' if self.exit_code==0 else 'failed'
+
+        job_dir = shlex.quote(self.job_dir)
+        check = 'if [ -f '+job_dir+'/exit_code ]; then cat '+job_dir+'/exit_code; '
+        check += 'elif kill -0 $(cat '+job_dir+'/pid) 2>/dev/null; then echo running; '
+        check += 'else cat '+job_dir+'/exit_code 2>/dev/null || echo lost; fi'
+
+        _, output = self.command(check)
+        output = output.strip()
+
+        if output=='running' or output=='lost':
+            return output
+        if not output.lstrip('-').isdigit():
+            # The exit code is still being written
+            return 'running'
+
+        self.exit_code = int(output)
+        self.finished = time.time()
+
+        return 'succeeded' if self.exit_code==0 else 'failed'
+
+    def output(self, tail=None):
+        '''Return the script output so far. If tail is submitted only the last `tail` lines are returned'''
+        if tail is None:
+            command = 'cat '+shlex.quote(self.job_dir+'/output.txt')
+        else:
+            command = 'tail -n '+str(int(tail))+' '+shlex.quote(self.job_dir+'/output.txt')
+        _, output = self.command(command)
+        return output
+
+    def progress(self):
+        '''Return the progress the script reported in $SPOT_CONNECT_JOB_DIR/progress as a float, or None if it has not reported any'''
+        _, output = self.command('cat '+shlex.quote(self.job_dir+'/progress')+' 2>/dev/null')
+        try:
+            return float(output.strip().split()[-1])
+        except (ValueError, IndexError):
+            return None
+
+    def kill(self):
+        '''Stop the script and every process it started'''
+        if self.pid is not None:
+            self.command('kill -- -'+str(self.pid)+' 2>/dev/null || kill '+str(self.pid)+' 2>/dev/null')
+
+    def wait(self, poll_interval=10, timeout=None):
+        '''Wait for the script to finish and return its final status'''
+        st = time.time()
+        status = self.status()
+        while status=='running':
+            if timeout is not None and time.time()-st>timeout:
+                break
+            time.sleep(poll_interval)
+            status = self.status()
+        return status
+
+
+def dispatch_scripts(instances, scripts, user_name, kp_dir=None, max_parallel=16, port=22, job_ids=None):
+    '''
+    Start one script per instance in parallel and return a list with a ScriptHandle for each script.
+    Scripts run detached so the call returns as soon as every script has started. Handles for scripts that failed to start have their `error` attribute set.
+    __________
+    parameters
+    - instances : list of dict. Instance descriptions from the describe_instances method
+    - scripts : list of str. Scripts to run, scripts[i] runs on instances[i]
+    - user_name : str. SSH username for accessing the instances
+    - kp_dir : str. directory with the private key files
+    - max_parallel : int. maximum number of instances to connect to at the same time
+    - port : int. port to use to connect to the instances
+    - job_ids : list of str. job ID for each script, random IDs are used if None
+    '''
+    if job_ids is None:
+        job_ids = [None]*len(scripts)
+
+    handles = [ScriptHandle(instance, user_name, script, job_id=job_id, kp_dir=kp_dir, port=port) for instance, script, job_id in zip(instances, scripts, job_ids)]
+
+    if len(handles)==0:
+        return handles
+
+    with ThreadPoolExecutor(max_workers=min(max_parallel, len(handles))) as executor:
+        futures = {executor.submit(handle.start): handle for handle in handles}
+        for future in as_completed(futures):
+            handle = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                handle.error = e
+                print('Failed to start script on '+handle.instance['InstanceId']+': '+str(e))
+
+    return handles
+
+
+def stage_files(instances, files, user_name, remote_dir='.', kp_dir=None, max_parallel=16, port=22):
+    '''
+    Upload files to many instances in parallel over the pooled SSH connections. Returns a list with None for each instance that succeeded or the exception raised.
+    __________
+    parameters
+    - instances : list of dict. Instance descriptions from the describe_instances method
+    - files : list of lists of str. local files to upload, files[i] are uploaded to instances[i]
+    - user_name : str. SSH username for the instances
+    - remote_dir : str. directory on the instances to upload the files to, it is created if it does not exist
+    - kp_dir : str. directory with the private key files
+    - max_parallel : int. maximum number of instances to upload to at the same time
+    - port : int. port to use to connect to the instances
+    '''
+    def upload(instance, instance_files):
+        try:
+            instance_methods.run_command(instance, user_name, 'mkdir -p '+shlex.quote(remote_dir), port=port, kp_dir=kp_dir)
+            client = instance_methods.get_connection(instance, user_name, port=port, kp_dir=kp_dir)
+            sftp = client.open_sftp()
+            for f in instance_files:
+                sftp.put(f, remote_dir+'/'+os.path.split(f)[-1])
+            sftp.close()
+            return None
+        except Exception as e:
+            print('Failed to upload files to '+instance['InstanceId']+': '+str(e))
+            return e
+
+    if len(instances)==0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_parallel, len(instances))) as executor:
+        return list(executor.map(upload, instances, files))
+
+
+def glob_base(remote_glob):
+    '''Return the leading directories of a glob pattern that contain no wildcards, the downloaded files keep their path relative to this directory'''
+    base = []
+    for part in remote_glob.split('/')[:-1]:
+        if any(c in part for c in '*?['):
+            break
+        base.append(part)
+    return '/'.join(base)
+
+
+def list_remote_files(instance, user_name, remote_glob, kp_dir=None, port=22):
+    '''
+    Expand a glob pattern on the instance with a single command and return the [(path, size), ...] of the matching files. Supports "**" to match nested directories.
+    Relative patterns are relative to the user's home directory.
+    '''
+    listing = 'for f in '+remote_glob+'; do if [ -f "$f" ]; then stat --printf "%s\\t%n\\n" -- "$f"; fi; done'
+    exit_status, output = instance_methods.run_command(instance, user_name, 'bash -O nullglob -O globstar -c '+shlex.quote(listing), port=port, kp_dir=kp_dir)
+    if exit_status!=0:
+        raise Exception('Could not list '+remote_glob+': '+output.strip())
+
+    files = []
+    for line in output.splitlines():
+        if '\t' in line:
+            size, path = line.split('\t', 1)
+            files.append((path, int(size)))
+
+    return files
+
+
+def gather_files(instances, remote_glob, local_dir, user_name, kp_dir=None, max_parallel=16, port=22, skip_existing=True):
+    '''
+    Download the files matching a glob pattern from many instances in parallel over the pooled SSH connections.
+    The pattern is expanded with one command per instance and the files of each instance are saved in <local_dir>/<instance id>/, keeping their path relative to the
+    fixed part of the pattern. Returns a summary dict with the total number of "files" and "bytes" downloaded, the number of files "skipped", the "seconds" it took,
+    the "failed_instances" ({instance id: error}) that could not be listed or connected to and the "failed_files" ({instance id: [(path, error), ...]}).
+    __________
+    parameters
+    - instances : list of dict. Instance descriptions from the describe_instances method
+    - remote_glob : str. glob pattern of the files to download, e.g. "results/*.pickle" or "/efs/output/**/*.csv"
+    - local_dir : str. local directory to download the files to
+    - user_name : str. SSH username for the instances
+    - kp_dir : str. directory with the private key files
+    - max_parallel : int. maximum number of instances to download from at the same time
+    - port : int. port to use to connect to the instances
+    - skip_existing : bool. if True, files that already exist locally with the same size are not downloaded again
+    '''
+    base = glob_base(remote_glob)
+    lock = threading.Lock()
+    summary = {'instances': len(instances), 'files': 0, 'bytes': 0, 'skipped': 0, 'seconds': 0, 'failed_instances': {}, 'failed_files': {}}
+
+    def download(instance):
+        iid = instance['InstanceId']
+        try:
+            files = list_remote_files(instance, user_name, remote_glob, kp_dir=kp_dir, port=port)
+            client = instance_methods.get_connection(instance, user_name, port=port, kp_dir=kp_dir)
+            sftp = client.open_sftp()
+        except Exception as e:
+            print('Failed to gather files from '+iid+': '+str(e))
+            with lock:
+                summary['failed_instances'][iid] = e
+            return
+
+        for path, size in files:
+            relative = os.path.relpath(path, base) if base!='' else path.lstrip('/')
+            if relative.startswith('..'):
+                relative = path.lstrip('/')
+            local_file = os.path.join(local_dir, iid, relative)
+            if skip_existing and os.path.exists(local_file) and os.path.getsize(local_file)==size:
+                with lock:
+                    summary['skipped'] += 1
+                continue
+            try:
+                os.makedirs(os.path.dirname(local_file), exist_ok=True)
+                sftp.get(path, local_file)
+                with lock:
+                    summary['files'] += 1
+                    summary['bytes'] += size
+            except Exception as e:
+                with lock:
+                    summary['failed_files'].setdefault(iid, []).append((path, e))
+        sftp.close()
+
+    st = time.time()
+    if len(instances)>0:
+        with ThreadPoolExecutor(max_workers=min(max_parallel, len(instances))) as executor:
+            list(executor.map(download, instances))
+    summary['seconds'] = time.time()-st
+
+    return summary
+
+
+class TaskLedger:
+
+    tasks       =   None
+
+    def __init__(self, scripts=None):
+        '''
+        Ledger of the tasks in a distributed job and the instances they were assigned to.
+        Each task is a dict with its "script", its "state" ("pending", "running", "done" or "failed"), the number of "attempts", the last reported "progress"
+        and the list of "assignments" (one dict per attempt with the "instance_id", the "handle" running the script and the "status" of the attempt).
+        A task can have more than one running attempt when a duplicate is launched for a straggler, the first attempt to succeed completes the task.
+        __________
+        parameters
+        - scripts : list of str. scripts to add to the ledger as pending tasks, the task IDs are the script positions in the list
+        '''
+        self.tasks = {}
+        if scripts is not None:
+            for script in scripts:
+                self.add(script)
+
+    def add(self, script, task_id=None):
+        '''Add a pending task to the ledger and return its ID'''
+        if task_id is None:
+            task_id = len(self.tasks)
+        self.tasks[task_id] = {'script': script, 'state': 'pending', 'attempts': 0, 'assignments': [], 'progress': None}
+        return task_id
+
+    def with_state(self, state):
+        '''Return the IDs of the tasks with the given state'''
+        return [task_id for task_id in self.tasks if self.tasks[task_id]['state']==state]
+
+    def running_assignments(self):
+        '''Return (task_id, assignment) tuples for every attempt that is still running'''
+        return [(task_id, assignment) for task_id in self.tasks for assignment in self.tasks[task_id]['assignments'] if assignment['status']=='running']
+
+    def busy_instances(self):
+        '''Return the IDs of the instances that are running an attempt'''
+        return set(assignment['instance_id'] for _, assignment in self.running_assignments())
+
+    def assign(self, task_id, instance_id, handle):
+        '''Record that an attempt of the task was started on the instance'''
+        task = self.tasks[task_id]
+        task['attempts'] += 1
+        task['state'] = 'running'
+        assignment = {'instance_id': instance_id, 'handle': handle, 'status': 'running', 'started': time.time(), 'finished': None}
+        task['assignments'].append(assignment)
+        return assignment
+
+    def finish(self, task_id, assignment, status, max_attempts=3):
+        '''
+        Record the final status of an attempt: "succeeded", "failed", "lost" or "cancelled". A task is only done once an attempt succeeded (at-least-once),
+        failed or lost attempts put the task back in the pending state until it has used up `max_attempts`.
+        '''
+        task = self.tasks[task_id]
+        assignment['status'] = status
+        assignment['finished'] = time.time()
+
+        if task['state']=='done':
+            return
+
+        if status=='succeeded':
+            task['state'] = 'done'
+        elif any(a['status']=='running' for a in task['assignments']):
+            task['state'] = 'running'
+        elif task['attempts']>=max_attempts:
+            task['state'] = 'failed'
+        else:
+            task['state'] = 'pending'
+
+    def runtimes(self):
+        '''Return the runtime in seconds of every successful attempt'''
+        return [a['finished']-a['started'] for task in self.tasks.values() for a in task['assignments'] if a['status']=='succeeded']
+
+    def complete(self):
+        '''True once every task is either done or failed'''
+        return all(task['state'] in ('done', 'failed') for task in self.tasks.values())
+
+    def summary(self):
+        '''Return the number of tasks in each state and the total number of attempts'''
+        summary = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+        for task in self.tasks.values():
+            summary[task['state']] += 1
+        summary['attempts'] = sum(task['attempts'] for task in self.tasks.values())
+        return summary
+
+
+class JobSupervisor:
+
+    ledger      =   None
+    region      =   None
+    dead        =   None
+
+    def __init__(self, scripts, instance_source, region, user_name='ec2-user', kp_dir=None, max_attempts=3, max_parallel=16, speculate=True, speculation_factor=2.0, min_runtimes=3):
+        '''
+        Run a list of tasks (scripts) on a changing set of instances, such as the instances of a spot fleet.
+        Each `step` polls the state of every instance with batched calls, re-queues the tasks of instances that were terminated or
+        interrupted, checks the running scripts and hands pending tasks to idle instances (surviving or replacement instances).
+        Tasks are run at least once, a task is only done when one of its attempts exits with code 0.
+        When `speculate` is True, instances left idle run a duplicate of the tasks that have been running much longer than the median task
+        runtime (stragglers). Whichever attempt finishes first completes the task and the other one is stopped. Scripts can report their progress
+        by writing a fraction to $SPOT_CONNECT_JOB_DIR/progress, which is used to tell slow tasks apart from long ones that are nearly done.
+        __________
+        parameters
+        - scripts : list of str. the tasks to run, one script per task
+        - instance_source : callable. function returning the list of instance IDs currently available, e.g. the active instances of a fleet
+        - region : str. region of the instances
+        - user_name : str. SSH username for the instances
+        - kp_dir : str. directory with the private key files
+        - max_attempts : int. maximum number of attempts for each task
+        - max_parallel : int. maximum number of instances to connect to at the same time
+        - speculate : bool. launch duplicates of straggler tasks on idle instances
+        - speculation_factor : float. a task is a straggler once its (estimated) runtime is this many times the median runtime
+        - min_runtimes : int. number of finished tasks needed before the median runtime is trusted for speculation
+        '''
+        self.ledger = TaskLedger(scripts)
+        self.speculate = speculate
+        self.speculation_factor = speculation_factor
+        self.min_runtimes = min_runtimes
+        self.instance_source = instance_source
+        self.region = region
+        self.user_name = user_name
+        self.kp_dir = kp_dir
+        self.max_attempts = max_attempts
+        self.max_parallel = max_parallel
+        self.dead = set()
+
+    def poll_instances(self):
+        '''Return the IDs of the usable instances and mark the instances that were terminated or interrupted as dead'''
+        available = list(self.instance_source())
+        tracked = set(available) | self.ledger.busy_instances()
+        statuses = ec2_methods.get_instance_statuses(list(tracked - self.dead), region=self.region)
+
+        ready = []
+        for iid in tracked - self.dead:
+            status = statuses.get(iid)
+            if status is None:
+                # Instances that have dropped out of the fleet and are no longer reported have been reclaimed
+                if iid not in available:
+                    self.dead.add(iid)
+            elif status['state'] in ('shutting-down', 'terminated', 'stopping', 'stopped'):
+                self.dead.add(iid)
+            elif status['state']=='running' and status['instance_status']=='ok' and iid in available:
+                ready.append(iid)
+
+        return ready
+
+    def check_assignments(self):
+        '''Update the ledger with the status of every running attempt, attempts on dead instances are marked as lost'''
+        running = self.ledger.running_assignments()
+
+        def check(assignment):
+            if assignment['instance_id'] in self.dead:
+                return 'lost'
+            try:
+                return assignment['handle'].status()
+            except Exception:
+                # The instance could not be reached, wait for the state polling to tell whether it was reclaimed
+                return 'running'
+
+        if len(running)==0:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(self.max_parallel, len(running))) as executor:
+            statuses = list(executor.map(lambda item: check(item[1]), running))
+
+        for (task_id, assignment), status in zip(running, statuses):
+            if status!='running':
+                if status=='lost':
+                    print('Task '+str(task_id)+' was lost with instance '+assignment['instance_id']+', re-queueing')
+                self.ledger.finish(task_id, assignment, status, max_attempts=self.max_attempts)
+
+        # Stop the attempts that lost the race against a successful duplicate
+        for task_id, assignment in self.ledger.running_assignments():
+            if self.ledger.tasks[task_id]['state']=='done':
+                try:
+                    assignment['handle'].kill()
+                except Exception:
+                    pass
+                self.ledger.finish(task_id, assignment, 'cancelled', max_attempts=self.max_attempts)
+
+    def stragglers(self):
+        '''Return the IDs of running tasks that are taking much longer than the median runtime, most overdue first'''
+        runtimes = sorted(self.ledger.runtimes())
+        if not self.speculate or len(runtimes)<self.min_runtimes:
+            return []
+        median = runtimes[len(runtimes)//2]
+
+        candidates = []
+        for task_id in self.ledger.with_state('running'):
+            task = self.ledger.tasks[task_id]
+            running = [a for a in task['assignments'] if a['status']=='running']
+            # Only speculate once per task and never beyond the task's attempt budget
+            if len(running)!=1 or task['attempts']>=self.max_attempts:
+                continue
+            elapsed = time.time()-running[0]['started']
+            if elapsed>self.speculation_factor*median:
+                candidates.append((task_id, running[0], elapsed))
+
+        stragglers = []
+        for task_id, assignment, elapsed in candidates:
+            try:
+                progress = assignment['handle'].progress()
+            except Exception:
+                progress = None
+            self.ledger.tasks[task_id]['progress'] = progress
+
+            # Use the reported progress to estimate the full runtime of the task
+            if progress is not None and progress>0:
+                estimate = elapsed/min(progress, 1.0)
+                if estimate<=self.speculation_factor*median:
+                    continue
+            stragglers.append((elapsed, task_id))
+
+        return [task_id for _, task_id in sorted(stragglers, reverse=True)]
+
+    def assign_tasks(self, ready):
+        '''Start pending tasks on the ready instances that are not running anything, then use the remaining idle instances for duplicates of stragglers'''
+        idle = [iid for iid in ready if iid not in self.ledger.busy_instances()]
+        pending = self.ledger.with_state('pending')
+
+        pairs = list(zip(pending, idle))
+        if len(idle)>len(pending):
+            pairs += list(zip(self.stragglers(), idle[len(pending):]))
+        if len(pairs)==0:
+            return
+
+        instances = ec2_methods.get_instances([iid for _, iid in pairs], region=self.region)
+        pairs = [(task_id, iid) for task_id, iid in pairs if iid in instances]
+
+        for task_id, iid in pairs:
+            if self.ledger.tasks[task_id]['state']=='running':
+                print('Task '+str(task_id)+' is straggling, launching a duplicate on '+iid)
+
+        scripts = [self.ledger.tasks[task_id]['script'] for task_id, _ in pairs]
+        job_ids = ['task'+str(task_id)+'-'+str(self.ledger.tasks[task_id]['attempts']+1)+'-'+sutils.genrs(length=4) for task_id, _ in pairs]
+        handles = dispatch_scripts([instances[iid] for _, iid in pairs], scripts, self.user_name, kp_dir=self.kp_dir, max_parallel=self.max_parallel, job_ids=job_ids)
+
+        for (task_id, iid), handle in zip(pairs, handles):
+            assignment = self.ledger.assign(task_id, iid, handle)
+            if handle.error is not None:
+                self.ledger.finish(task_id, assignment, 'lost', max_attempts=self.max_attempts)
+
+    def step(self):
+        '''Poll the instances and running tasks once, re-queue lost work and dispatch pending tasks. Returns the ledger summary'''
+        ready = self.poll_instances()
+        self.check_assignments()
+        self.assign_tasks(ready)
+        return self.ledger.summary()
+
+    def run(self, poll_interval=30, timeout=None):
+        '''Call `step` every `poll_interval` seconds until every task is done or failed (or the timeout runs out). Returns the ledger summary'''
+        st = time.time()
+        summary = self.step()
+        while not self.ledger.complete():
+            if timeout is not None and time.time()-st>timeout:
+                break
+            time.sleep(poll_interval)
+            summary = self.step()
+            print(summary, flush=True)
+        return summary
+
+
+def map_worker_loop(instance, user_name, tasks, results, kp_dir=None, python='python3', port=22):
+    '''
+    Run batches from the `tasks` queue on one instance until a None sentinel is received.
+    The map_worker agent is uploaded once and each batch is sent, run and collected over the instance's pooled SSH connection.
+    Messages put in the `results` queue are ("done", batch, results), ("retry", batch, error) or ("dead", instance_id, error) when the instance keeps failing.
+    A failed batch records the instance in its "failed" set, batches that exclude the instance are put back for the other instances.
+    '''
+    iid = instance['InstanceId']
+    remote_dir = '.spot_connect/map'
+
+    try:
+        instance_methods.run_command(instance, user_name, 'mkdir -p '+remote_dir, port=port, kp_dir=kp_dir)
+        client = instance_methods.get_connection(instance, user_name, port=port, kp_dir=kp_dir)
+        sftp = client.open_sftp()
+        sftp.put(os.path.join(sutils.pull_root(), 'map_worker.py'), remote_dir+'/map_worker.py')
+        sftp.close()
+    except Exception as e:
+        results.put(('dead', iid, e))
+        return
+
+    failures = 0
+    while True:
+        batch = tasks.get()
+        if batch is None:
+            return
+
+        if iid in batch['exclude']:
+            # Leave batches that already failed on this instance to the others
+            tasks.put(batch)
+            time.sleep(1)
+            continue
+
+        batch_file = remote_dir+'/batch_'+str(batch['id'])+'.pkl'
+        result_file = remote_dir+'/result_'+str(batch['id'])+'.pkl'
+
+        try:
+            client = instance_methods.get_connection(instance, user_name, port=port, kp_dir=kp_dir)
+            sftp = client.open_sftp()
+            sftp.putfo(io.BytesIO(batch['payload']), batch_file)
+
+            exit_status, output = instance_methods.run_command(instance, user_name, python+' '+remote_dir+'/map_worker.py '+batch_file+' '+result_file, port=port, kp_dir=kp_dir)
+            if exit_status!=0:
+                raise Exception('map_worker exited with status '+str(exit_status)+': '+output)
+
+            buffer = io.BytesIO()
+            sftp.getfo(result_file, buffer)
+            sftp.close()
+            instance_methods.run_command(instance, user_name, 'rm -f '+batch_file+' '+result_file, port=port, kp_dir=kp_dir)
+
+            results.put(('done', batch, pickle.loads(buffer.getvalue())))
+            failures = 0
+
+        except Exception as e:
+            failures += 1
+            batch['failed'].add(iid)
+            results.put(('retry', batch, e))
+            # Stop using an instance that fails twice in a row (most likely it was reclaimed)
+            if failures>=2:
+                results.put(('dead', iid, e))
+                return
+
+
+def map_on_instances(func, iterable, instances, user_name, kp_dir=None, chunksize=1, retries=2, prefetch=2, python='python3', return_index=False, port=22):
+    '''
+    Apply `func` to every item of `iterable` on the given instances and yield the results in the order they complete.
+    Items are sent in batches of `chunksize`. At most `prefetch` batches per instance are serialized ahead of time so large or endless iterables
+    are consumed as the instances make progress. Batches that fail (connection lost, instance reclaimed, worker crash) are retried up to `retries` times
+    on an instance they have not failed on yet, or on any remaining instance once they failed on all of them. An exception raised by `func` on the instance is raised locally with the remote traceback.
+    The function and items are serialized with cloudpickle if it is installed (required to send functions defined in a notebook or lambdas, cloudpickle
+    must then be installed on the instances as well), otherwise with pickle.
+    __________
+    parameters
+    - func : callable. function applied to each item
+    - iterable : iterable. items to process
+    - instances : list of dict. Instance descriptions from the describe_instances method
+    - user_name : str. SSH username for the instances
+    - kp_dir : str. directory with the private key files
+    - chunksize : int. number of items sent to an instance at once
+    - retries : int. number of times a failed batch is retried
+    - prefetch : int. number of batches queued per instance
+    - python : str. python executable on the instances
+    - return_index : bool. if True, yield (index, result) tuples where index is the position of the item in the iterable
+    - port : int. port to use to connect to the instances
+    '''
+    dumps = cloudpickle.dumps if cloudpickle is not None else pickle.dumps
+
+    tasks = queue.Queue()
+    results = queue.Queue()
+
+    for instance in instances:
+        threading.Thread(target=map_worker_loop, args=(instance, user_name, tasks, results), kwargs={'kp_dir': kp_dir, 'python': python, 'port': port}, daemon=True).start()
+
+    def exclusions(batch):
+        # Exclude the instances a batch failed on, unless that would leave no instance to run it
+        return frozenset(batch['failed']) if len(alive-batch['failed'])>0 else frozenset()
+
+    items = enumerate(iterable)
+    alive = set(instance['InstanceId'] for instance in instances)
+    retrying = {}
+    in_flight = 0
+    batch_id = 0
+    exhausted = False
+
+    try:
+        while True:
+            # Only keep a few batches per instance in flight so the iterable is consumed as results come back
+            while not exhausted and in_flight<max(len(alive), 1)*prefetch:
+                chunk = list(itertools.islice(items, chunksize))
+                if len(chunk)==0:
+                    exhausted = True
+                    break
+                tasks.put({'id': batch_id, 'payload': dumps((func, chunk)), 'attempts': 0, 'failed': set(), 'exclude': frozenset()})
+                batch_id += 1
+                in_flight += 1
+
+            if in_flight==0:
+                break
+            if len(alive)==0:
+                raise Exception('Every instance failed, '+str(in_flight)+' batches were not completed')
+
+            kind, batch, value = results.get()
+
+            if kind=='done':
+                in_flight -= 1
+                retrying.pop(batch['id'], None)
+                for index, success, result in value:
+                    if not success:
+                        raise Exception('Item '+str(index)+' failed on the instance:\n'+result)
+                    yield (index, result) if return_index else result
+
+            elif kind=='retry':
+                batch['attempts'] += 1
+                if batch['attempts']>retries:
+                    raise Exception('Batch '+str(batch['id'])+' failed '+str(batch['attempts'])+' times, last error: '+str(value))
+                batch['exclude'] = exclusions(batch)
+                retrying[batch['id']] = batch
+                tasks.put(batch)
+
+            elif kind=='dead':
+                alive.discard(batch)
+                for pending in retrying.values():
+                    pending['exclude'] = exclusions(pending)
+                print('Instance '+batch+' was dropped from the map: '+str(value))
+
+    finally:
+        for _ in instances:
+            tasks.put(None)
@@ -5,20 +5,35 @@ Created on Sun Jul  5 21:40:55 2020
 @author: Computer
 """
 
-import keras, requests, time 
+import keras, time
+from spot_connect.interruption import InterruptionHandler
+
 
 class SpotTermination(keras.callbacks.Callback):
-    
-    def __init__(self):
-        '''The SpotTermination Class can be used in the callbacks list for any keras model. 
-        At the beginning of each epoch the model will check if the spot instance has been scheduled for termination. 
-        If it has then the process will sleep until termination in order to ensure an orderly shut-down.'''
+
+    def __init__(self, handler=None, endpoint='http://169.254.169.254', poll_interval=5, sleep=150, stop_training=False):
+        '''The SpotTermination Class can be used in the callbacks list for any keras model.
+        An interruption.InterruptionHandler checks in the background if the spot instance has been scheduled for termination, the model only checks its flag before each batch.
+        If it has then the registered hooks (e.g. saving a checkpoint) are given time to finish and the process will sleep until termination in order to ensure an orderly shut-down.
+        __________
+        parameters
+        - handler : interruption.InterruptionHandler. handler to use, a new one is started if None. Register checkpoint hooks on it with handler.register
+        - endpoint : str. address of the instance metadata service used by the new handler
+        - poll_interval : float. number of seconds between checks of the new handler
+        - sleep : float. number of seconds to sleep once the instance has been scheduled for termination
+        - stop_training : bool. if True, stop training at the end of the batch instead of sleeping
+        '''
         super(SpotTermination, self).__init__()
+        if handler is None:
+            handler = InterruptionHandler(endpoint=endpoint, poll_interval=poll_interval)
+        self.handler = handler.start()
+        self.sleep = sleep
+        self.stop_training = stop_training
 
     def on_batch_begin(self, batch, logs={}):
-        status_code = requests.get("http://169.254.169.254/latest/meta-data/spot/instance-action").status_code
-        if status_code != 404: 
-             time.sleep(150)
-             
-             
-             
+        if self.handler.watcher.event.is_set():
+            self.handler.wait_for_hooks()
+            if self.stop_training:
+                self.model.stop_training = True
+            else:
+                time.sleep(self.sleep)
@@ -0,0 +1,43 @@
+"""
+Author: Carlos Valcarcel <carlos.d.valcarcel.w@gmail.com>
+
+This file is part of spot-connect
+
+Remote worker agent - map_worker.py:
+
+The map_worker script is uploaded to the instances used by InstanceManager.map
+and runs one batch of work at a time. It only depends on the standard library
+(and cloudpickle, if the function was serialized with it) so it can run on any
+instance without installing spot-connect.
+
+    python map_worker.py <batch file> <result file>
+
+MIT License 2020
+"""
+
+import sys, pickle, traceback
+
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
+
+
+def run_batch(batch_file, result_file):
+    '''Load a (function, [(index, item), ...]) batch, apply the function to each item and save the [(index, success, result or traceback), ...] results'''
+    with open(batch_file, 'rb') as f:
+        func, items = pickle.load(f)
+
+    results = []
+    for index, item in items:
+        try:
+            results.append((index, True, func(item)))
+        except Exception:
+            results.append((index, False, traceback.format_exc()))
+
+    with open(result_file, 'wb') as f:
+        pickle.dump(results, f)
+
+
+if __name__ == '__main__':
+    run_batch(sys.argv[1], sys.argv[2])
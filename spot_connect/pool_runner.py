@@ -0,0 +1,184 @@
+"""
+Author: Carlos Valcarcel <carlos.d.valcarcel.w@gmail.com>
+
+This file is part of spot-connect
+
+Instance workload runner - pool_runner.py:
+
+The pool_runner script runs on an instance and fans a workload shard (a pickled
+list, see sutils.split_workloads) out to a process pool sized to the instance's
+logical CPUs, and to its available memory if a per-task memory estimate is
+given. Items are handed out to the processes in small chunks as they become
+idle, so slow items do not hold up the other cores. Each worker saves its
+results in its own pickle file and a combined manifest.json describes the
+whole run. It only depends on the standard library
+so it can be uploaded to any instance:
+
+    python pool_runner.py <workload file> <module:function> <output dir> [--processes N] [--memory-per-task MB] [--chunksize K] [--path DIR]
+
+Use bash_scripts.compose_pool_runner_script to build the command.
+
+MIT License 2020
+"""
+
+import os, sys, json, time, pickle, argparse, importlib, traceback
+import multiprocessing as mp
+
+
+def available_memory_mb():
+    '''Return the memory available for new processes in MB (MemAvailable from /proc/meminfo), or None if it cannot be read'''
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])/1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def pool_size(processes=None, memory_per_task=None):
+    '''Return the number of processes to use: the logical CPU count, capped so that `memory_per_task` (MB) per process fits in 90% of the available memory'''
+    if processes is None:
+        processes = mp.cpu_count()
+
+    if memory_per_task is not None:
+        memory = available_memory_mb()
+        if memory is not None:
+            processes = min(processes, int(memory*0.9//memory_per_task))
+
+    return max(processes, 1)
+
+
+def load_function(spec, path=None):
+    '''Import the function given as "module:function"'''
+    if path is not None and path not in sys.path:
+        sys.path.insert(0, path)
+    module_name, function_name = spec.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+# State of a pool worker process, set by init_worker
+worker_state = {}
+
+
+def init_worker(spec, path, output_dir):
+    '''Load the function once per worker process and open the worker's result file'''
+    worker_state['func'] = load_function(spec, path)
+    worker_state['worker'] = os.getpid()
+    worker_state['file'] = os.path.join(output_dir, 'result_'+str(os.getpid())+'.pickle')
+    worker_state['out'] = open(worker_state['file'], 'wb')
+
+
+def run_item(args):
+    '''Apply the function to one (index, item) and append the {"results": [(index, result)], "errors": [(index, traceback)]} record to the worker's result file'''
+    index, item = args
+    st = time.time()
+    record = {'results': [], 'errors': []}
+    try:
+        record['results'].append((index, worker_state['func'](item)))
+    except Exception:
+        record['errors'].append((index, traceback.format_exc()))
+
+    pickle.dump(record, worker_state['out'])
+    worker_state['out'].flush()
+
+    return {'worker': worker_state['worker'], 'file': worker_state['file'], 'errors': len(record['errors']), 'seconds': time.time()-st}
+
+
+def consolidate(result_file):
+    '''Rewrite the records appended to a worker's result file as a single {"results": [...], "errors": [...]} pickle'''
+    merged = {'results': [], 'errors': []}
+    with open(result_file, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            merged['results'] += record['results']
+            merged['errors'] += record['errors']
+
+    tmp = result_file+'.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(merged, f)
+    os.replace(tmp, result_file)
+
+
+def run_workload(workload_file, spec, output_dir, processes=None, memory_per_task=None, path=None, chunksize=1):
+    '''
+    Run the function on every item of the workload with a process pool and return the manifest.
+    Items are handed out `chunksize` at a time to whichever process is idle, so uneven items are balanced across the processes.
+    __________
+    parameters
+    - workload_file : str. pickled list of items
+    - spec : str. function to apply as "module:function", the module must be importable on the instance (see `path`)
+    - output_dir : str. directory for the per-worker results and the manifest
+    - processes : int. number of processes, defaults to the number of logical CPUs
+    - memory_per_task : float. estimated peak memory of one process in MB, used to cap the number of processes to avoid running out of memory
+    - path : str. directory added to the python path to import the function's module
+    - chunksize : int. number of items sent to a process at once, larger chunks lower the overhead of many small items
+    '''
+    with open(workload_file, 'rb') as f:
+        workload = pickle.load(f)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    n_workers = min(pool_size(processes, memory_per_task), max(len(workload), 1))
+
+    st = time.time()
+    workers = {}
+    with mp.Pool(n_workers, initializer=init_worker, initargs=(spec, path, output_dir)) as pool:
+        for done in pool.imap_unordered(run_item, enumerate(workload), chunksize=max(int(chunksize), 1)):
+            worker = workers.setdefault(done['worker'], {'worker': done['worker'], 'file': done['file'], 'items': 0, 'errors': 0, 'seconds': 0})
+            worker['items'] += 1
+            worker['errors'] += done['errors']
+            worker['seconds'] += done['seconds']
+
+    # Merge the records appended by each worker into one {"results", "errors"} pickle per worker (the format read by load_results and tree_reduce)
+    for worker in workers.values():
+        consolidate(worker['file'])
+
+    manifest = {'workload': os.path.abspath(workload_file),
+                'function': spec,
+                'processes': n_workers,
+                'items': len(workload),
+                'errors': sum(w['errors'] for w in workers.values()),
+                'seconds': time.time()-st,
+                'workers': list(workers.values())}
+
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+def load_results(output_dir):
+    '''Combine the per-worker results of a run into a single list ordered as the workload'''
+    with open(os.path.join(output_dir, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+
+    results = []
+    for worker in manifest['workers']:
+        with open(worker['file'], 'rb') as f:
+            results += pickle.load(f)['results']
+
+    return [result for _, result in sorted(results, key=lambda r: r[0])]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a workload shard on a process pool')
+    parser.add_argument('workload', help='pickled list of items')
+    parser.add_argument('function', help='function to apply as module:function')
+    parser.add_argument('output_dir', help='directory for the results and manifest')
+    parser.add_argument('--processes', type=int, default=None, help='number of processes (default: logical CPUs)')
+    parser.add_argument('--memory-per-task', type=float, default=None, help='estimated memory per process in MB')
+    parser.add_argument('--chunksize', type=int, default=1, help='number of items sent to a process at once')
+    parser.add_argument('--path', default=None, help='directory to add to the python path')
+    args = parser.parse_args()
+
+    manifest = run_workload(args.workload, args.function, args.output_dir, processes=args.processes, memory_per_task=args.memory_per_task, path=args.path, chunksize=args.chunksize)
+    print('Processed '+str(manifest['items'])+' items with '+str(manifest['processes'])+' processes in '+str(round(manifest['seconds'], 1))+'s ('+str(manifest['errors'])+' errors)')
+
+    if manifest['errors']>0:
+        sys.exit(1)
@@ -11,52 +11,596 @@ interact with objects on s3.
 MIT License 2020
 """
 
-import os
+import os, time, queue, sqlite3, hashlib, threading, collections
 from path import Path 
+from concurrent.futures import ThreadPoolExecutor
 
 root = Path(os.path.dirname(os.path.abspath(__file__)))
 
-from spot_connect.sutils import chunks
+from spot_connect import sutils
+from spot_connect.sutils import iter_chunks
 
 import boto3
-from Ipython.display import clear_output 
+from boto3.s3.transfer import TransferConfig
 
-def listS3Objects(bucket_name):
-    s3 = boto3.resource('s3')
+# Lightweight description of an s3 object returned by the listing functions
+S3Object = collections.namedtuple('S3Object', ['key', 'size', 'etag', 'mtime'])
 
-    bucket = s3.Bucket(bucket_name)
 
-    s3_files = [] 
-    i = 0 
-    for f in bucket.objects.all():
-        s3_files.append(f)
-        i+=1 
-        if i%100==0:
-            print(f)
-            print('object #:', i)
-            clear_output(wait=True)
+def list_prefix(client, bucket_name, prefix='', start_after=None, page_size=1000):
+    '''
+    Lazily list the objects under a prefix one page at a time and yield them as S3Object(key, size, etag, mtime) tuples in key order.
+    __________
+    parameters
+    - client : boto3 s3 client
+    - bucket_name : str. name of the bucket
+    - prefix : str. only list keys that start with this prefix
+    - start_after : str. only list keys that come after this key
+    - page_size : int. number of keys requested per call (max 1000)
+    '''
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix, 'PaginationConfig': {'PageSize': page_size}}
+    if start_after is not None:
+        kwargs['StartAfter'] = start_after
+
+    for page in client.get_paginator('list_objects_v2').paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            yield S3Object(obj['Key'], obj['Size'], obj['ETag'].strip('"'), obj['LastModified'])
 
-    return s3_files 
 
-def deleteS3Objects(bucket_name : str, objects : list): 
+def split_prefix(client, bucket_name, prefix='', delimiter='/'):
+    '''Return the ([sub-prefixes], [objects]) directly under a prefix, as split by the delimiter'''
+    prefixes, objects = [], []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix, Delimiter=delimiter):
+        prefixes += [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+        objects += [S3Object(obj['Key'], obj['Size'], obj['ETag'].strip('"'), obj['LastModified']) for obj in page.get('Contents', [])]
+    return prefixes, objects
+
+
+def iter_s3_objects(bucket_name, prefix='', delimiter=None, depth=1, max_workers=16, region=None, client=None, page_size=1000, buffer_size=10000):
     '''
-    Delete a list of s3 objects from a given s3 bucket
+    Generator over the objects of a bucket as S3Object(key, size, etag, mtime) tuples, the listing is paged lazily so memory use does not grow with the bucket.
+    If a delimiter is submitted the keyspace is split into the sub-prefixes found `depth` levels under the prefix (e.g. "folder/sub-folder/" for depth=2 and delimiter="/")
+    and the sub-prefixes are listed concurrently, in that case the objects are not yielded in key order.
+
+        for key, size, etag, mtime in iter_s3_objects('my-bucket', prefix='data/', delimiter='/'):
+            ...
+    __________
+    parameters
+    - bucket_name : str. name of the bucket
+    - prefix : str. only list keys that start with this prefix
+    - delimiter : str. character used to split the keyspace into prefixes listed in parallel, the keys are listed sequentially if None
+    - depth : int. number of delimiter levels to split the keyspace into
+    - max_workers : int. maximum number of prefixes listed at the same time
+    - region : str. region of the bucket
+    - client : boto3 s3 client to use, one is created if None
+    - page_size : int. number of keys requested per call (max 1000)
+    - buffer_size : int. maximum number of listed objects waiting to be consumed before the listing threads pause
     '''
+    if client is None:
+        client = boto3.client('s3', region_name=region)
 
-    assert type(objects[0]) == boto3.resources.factory.s3.ObjectSummary
-    
-    s3 = boto3.resource('s3')
+    if delimiter is None:
+        yield from list_prefix(client, bucket_name, prefix=prefix, page_size=page_size)
+        return
 
-    bucket = s3.Bucket(bucket_name)
+    # Walk down the keyspace to find the prefixes to list, objects found along the way are yielded directly
+    prefixes = [prefix]
+    for level in range(depth):
+        next_prefixes = []
+        for p in prefixes:
+            sub_prefixes, objects = split_prefix(client, bucket_name, prefix=p, delimiter=delimiter)
+            yield from objects
+            next_prefixes += sub_prefixes
+        prefixes = next_prefixes
 
+    if len(prefixes)==0:
+        return
 
-    file_chunks = [c for c in chunks(objects, 1000)]
-    
-    responses = []
-    
-    for files in file_chunks: 
-        ftod = [{'Key':c.key} for c in files]
-        response = bucket.delete_objects(
-            Delete={'Objects': ftod}
-        ) 
-        responses.append(response)
\ No newline at end of file
+    results = queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_one(p):
+        try:
+            for obj in list_prefix(client, bucket_name, prefix=p, page_size=page_size):
+                if not put(obj):
+                    return
+        except Exception as e:
+            put(e)
+        put(done)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(prefixes)))
+    for p in prefixes:
+        executor.submit(list_one, p)
+
+    try:
+        remaining = len(prefixes)
+        while remaining>0:
+            item = results.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # Stop the listing threads if the consumer stopped early
+        stopped.set()
+        executor.shutdown(wait=False)
+
+
+def listS3Objects(bucket_name, prefix='', region=None):
+    '''
+    Return the list of objects in a bucket as S3Object(key, size, etag, mtime) tuples.
+    For large buckets iterate over iter_s3_objects instead so the objects are not all kept in memory.
+    '''
+    return list(iter_s3_objects(bucket_name, prefix=prefix, region=region))
+
+def delete_batch(client, bucket_name, keys, max_retries=5, backoff=0.5):
+    '''Delete up to 1000 keys with one request and retry only the keys that failed (with exponential backoff). Returns the [(key, code, message), ...] that could not be deleted'''
+    errors = []
+    for attempt in range(max_retries+1):
+        if attempt>0:
+            time.sleep(backoff*2**(attempt-1))
+        try:
+            response = client.delete_objects(Bucket=bucket_name, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+        except Exception as e:
+            errors = [(k, 'RequestFailed', str(e)) for k in keys]
+            continue
+        errors = [(e['Key'], e.get('Code'), e.get('Message')) for e in response.get('Errors', [])]
+        keys = [e[0] for e in errors]
+        if len(keys)==0:
+            break
+    return errors
+
+
+def deleteS3Objects(bucket_name : str, objects=None, prefix=None, max_workers=8, max_retries=5, region=None, client=None, verbose=True, report_interval=10):
+    '''
+    Delete objects from a given s3 bucket. The keys are consumed as a stream and sent in batches of 1000 to a pool of workers, so deleting starts before the
+    listing is complete and only a few batches are held in memory. Keys that fail are retried on their own. Returns a summary dict with the number of objects
+    "deleted", the [(key, code, message), ...] that "failed", the "seconds" it took and the "rate" in objects per second.
+
+        deleteS3Objects('my-bucket', prefix='scratch/')
+    __________
+    parameters
+    - bucket_name : str. name of the bucket
+    - objects : iterable. keys to delete as str or as objects with a `key` attribute (e.g. from iter_s3_objects or boto3's bucket.objects), can be a generator
+    - prefix : str. delete every object under this prefix, used if no objects are submitted
+    - max_workers : int. maximum number of delete requests sent at the same time
+    - max_retries : int. number of times the keys of a batch that failed are retried
+    - region : str. region of the bucket
+    - client : boto3 s3 client to use, one is created if None
+    - verbose : bool. if True, print the progress and throughput
+    - report_interval : float. number of seconds between progress reports
+    '''
+    if client is None:
+        client = boto3.client('s3', region_name=region)
+
+    if objects is None:
+        if prefix is None:
+            raise Exception('Submit the objects or the prefix to delete')
+        objects = iter_s3_objects(bucket_name, prefix=prefix, client=client)
+
+    keys = (o if isinstance(o, str) else o.key for o in objects)
+
+    summary = {'deleted': 0, 'failed': [], 'seconds': 0, 'rate': 0}
+    lock = threading.Lock()
+    in_flight = threading.Semaphore(max_workers*2)
+    st = time.time()
+    last_report = [st]
+
+    def delete(batch):
+        try:
+            errors = delete_batch(client, bucket_name, batch, max_retries=max_retries)
+        finally:
+            in_flight.release()
+        with lock:
+            summary['deleted'] += len(batch)-len(errors)
+            summary['failed'] += errors
+            if verbose and time.time()-last_report[0]>report_interval:
+                last_report[0] = time.time()
+                print('Deleted '+str(summary['deleted'])+' objects ('+str(int(summary['deleted']/(time.time()-st)))+' objects/s)', flush=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for batch in iter_chunks(keys, 1000):
+            # Wait for a free slot so the key source is not read far ahead of the deletes
+            in_flight.acquire()
+            futures.append(executor.submit(delete, batch))
+
+    for future in futures:
+        future.result()
+
+    summary['seconds'] = time.time()-st
+    summary['rate'] = summary['deleted']/max(summary['seconds'], 1e-9)
+
+    if verbose:
+        print('Deleted '+str(summary['deleted'])+' objects in '+str(round(summary['seconds'], 1))+'s ('+str(int(summary['rate']))+' objects/s), '+str(len(summary['failed']))+' failed')
+
+    return summary
+
+
+def get_s3_client(region=None, endpoint_url=None):
+    '''Return an s3 client, submit an endpoint_url to use an s3 compatible service (e.g. a local MinIO or moto server for testing)'''
+    return boto3.client('s3', region_name=region, endpoint_url=endpoint_url)
+
+
+def transfer_config(part_size_mb=64, max_concurrency=10):
+    '''Return the TransferConfig for multipart transfers with parts of `part_size_mb` and `max_concurrency` parts in flight per file'''
+    part_size = int(part_size_mb*1024*1024)
+    return TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=max_concurrency, use_threads=True)
+
+
+def local_etag(path, part_size):
+    '''
+    Compute the ETag s3 gives a file uploaded with the given part size: the md5 of the file for single part uploads, or the md5 of the concatenated part md5s
+    followed by "-<number of parts>" for multipart uploads.
+    '''
+    md5s = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(part_size)
+            if not data:
+                break
+            md5s.append(hashlib.md5(data))
+    if len(md5s)==0:
+        return hashlib.md5(b'').hexdigest()
+    if len(md5s)==1 and os.path.getsize(path)<part_size:
+        return md5s[0].hexdigest()
+    return hashlib.md5(b''.join(m.digest() for m in md5s)).hexdigest()+'-'+str(len(md5s))
+
+
+class S3Index:
+
+    path        =   None
+
+    def __init__(self, path=None):
+        '''
+        Local sqlite index of the objects in s3 buckets (key, size, etag and modification time), so syncs can find the changed objects without listing the whole bucket.
+        The index is updated by the transfer functions after each transfer and reconciled with s3 using paged listings that start after the last key seen.
+        It also caches the ETags computed for local files so unchanged local files are not read again.
+        __________
+        parameters
+        - path : str. sqlite file for the index, defaults to data/s3_index.sqlite in the package directory
+        '''
+        if path is None:
+            path = os.path.join(sutils.pull_root(), 'data', 's3_index.sqlite')
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, size INTEGER, etag TEXT, mtime REAL, scan INTEGER DEFAULT 0, PRIMARY KEY (bucket, key));
+                CREATE TABLE IF NOT EXISTS markers (bucket TEXT, prefix TEXT, tail TEXT, scan_marker TEXT, scan INTEGER DEFAULT 0, PRIMARY KEY (bucket, prefix));
+                CREATE TABLE IF NOT EXISTS local_files (path TEXT, part_size INTEGER, size INTEGER, mtime REAL, etag TEXT, PRIMARY KEY (path, part_size));
+            ''')
+
+    def get(self, bucket_name, key):
+        '''Return the indexed S3Object for a key, or None'''
+        with self.lock:
+            row = self.db.execute('SELECT key, size, etag, mtime FROM objects WHERE bucket=? AND key=?', (bucket_name, key)).fetchone()
+        return None if row is None else S3Object(*row)
+
+    def objects(self, bucket_name, prefix=''):
+        '''Return the indexed objects under a prefix as a list of S3Object(key, size, etag, mtime) in key order'''
+        with self.lock:
+            rows = self.db.execute('SELECT key, size, etag, mtime FROM objects WHERE bucket=? AND key>=? AND substr(key, 1, ?)=? ORDER BY key',
+                                   (bucket_name, prefix, len(prefix), prefix)).fetchall()
+        return [S3Object(*row) for row in rows]
+
+    def update(self, bucket_name, objects, scan=0):
+        '''Add or replace the entries of a list of S3Object'''
+        rows = [(bucket_name, o.key, o.size, o.etag, o.mtime.timestamp() if hasattr(o.mtime, 'timestamp') else o.mtime, scan) for o in objects]
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO objects (bucket, key, size, etag, mtime, scan) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def remove(self, bucket_name, keys):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM objects WHERE bucket=? AND key=?', [(bucket_name, k) for k in keys])
+
+    def get_markers(self, bucket_name, prefix):
+        with self.lock:
+            row = self.db.execute('SELECT tail, scan_marker, scan FROM markers WHERE bucket=? AND prefix=?', (bucket_name, prefix)).fetchone()
+        return (None, None, 0) if row is None else row
+
+    def set_markers(self, bucket_name, prefix, tail, scan_marker, scan):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO markers (bucket, prefix, tail, scan_marker, scan) VALUES (?, ?, ?, ?, ?)', (bucket_name, prefix, tail, scan_marker, scan))
+
+    def reconcile(self, bucket_name, prefix='', client=None, full=False, max_keys=None, region=None, endpoint_url=None):
+        '''
+        Bring the index up to date with s3 and return the number of objects "listed" and "removed".
+        By default only the keys after the last key seen under the prefix are listed, which picks up new objects with increasing names (logs, checkpoints,
+        numbered shards...) at the cost of the new objects only. With full=True the prefix is listed again to catch objects changed or deleted by other tools,
+        with max_keys the full listing is spread over several calls, each one continuing after the last key listed by the previous one.
+        __________
+        parameters
+        - bucket_name : str. name of the bucket
+        - prefix : str. prefix to reconcile
+        - client : boto3 s3 client to use, one is created if None
+        - full : bool. if True, list the whole prefix (or the next `max_keys` of it) and remove the objects that no longer exist
+        - max_keys : int. maximum number of keys listed by a full reconciliation
+        - region : str. region of the bucket
+        - endpoint_url : str. url of an s3 compatible service to use instead of AWS
+        '''
+        if client is None:
+            client = get_s3_client(region=region, endpoint_url=endpoint_url)
+
+        tail, scan_marker, scan = self.get_markers(bucket_name, prefix)
+        start = scan_marker if full else tail
+        if full and scan_marker is None:
+            scan += 1
+
+        listed, removed, last, batch = 0, 0, None, []
+        complete = True
+        for obj in list_prefix(client, bucket_name, prefix=prefix, start_after=start):
+            batch.append(obj)
+            listed += 1
+            last = obj.key
+            if len(batch)==1000:
+                self.update(bucket_name, batch, scan=scan)
+                batch = []
+            if full and max_keys is not None and listed>=max_keys:
+                complete = False
+                break
+        self.update(bucket_name, batch, scan=scan)
+
+        if full:
+            # Remove the indexed keys in the listed range that were not seen by this scan
+            query = 'DELETE FROM objects WHERE bucket=? AND key>=? AND substr(key, 1, ?)=? AND scan!=?'
+            args = [bucket_name, prefix, len(prefix), prefix, scan]
+            if start is not None:
+                query += ' AND key>?'
+                args.append(start)
+            if not complete:
+                query += ' AND key<=?'
+                args.append(last)
+            with self.lock, self.db:
+                removed = self.db.execute(query, args).rowcount
+            scan_marker = None if complete else last
+
+        if last is not None and (tail is None or last>tail):
+            tail = last
+        self.set_markers(bucket_name, prefix, tail, scan_marker, scan)
+
+        return {'listed': listed, 'removed': removed}
+
+    def local_etag(self, path, part_size):
+        '''Return the s3 ETag of a local file for the given part size, computed only if the file changed since it was last computed'''
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime, etag FROM local_files WHERE path=? AND part_size=?', (os.path.abspath(path), part_size)).fetchone()
+        if row is not None and row[0]==stat.st_size and row[1]==stat.st_mtime:
+            return row[2]
+        etag = local_etag(path, part_size)
+        self.set_local_etag(path, part_size, etag)
+        return etag
+
+    def set_local_etag(self, path, part_size, etag):
+        stat = os.stat(path)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO local_files (path, part_size, size, mtime, etag) VALUES (?, ?, ?, ?, ?)', (os.path.abspath(path), part_size, stat.st_size, stat.st_mtime, etag))
+
+    def close(self):
+        self.db.close()
+
+
+def indexed_objects(bucket_name, prefix, client, index=None, full=True, max_keys=10000):
+    '''
+    Return {key: S3Object} for the objects under a prefix, from the index if one is submitted or from a full listing otherwise.
+    The index is reconciled with the keys added after the last key seen and, if full is True, with the next `max_keys` keys of a rolling full listing of the prefix,
+    so objects overwritten or deleted by other tools are caught once the rolling listing reaches them (on every call for prefixes with less than `max_keys` objects).
+    Until then the index may hold a stale ETag (the object is wrongly skipped) or a deleted key. 
+    __________
+    parameters
+    - bucket_name : str. name of the bucket
+    - prefix : str. prefix of the objects
+    - client : boto3 s3 client
+    - index : S3Index. local index of the bucket, the prefix is listed if None
+    - full : bool. if True, also reconcile the next `max_keys` keys of the rolling full listing of the prefix
+    - max_keys : int. maximum number of keys listed by the full reconciliation on each call, the whole prefix if None
+    '''
+    if index is None:
+        return {o.key: o for o in iter_s3_objects(bucket_name, prefix=prefix, client=client)}
+    index.reconcile(bucket_name, prefix=prefix, client=client)
+    if full:
+        index.reconcile(bucket_name, prefix=prefix, client=client, full=True, max_keys=max_keys)
+    return {o.key: o for o in index.objects(bucket_name, prefix=prefix)}
+
+
+def is_missing(error):
+    '''Return True if a boto3 error means the object does not exist'''
+    return str(getattr(error, 'response', {}).get('Error', {}).get('Code')) in ('404', 'NoSuchKey', 'NotFound')
+
+
+def is_unchanged(path, remote, part_size, index=None):
+    '''Return True if a local file matches its s3 object (same size and ETag), the local ETag is cached in the index if one is submitted'''
+    if remote is None or not os.path.exists(path) or os.path.getsize(path)!=remote.size:
+        return False
+    if index is not None:
+        return index.local_etag(path, part_size)==remote.etag
+    return local_etag(path, part_size)==remote.etag
+
+
+def run_transfers(transfers, transfer, max_files, verbose, report_interval, action):
+    '''Run the (local path, key, size) transfers with a pool of `max_files` threads, reporting the progress, and return the summary'''
+    summary = {'files': 0, 'bytes': 0, 'skipped': 0, 'failed': [], 'seconds': 0, 'rate': 0}
+    lock = threading.Lock()
+    st = time.time()
+    last_report = [st]
+
+    def progress(nbytes):
+        with lock:
+            summary['bytes'] += nbytes
+            if verbose and time.time()-last_report[0]>report_interval:
+                last_report[0] = time.time()
+                print(action+' '+str(round(summary['bytes']/1e6, 1))+' MB ('+str(round(summary['bytes']/1e6/(time.time()-st), 1))+' MB/s)', flush=True)
+
+    def run(item):
+        path, key, size = item
+        try:
+            transfer(path, key, progress)
+            with lock:
+                summary['files'] += 1
+        except Exception as e:
+            with lock:
+                summary['failed'].append((path, key, e))
+
+    if len(transfers)>0:
+        with ThreadPoolExecutor(max_workers=min(max_files, len(transfers))) as executor:
+            list(executor.map(run, transfers))
+
+    summary['seconds'] = time.time()-st
+    summary['rate'] = summary['bytes']/max(summary['seconds'], 1e-9)
+
+    if verbose:
+        print(action+' '+str(summary['files'])+' files ('+str(round(summary['bytes']/1e6, 1))+' MB) in '+str(round(summary['seconds'], 1))+'s ('
+              +str(round(summary['rate']/1e6, 1))+' MB/s), '+str(summary['skipped'])+' unchanged, '+str(len(summary['failed']))+' failed')
+
+    return summary
+
+
+def upload_to_s3(path, bucket_name, prefix='', part_size_mb=64, max_concurrency=10, max_files=8, skip_unchanged=True, index=None, full=True, max_keys=10000, region=None, endpoint_url=None, client=None, verbose=True, report_interval=10):
+    '''
+    Upload a file or a directory to s3 with concurrent multipart transfers. Files that already exist in s3 with the same size and ETag are skipped.
+    Directories are uploaded to <prefix><relative path>, a single file is uploaded to the prefix itself unless it ends with "/".
+    Returns a summary dict with the number of "files" and "bytes" uploaded, the number "skipped", the [(path, key, error), ...] that "failed", the "seconds" and "rate" in bytes per second.
+    __________
+    parameters
+    - path : str. local file or directory
+    - bucket_name : str. name of the bucket
+    - prefix : str. key prefix to upload to
+    - part_size_mb : float. size of the multipart parts, files smaller than a part are uploaded in one request
+    - max_concurrency : int. number of parts of a file uploaded at the same time
+    - max_files : int. number of files uploaded at the same time
+    - skip_unchanged : bool. if True, do not upload files that are already in s3
+    - index : S3Index. local index of the bucket, used instead of listing the whole prefix and updated after each upload. Submit True to use the default index. 
+              Objects changed by other tools are only caught once the rolling full reconciliation reaches them, until then they may be skipped (see indexed_objects)
+    - full : bool. if True, reconcile the next `max_keys` keys of a rolling full listing of the prefix with the index, see indexed_objects
+    - max_keys : int. maximum number of keys listed by the full reconciliation, the whole prefix if None
+    - region : str. region of the bucket
+    - endpoint_url : str. url of an s3 compatible service to use instead of AWS
+    - client : boto3 s3 client to use, one is created if None
+    - verbose : bool. if True, print the progress and throughput
+    - report_interval : float. number of seconds between progress reports
+    '''
+    if client is None:
+        client = get_s3_client(region=region, endpoint_url=endpoint_url)
+    config = transfer_config(part_size_mb, max_concurrency)
+
+    if os.path.isdir(path):
+        files = []
+        for directory, _, names in os.walk(path):
+            for name in names:
+                local = os.path.join(directory, name)
+                files.append((local, prefix+os.path.relpath(local, path).replace(os.sep, '/')))
+    else:
+        files = [(path, prefix+os.path.basename(path) if prefix=='' or prefix.endswith('/') else prefix)]
+
+    if index is True:
+        index = S3Index()
+
+    remote = {}
+    if skip_unchanged and os.path.isdir(path):
+        remote = indexed_objects(bucket_name, prefix, client, index, full=full, max_keys=max_keys)
+    elif skip_unchanged:
+        # A single file only needs its own key, not a listing of everything under the prefix
+        key = files[0][1]
+        try:
+            head = client.head_object(Bucket=bucket_name, Key=key)
+            remote[key] = S3Object(key, head['ContentLength'], head['ETag'].strip('"'), head['LastModified'])
+        except Exception as e:
+            if not is_missing(e):
+                raise
+
+    transfers = []
+    skipped = 0
+    for local, key in files:
+        if skip_unchanged and is_unchanged(local, remote.get(key), config.multipart_chunksize, index=index):
+            skipped += 1
+        else:
+            transfers.append((local, key, os.path.getsize(local)))
+
+    def transfer(local, key, progress):
+        client.upload_file(local, bucket_name, key, Config=config, Callback=progress)
+        if index is not None:
+            head = client.head_object(Bucket=bucket_name, Key=key)
+            index.update(bucket_name, [S3Object(key, head['ContentLength'], head['ETag'].strip('"'), head['LastModified'])])
+
+    summary = run_transfers(transfers, transfer, max_files, verbose, report_interval, 'Uploaded')
+    summary['skipped'] = skipped
+    return summary
+
+
+def download_from_s3(bucket_name, prefix, local_dir, part_size_mb=64, max_concurrency=10, max_files=8, skip_unchanged=True, index=None, full=True, max_keys=10000, region=None, endpoint_url=None, client=None, verbose=True, report_interval=10):
+    '''
+    Download every object under a prefix (or a single key) to a local directory with concurrent multipart transfers, keeping the key paths relative to the prefix.
+    Local files with the same size and ETag as their object are skipped. Returns the same summary as upload_to_s3.
+    __________
+    parameters
+    - bucket_name : str. name of the bucket
+    - prefix : str. prefix (or key) of the objects to download
+    - local_dir : str. local directory to download the objects to
+    - part_size_mb : float. size of the ranges downloaded in parallel
+    - max_concurrency : int. number of ranges of a file downloaded at the same time
+    - max_files : int. number of files downloaded at the same time
+    - skip_unchanged : bool. if True, do not download objects that are already in the local directory
+    - index : S3Index. local index of the bucket, used instead of listing the whole prefix. Submit True to use the default index. 
+              Objects changed by other tools are only caught once the rolling full reconciliation reaches them, until then they may be skipped and deleted objects fail 
+              (they are then removed from the index), see indexed_objects
+    - full : bool. if True, reconcile the next `max_keys` keys of a rolling full listing of the prefix with the index, see indexed_objects
+    - max_keys : int. maximum number of keys listed by the full reconciliation, the whole prefix if None
+    - region : str. region of the bucket
+    - endpoint_url : str. url of an s3 compatible service to use instead of AWS
+    - client : boto3 s3 client to use, one is created if None
+    - verbose : bool. if True, print the progress and throughput
+    - report_interval : float. number of seconds between progress reports
+    '''
+    if client is None:
+        client = get_s3_client(region=region, endpoint_url=endpoint_url)
+    config = transfer_config(part_size_mb, max_concurrency)
+
+    if index is True:
+        index = S3Index()
+
+    remote = indexed_objects(bucket_name, prefix, client, index, full=full, max_keys=max_keys)
+
+    base = prefix[:prefix.rfind('/')+1]
+    transfers = []
+    skipped = 0
+    for obj in remote.values():
+        if obj.key.endswith('/'):
+            continue
+        local = os.path.join(local_dir, *obj.key[len(base):].split('/'))
+        if skip_unchanged and is_unchanged(local, obj, config.multipart_chunksize, index=index):
+            skipped += 1
+        else:
+            transfers.append((local, obj.key, obj.size))
+
+    def transfer(local, key, progress):
+        os.makedirs(os.path.dirname(local) or '.', exist_ok=True)
+        try:
+            client.download_file(bucket_name, key, local, Config=config, Callback=progress)
+        except Exception as e:
+            # The object was deleted since it was indexed, forget it so the next sync does not try it again
+            if index is not None and is_missing(e):
+                index.remove(bucket_name, [key])
+            raise
+        # The downloaded file has the ETag of its object if the object was uploaded with the same part size, cache it to skip reading the file next time
+        obj = remote[key]
+        parts = -(-obj.size//config.multipart_chunksize)
+        if index is not None and (obj.etag.endswith('-'+str(parts)) if obj.size>=config.multipart_chunksize else '-' not in obj.etag):
+            index.set_local_etag(local, config.multipart_chunksize, obj.etag)
+
+    summary = run_transfers(transfers, transfer, max_files, verbose, report_interval, 'Downloaded')
+    summary['skipped'] = skipped
+    return summary
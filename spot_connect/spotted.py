@@ -40,6 +40,12 @@ class SpotInstance:
     
     filesystem     =   None
     new_mount       =   None 
+    mount_preset    =   None 
+    scratch         =   None 
+    volumes         =   None 
+    availability_zone = None 
+    scratch_paths   =   None 
+    timings         =   None 
     upload          =   None 
     remote_path     =   None 
     monitoring      =   None 
@@ -70,7 +76,12 @@ class SpotInstance:
                  username       :   str   = None,
                  filesystem     :   str   = None,
                  new_mount      :   bool  = False, 
-                 monitoring     :   bool  = False):
+                 mount_preset   :   str   = 'default', 
+                 scratch        :   str   = None, 
+                 volumes        :   list  = None, 
+                 availability_zone : str = None, 
+                 monitoring     :   bool  = False,
+                 launch_backend :   str   = 'spot_request'):
         '''
         A class to run, control and interact with spot instances. 
         __________
@@ -91,7 +102,12 @@ class SpotInstance:
         - sec_group : string. name of the security group to use
         - efs_mount : bool. (for advanced use) If True, attach EFS mount. If no EFS mount with the name <filesystem> exists one is created. If filesystem is None the new EFS will have the same name as the instance  
         - new_mount : bool. (for advanced use) If True, create a new mount target on the EFS, even if one exists. If False, will be set to True if file system is submitted but no mount target is detected.
+        - scratch : str. mount point for the instance-store NVMe drives of the instance (combined in a RAID0 array if there are several), e.g. "/scratch". The directory is created on the root volume if the instance type has no instance-store 
+        - volumes : list of dict. EBS volumes to attach, restored from snapshots (optionally with fast snapshot restore and a pre-warm pass) or empty, see ec2_methods.snapshot_volume_mappings. Each one is mounted on its "mount_point" 
+        - availability_zone : str. availability zone to launch the instance in, required for volumes with fast snapshot restore. Any zone of the region if None 
+        - mount_preset : str. NFS settings used to mount the EFS, "default", "throughput" (large sequential files) or "metadata" (many small files), see bash_scripts.mount_presets
         - firewall : str. Firewall settings
+        - launch_backend : str, default "spot_request". Set to "fleet" to launch through an instant EC2 Fleet which returns the instance without polling the spot request. Falls back to "spot_request" when the fleet cannot launch the instance. 
         '''
 
         self.profile = None 
@@ -168,6 +184,10 @@ class SpotInstance:
         if self.kp_dir[-1]!='/': self.kp_dir = self.kp_dir + '/'
 
         self.new_mount = new_mount        
+        self.mount_preset = mount_preset 
+        self.scratch = scratch 
+        self.volumes = volumes 
+        self.availability_zone = availability_zone 
         self.monitoring = monitoring 
         self.instance_profile = instance_profile
                
@@ -180,26 +200,33 @@ class SpotInstance:
         self.filled_profile = None         
 
         # Launch the Instance 
-        # Launch the instance using the name profile, instance profile and monitoring arguments     
-        try:         
-            # If a key pair and security group were not added provided, they wil be created using the name of the instance                                
-            self.instance, self.profile = ec2_methods.get_spot_instance(self.name, self.profile, instance_profile=self.instance_profile, monitoring=self.monitoring, kp_dir=self.kp_dir, using_instance_id=self.using_id)  # Launch or connect to the spot instance under the given name 
-        except Exception as e:
-            raise e
-            sys.exit(1)
-       
-        # Mount Elastic File System
+        # The startup steps run as a pipeline: each step starts as soon as the steps it depends on are done, so the key pair and security group are set up 
+        # at the same time and the EFS and its mount target are created while the instance boots 
+        username = self.profile['username']
+
+        # Launch or connect to the spot instance under the given name, if a key pair and security group were not provided they will be created using the name of the instance 
+        steps = ec2_methods.spot_instance_steps(self.name, self.profile, instance_profile=self.instance_profile, monitoring=self.monitoring, kp_dir=self.kp_dir, using_instance_id=self.using_id, 
+                                                launch_backend=launch_backend, scratch=self.scratch, volumes=self.volumes, availability_zone=self.availability_zone)
+
+        # Make sure the scratch space and volumes are mounted, the user data does it at boot but the instance may have been launched without it 
+        if self.scratch is not None or self.volumes: 
+            _, self.volumes = ec2_methods.snapshot_volume_mappings(self.volumes or [])
+            steps['storage'] = (lambda results: instance_methods.run_script(results['boot'], username, bash_scripts.compose_storage_script(scratch=self.scratch, volumes=self.volumes, user=username), kp_dir=self.kp_dir, cmd=True), ['boot'])
+
+        # Mount Elastic File System, the file system and mount target only need the instance's subnet so they do not wait for it to boot 
         if self.profile['efs_mount']: 
-           
             print('Requesting EFS mount...')            
-            fs_name = self.filesystem                 
-            try:                                
-                self.mount_target, self.instance_dns, self.filesystem_dns = efs_methods.retrieve_efs_mount(fs_name, self.instance, new_mount=self.new_mount, region=self.profile['region'])
-            except Exception as e: 
-                raise e 
-                sys.exit(1)        
-            print('Connecting instance to link EFS...')
-            instance_methods.run_script(self.instance, self.profile['username'], bash_scripts.compose_mount_script(self.filesystem_dns), kp_dir=self.kp_dir, cmd=True)
+            steps['efs'] = (lambda results: efs_methods.describe_efs(self.filesystem, region=self.profile['region']), [])
+            steps['mount_target'] = (lambda results: efs_methods.retrieve_efs_mount(self.filesystem, results['instance'], new_mount=self.new_mount, region=self.profile['region']), ['efs', 'instance'])
+            steps['efs_mount'] = (lambda results: instance_methods.run_script(results['boot'], username, bash_scripts.compose_mount_script(results['mount_target'][2], preset=self.mount_preset), kp_dir=self.kp_dir, cmd=True), ['boot', 'mount_target'])
+
+        results, self.timings = sutils.run_pipeline(steps)
+
+        self.instance = results['boot']
+        self.scratch_paths = ([self.scratch] if self.scratch is not None else [])+[volume['mount_point'] for volume in (self.volumes or [])]
+        if self.profile['efs_mount']: 
+            self.mount_target, _, self.filesystem_dns = results['mount_target']
+            self.instance_dns = self.instance['PublicDnsName']
         
         # Automatically Run Scripts 
         st = time.time()
@@ -366,6 +393,15 @@ class SpotInstance:
         else: return False
         
 
+    def volumes_prewarmed(self):
+        '''Check whether the pre-warm pass of every volume mounted with "prewarm" has finished reading the volume'''
+        done = ['/tmp/spot_connect_prewarm_'+volume['device'].replace('/dev/', '')+'.done' for volume in (self.volumes or []) if volume.get('prewarm')]
+        if len(done)==0: 
+            return True 
+        output = self.run('ls '+' '.join(done)+' 2>/dev/null | wc -l', cmd=True, return_output=True)
+        return output.strip()==str(len(done))
+
+
     def terminate(self): 
         '''Terminate the instance'''
         instance_methods.terminate_instance(self.instance['InstanceId'])     
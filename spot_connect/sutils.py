@@ -11,13 +11,13 @@ build out the other sub-modules in spot-connect.
 MIT License 2020
 """
 
-import os, ast, boto3, random, string, pprint, glob, re, psutil
+import os, ast, boto3, random, string, pprint, glob, re, psutil, itertools, time, threading
 import _pickle as pickle
 import pandas as pd 
 import numpy as np
 from path import Path 
 from IPython.display import clear_output
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 root = Path(os.path.dirname(os.path.abspath(__file__)))
@@ -40,6 +40,74 @@ def chunks(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
+def iter_chunks(iterable, n):
+    """Yield successive n-sized lists from any iterable (e.g. a generator) without materializing it."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if len(batch)==0:
+            return
+        yield batch
+
+def run_pipeline(steps, max_workers=8, verbose=True):
+    '''
+    Run steps that depend on each other, each step starts in a thread pool as soon as the steps it depends on are done. 
+    Returns the results of the steps and their timings ({step: {"start", "end", "seconds"}}, in seconds since the pipeline started). 
+    If a step fails no new step is started and the exception is raised once the running steps are done. 
+    __________
+    parameters
+    - steps : dict. {name: (function, [names of the steps it depends on])}, each function is called with the dict of results of the finished steps 
+    - max_workers : int. maximum number of steps running at the same time 
+    - verbose : bool. if True, print the timing of each step and the time saved compared to running the steps one after the other 
+    '''
+    for name, (_, dependencies) in steps.items():
+        for dependency in dependencies:
+            if dependency not in steps:
+                raise Exception('Step "'+name+'" depends on the unknown step "'+dependency+'"')
+
+    results, timings, running = {}, {}, {}
+    pending = dict(steps)
+    failed = None
+    st = time.time()
+
+    def timed(name, function):
+        timings[name] = {'start': time.time()-st}
+        try:
+            return function(results)
+        finally:
+            timings[name]['end'] = time.time()-st
+            timings[name]['seconds'] = timings[name]['end']-timings[name]['start']
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if failed is None:
+                for name in [n for n, (_, dependencies) in pending.items() if all(d in results for d in dependencies)]:
+                    running[executor.submit(timed, name, pending.pop(name)[0])] = name
+            if not running:
+                if failed is None:
+                    raise Exception('Circular dependencies between the steps: '+', '.join(pending))
+                break
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    if failed is None:
+                        failed = e
+
+    if verbose:
+        total = time.time()-st
+        print('Phase timings:')
+        for name in sorted(timings, key=lambda n: timings[n]['start']):
+            print('   %-16s %7.1fs -> %7.1fs (%.1fs)' % (name, timings[name]['start'], timings[name]['end'], timings[name]['seconds']))
+        print('Total %.1fs, %.1fs saved by running the phases concurrently' % (total, max(0, sum(t['seconds'] for t in timings.values())-total)), flush=True)
+
+    if failed is not None:
+        raise failed
+
+    return results, timings
+
 def genrs(length=10):
     return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
 
@@ -77,6 +145,45 @@ def save_profiles(profiles):
         f.write(pprint.pformat(profiles))
         f.close()
 
+# Launch templates are cached from the threads launching instances in parallel
+launch_templates_lock = threading.RLock()
+
+def load_launch_templates():
+    '''Load the cached launch template descriptors from the package launch_templates.txt file'''
+    template_file = os.path.join(pull_root(),'data','launch_templates.txt')
+
+    if not os.path.exists(template_file):
+        return {}
+
+    with open(template_file,'r') as f:
+        templates = ast.literal_eval(f.read())
+
+    return templates
+
+def save_launch_templates(templates):
+    '''Save the launch template cache dict str in a .txt file. The file is written to a temporary file and renamed so readers never see a partial cache'''
+    template_file = os.path.join(pull_root(),'data','launch_templates.txt')
+    tmp_file = template_file+'.'+str(os.getpid())+'.tmp'
+
+    with launch_templates_lock: 
+        with open(tmp_file,'w') as f:
+            f.write(pprint.pformat(templates))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, template_file)
+
+def update_launch_templates(key, entry=None): 
+    '''Set (or remove, if entry is None) a single launch template in the cache. The cache is re-read under the lock so concurrent launches do not drop each other's entries'''
+    with launch_templates_lock: 
+        templates = load_launch_templates()
+        if entry is not None: 
+            templates[key] = entry
+        elif key in templates: 
+            del templates[key]
+        else: 
+            return 
+        save_launch_templates(templates)
+
 def default_region(): 
     profiles = load_profiles()
     print(profiles['default']['region'])       
@@ -120,6 +227,14 @@ def printTotals(transferred, toBeTransferred):
     '''Print paramiko upload transfer'''
     print("Transferred: %.3f" % float(float(transferred)/float(toBeTransferred)), end="\r", flush=True)
 
+def parse_transfer_size(line):
+    '''Return the number of bytes completed in an aws cli progress line such as "Completed 1.2 GiB/~3.4 GiB (52.1 MiB/s) with ~10 file(s) remaining", 0 if it cannot be parsed'''
+    match = re.search(r'Completed ([\d.]+) (Bytes|KiB|MiB|GiB|TiB)', line)
+    if match is None:
+        return 0
+    units = {'Bytes': 1, 'KiB': 1024, 'MiB': 1024**2, 'GiB': 1024**3, 'TiB': 1024**4}
+    return int(float(match.group(1))*units[match.group(2)])
+
 def get_package_kp_dir():
     '''Get the key-pair directory'''
     kpfile = [f for f in list(absoluteFilePaths(os.path.join(pull_root(),'data'))) if os.path.split(f)[-1]=='key_pair_default_dir.txt'][0]    
@@ -251,7 +366,7 @@ def split_workloads(n_jobs, workload, wrkdir=None, filename=None):
     else: 
         filename = wrkdir + '/' + filename
         
-    workload_size = int(np.ceil(len(workload))/n_jobs)
+    workload_size = int(np.ceil(len(workload)/n_jobs))
         
     workload_list = [c for c in chunks(workload, workload_size)]
     
@@ -264,86 +379,6 @@ def split_workloads(n_jobs, workload, wrkdir=None, filename=None):
 
     return filenames 
 
-class CurrentIdLog:
-    
-    def __init__(self, logdir=None, lower_limit=0, upper_limit=9999999):
-        '''
-        A log class to keep track of the user and call Ids that have been used today.
-        This class was designed to avoid using repeat user id numbers and call numbers which will return an error in the API.
-        We reset by day because call numbers are reset in the API system after a short ammount of time.
-        __________
-        parameters
-        - logdir : str. the directory to load or store the "current_session_ids.pickle" file which contains the IDs that have been used today so far. 
-        '''
-        self.curid=None
-        self.ids=None
-        self.hd=None
-        
-        self.lower_limit = lower_limit 
-        self.upper_limit = upper_limit
-        
-        date = datetime.today().date()
-        
-        if logdir is None: 
-            self.hd=os.path.join(pull_root(),'data')
-        else: 
-            self.hd=logdir
-        
-        if os.path.exists(self.hd+'/current_session_ids.pickle'):
-            self.ids=loosen(self.hd+'/current_session_ids.pickle')             # load any existing log 
-            if self.ids['date']!=date:                                         # if it is from a different date we reset it 
-                self.ids={}
-                self.ids['date']=date                                          # and set its date to today   
-        else: 
-            self.ids={}
-            self.ids['date']=date
-    
-    def add_user_id(self, uid):                                     
-        '''Add a user ID to the list of unavailable IDs'''
-        self.ids[uid]=[]
-    
-    def set_user_id(self, uid):
-        '''Set the current session ID'''
-        self.curid=uid
-        if uid not in self.ids:
-            self.add_user_id(uid)
-    
-    def add_call_id(self, fid):
-        '''Log that the current fid has been used with the current session id'''
-        self.ids[self.curid].append(fid)
-
-    def get_valid_user_id(self, verbose=False):
-        '''Get a user ID that has not been used yet'''
-        uid=random.randint(self.lower_limit,self.upper_limit)                  # propose a random integer as the new user ID 
-        valid=False
-        while not valid: 
-            if uid in self.ids:                                                # if it is in the current list of used IDs 
-                uid=random.randint(self.lower_limit,self.upper_limit)          # propose another
-            else: 
-                self.set_user_id(uid)                                          # otherwise set it as the current ID and move on 
-                full_pickle(self.hd+'/current_session_ids', self.ids)          # save the id dictionary for todays session 
-                valid=True
-        if verbose: 
-            print('Current ID is %i' % uid)
-        
-        return uid                                                             # return the user ID for use 
-    
-    def get_valid_call_id(self, verbose=False):
-        '''Get a function ID that has not been used for the current user yet'''
-        fid=random.randint(self.lower_limit,self.upper_limit)                  # propose a random integer as the new function ID 
-        valid=False
-        while not valid:
-            if fid in self.ids[self.curid]:                                    # if the current user has used it already 
-                fid=random.randint(self.lower_limit,self.upper_limit)          # propose a new one
-            else: 
-                self.ids[self.curid].append(fid)                               # otherwise add it to the list and use it and move on 
-                full_pickle(self.hd+'/current_session_ids', self.ids)          # save the id dictionary for todays session 
-                valid=True
-        if verbose:
-            print('Call ID is %i' % fid)
-        
-        return fid    
-
 # Load the data needed for the module
 username_dictionary = {'Linux':'ec2-user',
                        'Ubuntu':'ubuntu',
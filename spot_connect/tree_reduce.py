@@ -0,0 +1,215 @@
+"""
+Author: Carlos Valcarcel <carlos.d.valcarcel.w@gmail.com>
+
+This file is part of spot-connect
+
+Hierarchical result reduction - tree_reduce.py:
+
+The tree_reduce script merges the partial results (pickle files) in a shared
+directory, such as the EFS mounted on a fleet, with a user supplied combiner
+function. Each instance of the fleet runs it with its own rank: it first
+reduces its share of the files and then partials are merged pairwise (or
+`fan_in` at a time) level by level until rank 0 writes the final result, so
+only the final artifact has to leave the shared file system. Without a rank it
+reduces the whole directory in the current process, which is also the local
+fallback when the results are on a local disk. It only depends on the standard
+library:
+
+    python tree_reduce.py <directory> <module:function> <output> [--rank R --world-size N --run-id ID] [--pattern GLOB] [--fan-in K] [--path DIR]
+
+Every rank of a distributed reduction must be given the same run id, the
+partials of the run are kept in their own `_tree_reduce/<run id>` directory so
+those left behind by an earlier (failed) reduction are never picked up.
+
+Use bash_scripts.compose_tree_reduce_script to build the command.
+
+MIT License 2020
+"""
+
+import os, sys, glob, time, shutil, pickle, argparse, importlib
+
+
+def load(file):
+    '''Load a pickled partial result'''
+    with open(file, 'rb') as f:
+        return pickle.load(f)
+
+
+def save(data, file):
+    '''Pickle a partial result, the file is written under a temporary name and renamed so other instances never read it half written'''
+    tmp = file+'.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(data, f)
+    os.replace(tmp, file)
+
+
+def load_function(spec, path=None):
+    '''Import the function given as "module:function"'''
+    if path is not None and path not in sys.path:
+        sys.path.insert(0, path)
+    module_name, function_name = spec.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def reduce_files(files, combiner, fan_in=2):
+    '''
+    Reduce a list of pickle files with the combiner as a tree, streaming the files: each file is loaded and merged as soon as `fan_in` partials of the same
+    level are available, so at most fan_in-1 partials per level (a logarithmic number) are held in memory. The order of the files is kept, the combiner
+    only needs to be associative. Returns None if there are no files.
+    '''
+    levels = []
+    for file in files:
+        partial = load(file)
+        level = 0
+        while True:
+            if len(levels)==level:
+                levels.append([])
+            levels[level].append(partial)
+            if len(levels[level])<fan_in:
+                break
+            group, levels[level] = levels[level], []
+            partial = group[0]
+            for other in group[1:]:
+                partial = combiner(partial, other)
+            level += 1
+
+    # The partials left on the higher levels cover the earlier files
+    result = None
+    for level in reversed(levels):
+        for partial in level:
+            result = partial if result is None else combiner(result, partial)
+    return result
+
+
+def part_file(work_dir, level, index):
+    return os.path.join(work_dir, 'level_'+str(level)+'_part_'+str(index)+'.pickle')
+
+
+def empty_file(work_dir, level, index):
+    return os.path.join(work_dir, 'level_'+str(level)+'_part_'+str(index)+'.empty')
+
+
+def wait_for_part(work_dir, level, index, timeout=3600, poll_interval=2):
+    '''Wait until the partial (or its empty marker) exists and return its path, or None if the partial is empty'''
+    st = time.time()
+    while True:
+        if os.path.exists(part_file(work_dir, level, index)):
+            return part_file(work_dir, level, index)
+        if os.path.exists(empty_file(work_dir, level, index)):
+            return None
+        if time.time()-st>timeout:
+            raise Exception('Timed out waiting for partial '+str(index)+' of level '+str(level))
+        time.sleep(poll_interval)
+
+
+def work_directory(directory, run_id):
+    '''Directory where the partials of a distributed reduction are exchanged, one per run so stale partials of an earlier run are never read'''
+    return os.path.join(directory, '_tree_reduce', str(run_id))
+
+
+def reduce_rank(directory, combiner, output, rank, world_size, run_id, pattern='*.pickle', fan_in=2, timeout=3600, poll_interval=2):
+    '''
+    Run one rank of a distributed tree reduction over the files of a shared directory.
+    Level 0: rank r reduces the r-th of `world_size` contiguous blocks of the files (sorted by name), so the results are merged in the order of the files and
+    the combiner only needs to be associative.
+    Level L: partial i is the merge of partials i*fan_in ... i*fan_in+fan_in-1 of level L-1 and is computed by rank i*fan_in**L, which waits for the
+    partials it needs to appear in the shared directory. Ranks with nothing left to merge return. Rank 0 saves the final result to `output`.
+    Returns the final result on rank 0 and None on the other ranks.
+    __________
+    parameters
+    - directory : str. shared directory with the partial results
+    - combiner : callable. function that merges two partial results into one
+    - output : str. path of the final reduced pickle
+    - rank : int. rank of this instance, from 0 to world_size-1
+    - world_size : int. number of instances taking part in the reduction
+    - run_id : str. identifier of the reduction, the same for every rank and unique to each run 
+    - pattern : str. glob pattern of the partial result files in the directory
+    - fan_in : int. number of partials merged together at each level
+    - timeout : int. maximum number of seconds to wait for another rank's partial
+    - poll_interval : int. number of seconds between checks for another rank's partial
+    '''
+    if run_id is None or str(run_id)=='':
+        raise Exception('A run_id shared by every rank is required for a distributed reduction')
+    work_dir = work_directory(directory, run_id)
+    os.makedirs(work_dir, exist_ok=True)
+
+    files = sorted(f for f in glob.glob(os.path.join(directory, pattern)) if os.path.abspath(f)!=os.path.abspath(output))
+    result = reduce_files(files[rank*len(files)//world_size:(rank+1)*len(files)//world_size], combiner, fan_in=fan_in)
+
+    level = 0
+    index = rank
+    parts = world_size
+
+    while True:
+        if parts==1:
+            if result is not None:
+                save(result, output)
+            # Every other rank has saved its partials by now, clear them (a failed run leaves its own directory behind, which later runs ignore)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return result
+
+        if result is None:
+            open(empty_file(work_dir, level, index), 'w').close()
+        else:
+            save(result, part_file(work_dir, level, index))
+
+        # Only the first rank of each group carries on to the next level
+        if index%fan_in!=0:
+            return None
+
+        result = None
+        for child in range(index, min(index+fan_in, parts)):
+            child_file = wait_for_part(work_dir, level, child, timeout=timeout, poll_interval=poll_interval)
+            if child_file is None:
+                continue
+            partial = load(child_file)
+            result = partial if result is None else combiner(result, partial)
+
+        level += 1
+        index = index//fan_in
+        parts = -(-parts//fan_in)
+
+
+def tree_reduce_directory(directory, combiner, output=None, pattern='*.pickle', fan_in=2):
+    '''
+    Reduce every partial result in a directory in the current process (local fallback of the distributed reduction).
+    Saves the result to `output` if one is submitted and returns it.
+    __________
+    parameters
+    - directory : str. directory with the partial results
+    - combiner : callable. function that merges two partial results into one
+    - output : str. path of the final reduced pickle
+    - pattern : str. glob pattern of the partial result files in the directory
+    - fan_in : int. number of partials merged together at each level
+    '''
+    files = sorted(glob.glob(os.path.join(directory, pattern)))
+    if output is not None:
+        files = [f for f in files if os.path.abspath(f)!=os.path.abspath(output)]
+
+    result = reduce_files(files, combiner, fan_in=fan_in)
+    if output is not None and result is not None:
+        save(result, output)
+
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reduce the partial results in a directory')
+    parser.add_argument('directory', help='directory with the partial results')
+    parser.add_argument('combiner', help='function merging two partials as module:function')
+    parser.add_argument('output', help='path of the final result')
+    parser.add_argument('--rank', type=int, default=None, help='rank of this instance in a distributed reduction')
+    parser.add_argument('--world-size', type=int, default=1, help='number of instances in a distributed reduction')
+    parser.add_argument('--run-id', default=None, help='identifier shared by the ranks of a distributed reduction, unique to each run')
+    parser.add_argument('--pattern', default='*.pickle', help='glob pattern of the partial result files')
+    parser.add_argument('--fan-in', type=int, default=2, help='number of partials merged at each level')
+    parser.add_argument('--timeout', type=int, default=3600, help='seconds to wait for the partials of other ranks')
+    parser.add_argument('--path', default=None, help='directory to add to the python path')
+    args = parser.parse_args()
+
+    combiner = load_function(args.combiner, args.path)
+
+    if args.rank is None:
+        tree_reduce_directory(args.directory, combiner, output=args.output, pattern=args.pattern, fan_in=args.fan_in)
+    else:
+        reduce_rank(args.directory, combiner, args.output, args.rank, args.world_size, args.run_id, pattern=args.pattern, fan_in=args.fan_in, timeout=args.timeout)
@@ -0,0 +1,69 @@
+"""
+Tests for the file system destination of spot_connect/checkpoint.py, a temporary directory stands in for the EFS.
+"""
+
+import os
+
+import pytest
+
+from spot_connect import checkpoint
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def efs_bytes(efs):
+    chunk_dir = os.path.join(efs, '.chunks')
+    return sum(os.path.getsize(os.path.join(chunk_dir, name)) for name in os.listdir(chunk_dir))
+
+
+def test_stream_and_restore(tmp_path):
+    source, efs = str(tmp_path/'checkpoints'), str(tmp_path/'efs')
+    write(os.path.join(source, 'model', 'weights.bin'), b'a'*10+b'b'*10+b'c'*5)
+    streamer = checkpoint.CheckpointStreamer(source, efs, chunk_size=10)
+    streamer.flush()
+    assert streamer.stats['bytes']==25
+    assert checkpoint.restore_checkpoint(efs, str(tmp_path/'first'))==[os.path.join('model', 'weights.bin')]
+    assert read(str(tmp_path/'first'/'model'/'weights.bin'))==b'a'*10+b'b'*10+b'c'*5
+
+    # Only the second chunk changes and the file shrinks, only that chunk is written to the EFS
+    write(os.path.join(source, 'model', 'weights.bin'), b'a'*10+b'x'*10)
+    os.utime(os.path.join(source, 'model', 'weights.bin'), (1, 1))
+    streamer.flush()
+    assert streamer.stats['bytes']==25+10
+    assert streamer.stats['chunks_skipped']==1
+    # The chunks of the previous version are removed once the new manifest is saved
+    assert efs_bytes(efs)==20
+
+    restored = checkpoint.restore_checkpoint(efs, str(tmp_path/'restored'))
+    assert restored==[os.path.join('model', 'weights.bin')]
+    assert read(str(tmp_path/'restored'/'model'/'weights.bin'))==b'a'*10+b'x'*10
+
+
+def test_interrupted_write_keeps_previous_version(tmp_path):
+    source, efs = str(tmp_path/'checkpoints'), str(tmp_path/'efs')
+    data = b'a'*10+b'b'*10
+    write(os.path.join(source, 'weights.bin'), data)
+    streamer = checkpoint.CheckpointStreamer(source, efs, chunk_size=10)
+    streamer.flush()
+
+    def interrupted(offset):
+        if offset>0:
+            raise KeyboardInterrupt()
+        return b'x'*10
+
+    with pytest.raises(KeyboardInterrupt):
+        streamer.store.write_file('weights.bin', len(data), [(0, 0, 'new0'), (1, 10, 'new1')], interrupted, lambda nbytes: None)
+
+    # The manifest still describes the previous version and no partial chunk is left behind
+    assert checkpoint.restore_checkpoint(efs, str(tmp_path/'restored'))==['weights.bin']
+    assert read(str(tmp_path/'restored'/'weights.bin'))==data
+    assert not any(name.endswith('.tmp') for name in os.listdir(os.path.join(efs, '.chunks')))
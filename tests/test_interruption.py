@@ -0,0 +1,96 @@
+"""
+Tests for spot_connect/interruption.py against a local HTTP server standing in for the instance metadata service.
+"""
+
+import json, threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from spot_connect import interruption
+
+
+class MetadataService(BaseHTTPRequestHandler):
+
+    # Set by the metadata_service fixture 
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_PUT(self):
+        self.state['token_requests'] += 1
+        if self.path=='/latest/api/token' and self.state['imdsv2']:
+            self.reply(200, 'token-1')
+        else:
+            self.reply(403)
+
+    def do_GET(self):
+        self.state['tokens'].append(self.headers.get('X-aws-ec2-metadata-token'))
+        if self.path=='/latest/meta-data/spot/instance-action' and self.state['action'] is not None:
+            self.reply(200, json.dumps(self.state['action']))
+        elif self.path=='/latest/meta-data/events/recommendations/rebalance' and self.state['rebalance'] is not None:
+            self.reply(200, json.dumps(self.state['rebalance']))
+        else:
+            self.reply(404)
+
+
+@pytest.fixture
+def metadata_service():
+    state = {'imdsv2': True, 'token_requests': 0, 'tokens': [], 'action': None, 'rebalance': None}
+    handler = type('Handler', (MetadataService,), {'state': state})
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state['endpoint'] = 'http://127.0.0.1:'+str(server.server_port)
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def test_notices_run_hooks_in_priority_order(metadata_service):
+    handler = interruption.InterruptionHandler(endpoint=metadata_service['endpoint'], poll_interval=0.05, verbose=False)
+    calls = []
+    handler.register(lambda: calls.append('upload'), priority=5, name='upload')
+    handler.register(lambda: calls.append('save'), priority=10, name='save')
+    handler.register(lambda: calls.append('drain'), name='drain', events=('rebalance',))
+    handler.start()
+
+    try:
+        assert not handler.wait(0.3)
+        metadata_service['rebalance'] = {'noticeTime': '2020-07-05T21:38:55Z'}
+        metadata_service['action'] = {'action': 'terminate', 'time': '2020-07-05T21:40:55Z'}
+        assert handler.wait(5)
+        handler.wait_for_hooks(5)
+        handler.hook_threads['rebalance'].join(5)
+    finally:
+        handler.stop()
+
+    assert handler.notice=={'action': 'terminate', 'time': '2020-07-05T21:40:55Z'}
+    assert handler.watcher.rebalance=={'noticeTime': '2020-07-05T21:38:55Z'}
+    assert [entry['hook'] for entry in handler.report if entry['event']=='interruption']==['save', 'upload']
+    assert calls.index('save')<calls.index('upload') and 'drain' in calls
+    # The token is requested once and reused by every poll 
+    assert metadata_service['token_requests']==1
+    assert set(metadata_service['tokens'])=={'token-1'}
+
+
+def test_token_failure_falls_back_to_imdsv1(metadata_service):
+    metadata_service['imdsv2'] = False
+    watcher = interruption.InterruptionWatcher(endpoint=metadata_service['endpoint'], poll_interval=0.05)
+
+    for _ in range(5):
+        assert watcher.check() is None
+    metadata_service['action'] = {'action': 'stop', 'time': '2020-07-05T21:40:55Z'}
+    assert watcher.check()['action']=='stop'
+    assert watcher.interrupted
+
+    # The failed token request is not repeated on every poll 
+    assert metadata_service['token_requests']==1
+    assert set(metadata_service['tokens'])=={None}
@@ -0,0 +1,51 @@
+"""
+Tests for spot_connect/pool_runner.py, the workload runs on a local process pool.
+"""
+
+import os, time, pickle
+
+from spot_connect import pool_runner
+
+
+def slow_first(item):
+    # The first item takes as long as all the others together on one core 
+    time.sleep(1.0 if item==0 else 0.02)
+    if item==5:
+        raise ValueError('bad item')
+    return item*2
+
+
+def write_workload(tmp_path, items):
+    workload_file = str(tmp_path/'workload.pickle')
+    with open(workload_file, 'wb') as f:
+        pickle.dump(items, f)
+    return workload_file
+
+
+def test_items_are_balanced_across_processes(tmp_path):
+    workload_file = write_workload(tmp_path, list(range(40)))
+    output_dir = str(tmp_path/'results')
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    manifest = pool_runner.run_workload(workload_file, 'test_pool_runner:slow_first', output_dir, processes=2, path=here)
+
+    assert manifest['items']==40
+    assert manifest['errors']==1
+    assert sum(worker['items'] for worker in manifest['workers'])==40
+    # The idle process takes the remaining items while the other one works on the slow item 
+    assert min(worker['items'] for worker in manifest['workers'])<=3
+
+    results = pool_runner.load_results(output_dir)
+    assert results==[i*2 for i in range(40) if i!=5]
+
+    # Each worker file holds a single pickle, so the files can be merged with tree_reduce 
+    for worker in manifest['workers']:
+        with open(worker['file'], 'rb') as f:
+            record = pickle.load(f)
+            assert f.read()==b''
+        assert len(record['results'])+len(record['errors'])==worker['items']
+
+
+def test_empty_workload(tmp_path):
+    manifest = pool_runner.run_workload(write_workload(tmp_path, []), 'test_pool_runner:slow_first', str(tmp_path/'results'), processes=2, path=os.path.dirname(os.path.abspath(__file__)))
+    assert manifest['items']==0 and manifest['workers']==[]
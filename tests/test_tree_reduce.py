@@ -0,0 +1,108 @@
+"""
+Tests for spot_connect/tree_reduce.py, a plain temporary directory stands in for the EFS shared by the ranks and each rank runs in its own process.
+"""
+
+import os, pickle, multiprocessing
+
+import pytest
+
+from spot_connect import tree_reduce
+
+
+def add(a, b):
+    return a+b
+
+
+def concat(a, b):
+    return a+b
+
+
+def write_parts(directory, values):
+    for i, value in enumerate(values):
+        with open(os.path.join(directory, 'result_'+str(i).zfill(3)+'.pickle'), 'wb') as f:
+            pickle.dump(value, f)
+
+
+def run_ranks(directory, output, world_size, run_id, fan_in=2, combiner=add):
+    ranks = [multiprocessing.Process(target=tree_reduce.reduce_rank, 
+                                     args=(str(directory), combiner, str(output), rank, world_size, run_id), 
+                                     kwargs={'pattern':'result_*.pickle', 'fan_in':fan_in, 'timeout':60, 'poll_interval':0.05}) for rank in range(world_size)]
+    for rank in ranks:
+        rank.start()
+    for rank in ranks:
+        rank.join(120)
+        assert rank.exitcode==0
+    return tree_reduce.load(str(output))
+
+
+@pytest.mark.parametrize('world_size,fan_in', [(1, 2), (3, 2), (4, 2), (5, 3)])
+def test_distributed_reduction(tmp_path, world_size, fan_in):
+    write_parts(tmp_path, list(range(11)))
+    output = tmp_path/'final.pickle'
+    assert run_ranks(tmp_path, output, world_size, 'run1', fan_in=fan_in)==sum(range(11))
+    assert not os.path.exists(tree_reduce.work_directory(str(tmp_path), 'run1'))
+
+
+@pytest.mark.parametrize('world_size,fan_in', [(1, 2), (3, 2), (4, 3), (16, 2)])
+def test_distributed_reduction_keeps_file_order(tmp_path, world_size, fan_in):
+    # List concatenation is associative but not commutative 
+    write_parts(tmp_path, [[i] for i in range(13)])
+    assert run_ranks(tmp_path, tmp_path/'final.pickle', world_size, 'run1', fan_in=fan_in, combiner=concat)==list(range(13))
+
+
+def test_files_are_streamed(tmp_path, monkeypatch):
+    write_parts(tmp_path, [[i] for i in range(16)])
+    events = []
+    load = tree_reduce.load
+    monkeypatch.setattr(tree_reduce, 'load', lambda file: events.append('load') or load(file))
+
+    def combiner(a, b):
+        events.append('combine')
+        return a+b
+
+    files = sorted(str(f) for f in tmp_path.glob('result_*.pickle'))
+    assert tree_reduce.reduce_files(files, combiner, fan_in=2)==list(range(16))
+    # Partials are merged as soon as a pair is loaded instead of loading every file first 
+    assert events[:3]==['load', 'load', 'combine']
+    for fan_in in [2, 3, 5]:
+        assert tree_reduce.reduce_files(files[:11], concat, fan_in=fan_in)==list(range(11))
+
+
+def test_more_ranks_than_files(tmp_path):
+    write_parts(tmp_path, [1, 2])
+    assert run_ranks(tmp_path, tmp_path/'final.pickle', 5, 'run1')==3
+
+
+def test_stale_partials_are_ignored(tmp_path):
+    write_parts(tmp_path, list(range(6)))
+    # Partials left behind by a reduction that failed before rank 0 cleared them 
+    for run_dir in [os.path.join(str(tmp_path), '_tree_reduce'), tree_reduce.work_directory(str(tmp_path), 'failed')]:
+        os.makedirs(run_dir, exist_ok=True)
+        tree_reduce.save(1000, tree_reduce.part_file(run_dir, 0, 1))
+        open(tree_reduce.empty_file(run_dir, 0, 0), 'w').close()
+
+    assert run_ranks(tmp_path, tmp_path/'final.pickle', 2, 'run2')==sum(range(6))
+
+
+def test_repeated_runs(tmp_path):
+    write_parts(tmp_path, list(range(4)))
+    output = tmp_path/'final.pickle'
+    assert run_ranks(tmp_path, output, 2, 'run1')==6
+    write_parts(tmp_path, [10, 20, 30, 40])
+    assert run_ranks(tmp_path, output, 2, 'run2')==100
+
+
+def test_run_id_is_required(tmp_path):
+    write_parts(tmp_path, [1])
+    with pytest.raises(Exception):
+        tree_reduce.reduce_rank(str(tmp_path), add, str(tmp_path/'final.pickle'), 0, 1, None)
+
+
+def test_local_reduction(tmp_path):
+    write_parts(tmp_path, [[i] for i in range(7)])
+    assert tree_reduce.tree_reduce_directory(str(tmp_path), concat, pattern='result_*.pickle', fan_in=2)==list(range(7))
+    write_parts(tmp_path, list(range(9)))
+    output = tmp_path/'final.pickle'
+    assert tree_reduce.tree_reduce_directory(str(tmp_path), add, output=str(output), pattern='result_*.pickle', fan_in=3)==36
+    assert tree_reduce.load(str(output))==36
+    assert tree_reduce.tree_reduce_directory(str(tmp_path/'missing'), add) is None